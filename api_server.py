@@ -1,19 +1,41 @@
+import logging
 from flask import Flask, jsonify, request, g
-from database import get_logs
+from database import get_logs, connect
+import os
 import sqlite3
+import json
+import time
 from datetime import datetime
-from config import DATABASE_FILE
+from functools import wraps
+from metrics import REGISTRY, HTTP_REQUESTS, HTTP_REQUEST_SECONDS, HTTP_REJECTED
+from rate_limit import RateLimiter, retry_after
+from config import (SQL_PROFILING, SQL_PROFILE_REPEAT_THRESHOLD, SQL_PROFILE_SLOWEST,
+                    RATE_LIMIT_DEVICE, RATE_LIMIT_CLIENT, RATE_LIMIT_MAX_KEYS)
+import sql_profiler
+import search_index
+import event_segments
+import low_stock
+import notification_digest
+import refill_report
+import presence
+import reference_cache
+import bulk_schedule
+from scheduler import SCHEDULER
 from mqtt_publisher import (send_dispense_command, send_refill_command, 
-                          set_hard_mode, reset_pending_module, publish_schedule)
-from utils import transform_schedule_for_mqtt
+                          set_hard_mode, reset_pending_module, publish_schedule,
+                          publish_saturated)
+from utils import transform_schedule_for_mqtt, next_dose, parse_time
+import device_shadow
+import command_tracker
 
 app = Flask(__name__)
+logger = logging.getLogger(__name__)
 
 # Database connection management
 def get_db():
     """Get database connection for the current request context"""
     if 'db' not in g:
-        g.db = sqlite3.connect(DATABASE_FILE)
+        g.db = connect()
         g.db.row_factory = sqlite3.Row
     return g.db
 
@@ -24,6 +46,76 @@ def close_db(e=None):
     if db is not None:
         db.close()
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if SQL_PROFILING:
+        sql_profiler.start_profile(SQL_PROFILE_SLOWEST)
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        # Label by URL rule, not path, so ids do not explode cardinality
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, request.method, route)
+        HTTP_REQUESTS.inc(request.method, route, str(response.status_code))
+    if SQL_PROFILING:
+        add_sql_profile(response)
+    return response
+
+def add_sql_profile(response):
+    """Report the request's SQL profile as X-SQL-* headers and a log line"""
+    profile = sql_profiler.stop_profile()
+    if profile is None:
+        return
+    summary = profile.to_dict(SQL_PROFILE_REPEAT_THRESHOLD)
+    response.headers['X-SQL-Queries'] = str(summary['queries'])
+    response.headers['X-SQL-Time-Ms'] = str(summary['sql_ms'])
+    if summary['slowest']:
+        response.headers['X-SQL-Slowest-Ms'] = str(summary['slowest'][0]['ms'])
+    if summary['repeated']:
+        response.headers['X-SQL-Repeated'] = str(max(summary['repeated'].values()))
+    logger.info("sql profile", extra={'fields': {'method': request.method, 'path': request.path, **summary}})
+
+device_limiter = RateLimiter(*RATE_LIMIT_DEVICE, max_keys=RATE_LIMIT_MAX_KEYS)
+client_limiter = RateLimiter(*RATE_LIMIT_CLIENT, max_keys=RATE_LIMIT_MAX_KEYS)
+
+def rejected(reason, status_code, wait):
+    HTTP_REJECTED.inc(reason)
+    response = jsonify({'error': 'Too many requests' if status_code == 429 else 'Server busy, retry later'})
+    response.status_code = status_code
+    response.headers['Retry-After'] = retry_after(wait)
+    return response
+
+def admit_command(view):
+    """Rate limit a command endpoint per device and per client; shed load when publishing is saturated"""
+    @wraps(view)
+    def wrapper(device_id, *args, **kwargs):
+        client = request.remote_addr or 'unknown'
+        wait = client_limiter.take(client)
+        if wait:
+            return rejected('client', 429, wait)
+        wait = device_limiter.take(device_id)
+        if wait:
+            client_limiter.refund(client)
+            return rejected('device', 429, wait)
+        if publish_saturated():
+            # Refuse before touching the database rather than queue behind the broker
+            client_limiter.refund(client)
+            device_limiter.refund(device_id)
+            return rejected('overloaded', 503, 1)
+        return view(device_id, *args, **kwargs)
+    return wrapper
+
+"""
+GET /metrics
+Prometheus text exposition format
+"""
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return app.response_class(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
 def start_api():
     app.run(host="0.0.0.0", port=4000)
 
@@ -50,6 +142,7 @@ def create_doctor():
             VALUES (?, ?)
         ''', (data['name'], data['email']))
         db.commit()
+        reference_cache.add_doctor(c.lastrowid)
         return jsonify({'id': c.lastrowid, 'status': 'success'}), 201
     except sqlite3.IntegrityError:
         return jsonify({'error': 'Email already exists'}), 409
@@ -190,8 +283,8 @@ def create_patient():
     try:
         doctor_id = data.get('doctor_id')
         if doctor_id is not None:
-            c.execute('SELECT id FROM doctor WHERE id = ?', (doctor_id,))
-            if not c.fetchone():
+            doctor_id = reference_cache.as_id(doctor_id)
+            if doctor_id is None or not reference_cache.doctor_exists(doctor_id):
                 return jsonify({'error': 'Invalid doctor_id'}), 400
 
         c.execute('''
@@ -202,6 +295,8 @@ def create_patient():
               doctor_id,
               data.get('notes')))
         db.commit()
+        reference_cache.set_patient_doctor(c.lastrowid, doctor_id)
+        notification_digest.set_patient_doctor(c.lastrowid, doctor_id)
         return jsonify({'id': c.lastrowid, 'status': 'success'}), 201
     except sqlite3.IntegrityError:
         return jsonify({'error': 'Invalid doctor_id'}), 400
@@ -220,13 +315,15 @@ def assign_doctor(patient_id):
     data = request.get_json()
     if not data or 'doctor_id' not in data:
         return jsonify({'error': 'doctor_id required'}), 400
+    doctor_id = reference_cache.as_id(data['doctor_id'])
+    if doctor_id is None:
+        return jsonify({'error': 'Invalid doctor_id'}), 400
     
     db = get_db()
     c = db.cursor()
     try:
         # Verify doctor exists
-        c.execute('SELECT id FROM doctor WHERE id = ?', (data['doctor_id'],))
-        if not c.fetchone():
+        if not reference_cache.doctor_exists(doctor_id):
             return jsonify({'error': 'Doctor not found'}), 404
             
         # Update patient's doctor
@@ -234,12 +331,14 @@ def assign_doctor(patient_id):
             UPDATE patient 
             SET doctor_id = ? 
             WHERE id = ?
-        ''', (data['doctor_id'], patient_id))
+        ''', (doctor_id, patient_id))
         
         if c.rowcount == 0:
             return jsonify({'error': 'Patient not found'}), 404
             
         db.commit()
+        reference_cache.set_patient_doctor(patient_id, doctor_id)
+        notification_digest.set_patient_doctor(patient_id, doctor_id)
         return jsonify({'status': 'success'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -275,6 +374,119 @@ def get_doctor_patients(doctor_id):
     
     return jsonify(patients)
 
+"""
+GET /api/doctors/{doctor_id}/dashboard
+Everything a doctor's dashboard needs for all their patients, built from a
+single query (plus the in-memory device shadow) instead of 1 + 2N calls.
+Response:
+{
+    "doctor_id": 1,
+    "patients": [
+        {
+            "id": 1,
+            "name": "John Doe",
+            "age": 45,
+            "device": {
+                "serial_number": "SN123456",
+                "last_status": "module1: Pill taken",
+                "last_alert": null,
+                "last_seen": "2025-06-01T08:00:12"
+            },
+            "low_modules": [{"module": "module2", "pills_left": 3, "threshold": 5}],
+            "pending_modules": [],
+            "next_dose": {"time": "2025-06-01T20:00:00", "medicine_name": "Aspirin", "module": "module1"},
+            "last_event": {"timestamp": "2025-06-01T08:00:12", "module": "module1", "message": "module1: Pill taken"}
+        }
+    ]
+}
+"""
+@app.route('/api/doctors/<int:doctor_id>/dashboard', methods=['GET'])
+def get_doctor_dashboard(doctor_id):
+    db = get_db()
+    c = db.cursor()
+    c.execute('''
+        SELECT d.id AS doctor_id,
+               p.id, p.name, p.age,
+               pd.serial_number,
+               (SELECT json_group_array(json_object(
+                           'module', dm.module_name,
+                           'pills_left', dm.pills_left,
+                           'threshold', dm.threshold,
+                           'pending', dm.pending))
+                FROM dispenser_module dm
+                WHERE dm.pill_dispenser_id = pd.id) AS modules,
+               (SELECT json_group_array(json_object(
+                           'time', s.time,
+                           'repeat_type', s.repeat_type,
+                           'days', s.days_of_week,
+                           'until_date', s.until_date,
+                           'medicine_name', s.medicine_name,
+                           'module', sm.module_name))
+                FROM schedule s
+                LEFT JOIN dispenser_module sm ON s.dispenser_module_id = sm.id
+                WHERE s.patient_id = p.id) AS schedules,
+               (SELECT json_object('timestamp', l.timestamp,
+                                   'module', lm.module_name,
+                                   'message', l.message)
+                FROM logs l
+                JOIN dispenser_module lm ON l.dispenser_module_id = lm.id
+                WHERE l.id = (
+                    -- newest log id per module comes straight off idx_logs_module
+                    SELECT MAX(last_id) FROM (
+                        SELECT (SELECT MAX(id) FROM logs WHERE dispenser_module_id = m.id) AS last_id
+                        FROM dispenser_module m
+                        WHERE m.pill_dispenser_id = pd.id))) AS last_event
+        FROM doctor d
+        LEFT JOIN patient p ON p.doctor_id = d.id
+        LEFT JOIN pill_dispenser pd ON pd.patient_id = p.id
+        WHERE d.id = ?
+        ORDER BY p.id
+    ''', (doctor_id,))
+
+    rows = c.fetchall()
+    if not rows:
+        return jsonify({'error': 'Doctor not found'}), 404
+
+    patients = []
+    for row in rows:
+        if row['id'] is None:
+            continue  # doctor without patients
+        modules = json.loads(row['modules']) if row['serial_number'] else []
+        schedules = json.loads(row['schedules'])
+        for schedule in schedules:
+            schedule['days'] = schedule['days'].split(',') if schedule['days'] else []
+        when, schedule = next_dose(schedules)
+
+        device = None
+        if row['serial_number']:
+            shadow = device_shadow.get_shadow(row['serial_number'])
+            device = {
+                'serial_number': row['serial_number'],
+                'last_status': shadow.last_status if shadow else None,
+                'last_alert': shadow.last_alert if shadow else None,
+                'last_seen': shadow.last_seen if shadow else None
+            }
+
+        patients.append({
+            'id': row['id'],
+            'name': row['name'],
+            'age': row['age'],
+            'device': device,
+            'low_modules': [{'module': m['module'], 'pills_left': m['pills_left'], 'threshold': m['threshold']}
+                            for m in modules
+                            if m['pills_left'] is not None and m['threshold'] is not None
+                            and m['pills_left'] <= m['threshold']],
+            'pending_modules': [m['module'] for m in modules if m['pending']],
+            'next_dose': {
+                'time': when.isoformat(),
+                'medicine_name': schedule['medicine_name'],
+                'module': schedule['module']
+            } if when else None,
+            'last_event': json.loads(row['last_event']) if row['last_event'] else None
+        })
+
+    return jsonify({'doctor_id': doctor_id, 'patients': patients})
+
 """
 GET /api/patients
 Response: 
@@ -460,14 +672,12 @@ def create_schedule(patient_id):
             # Validate required fields
             if not all(key in schedule for key in ['time', 'module', 'medicine_name']):
                 return jsonify({'error': 'Missing required schedule fields'}), 400
+            if parse_time(schedule['time']) is None:
+                return jsonify({'error': f'Invalid time {schedule["time"]!r}, expected HH:MM'}), 400
 
             # Get module id
-            c.execute('''
-                SELECT id FROM dispenser_module 
-                WHERE pill_dispenser_id = ? AND module_name = ?
-            ''', (device['id'], schedule['module']))
-            module = c.fetchone()
-            if not module:
+            module_id = reference_cache.module_id(device['serial_number'], schedule['module'])
+            if module_id is None:
                 return jsonify({'error': f'Module {schedule["module"]} not found'}), 404
 
             # Insert schedule
@@ -483,7 +693,7 @@ def create_schedule(patient_id):
                 ) VALUES (?, ?, ?, ?, ?, ?, ?)
             ''', (
                 patient_id,
-                module['id'],
+                module_id,
                 schedule['medicine_name'],
                 schedule['time'],
                 schedule.get('repeat_type', 'daily'),
@@ -504,69 +714,170 @@ def create_schedule(patient_id):
         
     except Exception as e:
         db.rollback()
-        print("Error at create schedule: ", e)
+        logger.exception("create schedule failed", extra={'fields': {'patient_id': patient_id}})
         return jsonify({'error': str(e)}), 500
     
 
+"""
+GET /api/search?q=jo dia&kind=patient&limit=20
+Ranked, prefix-matching full-text search over patient names and notes,
+doctor names and schedule medicine names. `kind` (patient | doctor |
+schedule) and `limit` are optional.
+Response:
+[
+    {"kind": "patient", "id": 1, "field": "notes", "snippet": "[Diabetes] patient",
+     "score": 4.2, "name": "John Doe"},
+    {"kind": "schedule", "id": 7, "field": "medicine_name", "snippet": "[Aspirin]",
+     "score": 2.9, "patient_id": 1, "medicine_name": "Aspirin"}
+]
+"""
+@app.route('/api/search', methods=['GET'])
+def search():
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'q required'}), 400
+    kind = request.args.get('kind')
+    if kind and kind not in search_index.SEARCH_KINDS:
+        return jsonify({'error': f'kind must be one of {", ".join(search_index.SEARCH_KINDS)}'}), 400
+    limit = min(request.args.get('limit', 20, type=int), 100)
+
+    db = get_db()
+    c = db.cursor()
+    try:
+        return jsonify(search_index.search(c, query, kind, limit))
+    except sqlite3.OperationalError as e:
+        return jsonify({'error': f'Search unavailable: {e}'}), 503
+
 # Device control endpoints
 """
 POST /api/devices/{device_id}/dispense
+Headers (optional):
+    Idempotency-Key: 6f1c2d3e-...   (retries with the same key never dispense twice)
 Request format:
 {
     "module_name": "module1"
 }
-Response: 
+Response (202 with "queued": true when the device is offline or the publish
+failed; the command is delivered from the queue later):
 {
     "status": "success",
-    "message": "Dispense command sent to module1"
+    "message": "Dispense command sent to module1",
+    "pills_left": 9,
+    "command_id": "3f9a01c2",
+    "queued": false
 }
 """
 @app.route('/api/devices/<device_id>/dispense', methods=['POST'])
+@admit_command
 def trigger_dispense(device_id):
     data = request.get_json()
     if not data or 'module_name' not in data:
         return jsonify({'error': 'module_name required'}), 400
+
+    idempotency_key = request.headers.get('Idempotency-Key')
     
     db = get_db()
     c = db.cursor()
     try:
-        # Verify module exists and get its ID
+        if idempotency_key:
+            # Claim the key first; a concurrent request with the same key
+            # blocks on the write lock and then sees it as taken
+            c.execute('''
+                INSERT OR IGNORE INTO idempotency_key (key, device_id, created_at)
+                VALUES (?, ?, ?)
+            ''', (idempotency_key, device_id, time.time()))
+            if c.rowcount == 0:
+                db.rollback()
+                return replay_idempotent_response(c, idempotency_key)
+
+        # Decrement only if pills are left, in a single statement
+        module_id = reference_cache.module_id(device_id, data['module_name'])
         c.execute('''
-            SELECT dm.id, dm.pills_left 
-            FROM dispenser_module dm
-            JOIN pill_dispenser pd ON dm.pill_dispenser_id = pd.id
-            WHERE pd.serial_number = ? AND dm.module_name = ?
-        ''', (device_id, data['module_name']))
+            UPDATE dispenser_module
+            SET pills_left = pills_left - 1
+            WHERE pills_left > 0 AND id = ?
+            RETURNING id, pills_left
+        ''', (module_id,))
         
         module = c.fetchone()
         if not module:
-            return jsonify({'error': 'Module not found'}), 404
-            
-        if module['pills_left'] <= 0:
-            return jsonify({'error': 'Module is empty'}), 400
-            
-        # Update pills count and set pending
-        c.execute('''
-            UPDATE dispenser_module 
-            SET pills_left = pills_left - 1
-            WHERE id = ?
-        ''', (module['id'],))
+            if module_id is None:
+                body, status_code = {'error': 'Module not found'}, 404
+            else:
+                body, status_code = {'error': 'Module is empty'}, 400
+            store_idempotent_response(c, idempotency_key, body, status_code)
+            db.commit()
+            return jsonify(body), status_code
         
         # Log the event
         c.execute('''
             INSERT INTO logs (timestamp, dispenser_module_id, message)
             VALUES (?, ?, ?)
         ''', (datetime.now().isoformat(), module['id'], f"Dispense command sent"))
+
+        body = {
+            'status': 'success',
+            'message': f'Dispense command sent to {data["module_name"]}',
+            'pills_left': module['pills_left']
+        }
+        store_idempotent_response(c, idempotency_key, body, 200)
         
         db.commit()
+        device_shadow.update_module(device_id, data['module_name'],
+                                    pills_left=module['pills_left'])
         
         # Send MQTT command
-        send_dispense_command(device_id, data['module_name'])
-        return jsonify({'status': 'success', 'message': f'Dispense command sent to {data["module_name"]}'})
+        body['command_id'] = send_dispense_command(device_id, data['module_name'])
+        body['queued'] = command_queued(body['command_id'])
+        status_code = 202 if body['queued'] else 200
+        if body['queued']:
+            body['message'] = f'Dispense command queued for {data["module_name"]}'
+        # Replays should be trackable too, so store the body with its command id
+        store_idempotent_response(c, idempotency_key, body, status_code)
+        db.commit()
+        dispatch_low_stock(db)
+        return jsonify(body), status_code
     except Exception as e:
         db.rollback()
         return jsonify({'error': str(e)}), 500
 
+def store_idempotent_response(c, idempotency_key, body, status_code):
+    """Remember the response for a claimed idempotency key (same transaction)"""
+    if not idempotency_key:
+        return
+    c.execute('''
+        UPDATE idempotency_key
+        SET response = ?, status_code = ?
+        WHERE key = ?
+    ''', (json.dumps(body), status_code, idempotency_key))
+
+def replay_idempotent_response(c, idempotency_key):
+    c.execute('''
+        SELECT response, status_code
+        FROM idempotency_key
+        WHERE key = ?
+    ''', (idempotency_key,))
+    row = c.fetchone()
+    if not row or row['response'] is None:
+        return jsonify({'error': 'Request with this Idempotency-Key is in progress'}), 409
+    response = app.response_class(row['response'], status=row['status_code'],
+                                  mimetype='application/json')
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def command_queued(command_id):
+    """True if the command waits in the offline queue (command_queue.py) instead of being sent"""
+    command = command_tracker.get_command(command_id)
+    return command is not None and command['state'] == command_tracker.QUEUED
+
+def dispatch_low_stock(db):
+    """Send threshold notifications; a failure here must not fail the command"""
+    try:
+        low_stock.dispatch_transitions(db)
+    except Exception:
+        db.rollback()  # unclaimed transitions go out with the next dispatch
+        logger.exception("low stock notification dispatch failed")
+
 """
 POST /api/devices/{device_id}/refill
 Request format:
@@ -574,13 +885,16 @@ Request format:
     "module_name": "module1",
     "count": 30
 }
-Response:
+Response (202 with "queued": true if the command was queued, as for dispense):
 {
     "status": "success",
-    "message": "Refill command sent to module1"
+    "message": "Refill command sent to module1",
+    "command_id": "3f9a01c2",
+    "queued": false
 }
 """
 @app.route('/api/devices/<device_id>/refill', methods=['POST'])
+@admit_command
 def refill_module(device_id):
     data = request.get_json()
     if not data or 'module_name' not in data or 'count' not in data:
@@ -590,15 +904,8 @@ def refill_module(device_id):
     c = db.cursor()
     try:
         # Verify module exists
-        c.execute('''
-            SELECT dm.id
-            FROM dispenser_module dm
-            JOIN pill_dispenser pd ON dm.pill_dispenser_id = pd.id
-            WHERE pd.serial_number = ? AND dm.module_name = ?
-        ''', (device_id, data['module_name']))
-        
-        module = c.fetchone()
-        if not module:
+        module_id = reference_cache.module_id(device_id, data['module_name'])
+        if module_id is None:
             return jsonify({'error': 'Module not found'}), 404
             
         # Update pills count
@@ -607,19 +914,25 @@ def refill_module(device_id):
             SET pills_left = ?,
                 pending = 0
             WHERE id = ?
-        ''', (data['count'], module['id']))
+        ''', (data['count'], module_id))
         
         # Log the event
         c.execute('''
             INSERT INTO logs (timestamp, dispenser_module_id, message)
             VALUES (?, ?, ?)
-        ''', (datetime.now().isoformat(), module['id'], f"Refilled with {data['count']} pills"))
+        ''', (datetime.now().isoformat(), module_id, f"Refilled with {data['count']} pills"))
         
         db.commit()
+        device_shadow.update_module(device_id, data['module_name'],
+                                    pills_left=data['count'], pending=0)
         
         # Send MQTT command
-        send_refill_command(device_id, data['module_name'], data['count'])
-        return jsonify({'status': 'success', 'message': f'Refill command sent to {data["module_name"]}'})
+        command_id = send_refill_command(device_id, data['module_name'], data['count'])
+        dispatch_low_stock(db)
+        queued = command_queued(command_id)
+        return jsonify({'status': 'success',
+                        'message': f'Refill command {"queued for" if queued else "sent to"} {data["module_name"]}',
+                        'command_id': command_id, 'queued': queued}), 202 if queued else 200
     except Exception as e:
         db.rollback()
         return jsonify({'error': str(e)}), 500
@@ -630,13 +943,16 @@ Request format:
 {
     "module_name": "module1"
 }
-Response:
+Response (202 with "queued": true if the command was queued, as for dispense):
 {
     "status": "success",
-    "message": "Reset pending state"
+    "message": "Reset pending state",
+    "command_id": "3f9a01c2",
+    "queued": false
 }
 """
 @app.route('/api/devices/<device_id>/reset_pending', methods=['POST'])
+@admit_command
 def reset_pending_state(device_id):
     data = request.get_json()
     if not data or 'module_name' not in data:
@@ -646,15 +962,8 @@ def reset_pending_state(device_id):
     c = db.cursor()
     try:
         # Verify module exists
-        c.execute('''
-            SELECT dm.id
-            FROM dispenser_module dm
-            JOIN pill_dispenser pd ON dm.pill_dispenser_id = pd.id
-            WHERE pd.serial_number = ? AND dm.module_name = ?
-        ''', (device_id, data['module_name']))
-        
-        module = c.fetchone()
-        if not module:
+        module_id = reference_cache.module_id(device_id, data['module_name'])
+        if module_id is None:
             return jsonify({'error': 'Module not found'}), 404
             
         # Reset pending state
@@ -662,23 +971,107 @@ def reset_pending_state(device_id):
             UPDATE dispenser_module 
             SET pending = 0
             WHERE id = ?
-        ''', (module['id'],))
+        ''', (module_id,))
         
         # Log the event
         c.execute('''
             INSERT INTO logs (timestamp, dispenser_module_id, message)
             VALUES (?, ?, ?)
-        ''', (datetime.now().isoformat(), module['id'], "Pending state reset"))
+        ''', (datetime.now().isoformat(), module_id, "Pending state reset"))
         
         db.commit()
+        device_shadow.update_module(device_id, data['module_name'], pending=0)
         
         # Send MQTT command
-        reset_pending_module(device_id, data['module_name'])
-        return jsonify({'status': 'success', 'message': 'Reset pending state'})
+        command_id = reset_pending_module(device_id, data['module_name'])
+        queued = command_queued(command_id)
+        return jsonify({'status': 'success', 'message': 'Reset pending state', 'command_id': command_id,
+                        'queued': queued}), 202 if queued else 200
     except Exception as e:
         db.rollback()
         return jsonify({'error': str(e)}), 500
 
+"""
+GET /api/commands/{command_id}
+Response:
+{
+    "command_id": "3f9a01c2",
+    "device_id": "SN123456",
+    "command": "dispense:module1",
+    "state": "completed",          # sent | acked | completed | timed_out
+    "sent_at": 1717228800.12,
+    "acked_at": 1717228800.31,
+    "completed_at": 1717228801.02,
+    "reply": "module1: Pill dispensed"
+}
+"""
+@app.route('/api/commands/<command_id>', methods=['GET'])
+def get_command_status(command_id):
+    command = command_tracker.get_command(command_id)
+    if not command:
+        return jsonify({'error': 'Command not found'}), 404
+    return jsonify(command)
+
+"""
+GET /api/devices/slow?p95=2.5
+Devices whose p95 command round trip exceeds `p95` seconds, or whose
+latest commands timed out (unresponsive first).
+Response:
+[
+    {
+        "device_id": "SN123456",
+        "unresponsive": true,
+        "count": 12,
+        "mean": 0.8,
+        "p50": 0.5,
+        "p95": 5,
+        "timeouts": 2,
+        "consecutive_timeouts": 1,
+        "last_completed_at": 1717228801.02,
+        "histogram": {"0.1": 0, "0.25": 1, ..., "+Inf": 0}
+    }
+]
+"""
+@app.route('/api/devices/slow', methods=['GET'])
+def get_slow_devices():
+    threshold = request.args.get('p95', 2.5, type=float)
+    return jsonify(command_tracker.slow_devices(threshold))
+
+"""
+GET /api/devices/{device_id}/history?from=2025-01-01&to=2025-07-01&limit=500
+Events for one device, newest first; `from`/`to` are ISO dates or
+datetimes (`to` exclusive), both optional. `kinds` counts every event in
+the range, not only the returned ones.
+Response:
+{
+    "serial_number": "SN123456",
+    "events": [
+        {
+            "id": 981,
+            "timestamp": "2025-06-01T08:00:12",
+            "module": "module1",
+            "message": "module1: Pill taken",
+            "kind": "taken"
+        }
+    ],
+    "kinds": {"dispensed": 180, "taken": 171, "not_taken": 9}
+}
+"""
+@app.route('/api/devices/<device_id>/history', methods=['GET'])
+def get_device_history(device_id):
+    start, end = request.args.get('from'), request.args.get('to')
+    for value in (start, end):
+        if value and not event_segments.to_micros(value):
+            return jsonify({'error': f'Invalid date: {value}'}), 400
+    limit = max(1, min(request.args.get('limit', 500, type=int), 5000))
+
+    dispenser_id = reference_cache.dispenser_id(device_id)
+    if dispenser_id is None:
+        return jsonify({'error': 'Device not found'}), 404
+
+    events, kinds = event_segments.device_history(get_db().cursor(), dispenser_id, start, end, limit)
+    return jsonify({'serial_number': device_id, 'events': events, 'kinds': kinds})
+
 # Device status endpoint
 """
 GET /api/patients/{patient_id}/device
@@ -692,46 +1085,165 @@ Response:
             "threshold": 5,
             "pending": false
         }
-    ]
+    ],
+    "last_status": "module1: Pill taken",
+    "last_alert": null,
+    "last_seen": "2025-06-01T08:00:12",
+    "presence": {"online": true, "since": "2025-06-01T07:58:40", "last_seen": "2025-06-01T08:00:12"}
 }
 """
 @app.route('/api/patients/<int:patient_id>/device', methods=['GET'])
 def get_device_status(patient_id):
-    db = get_db()
-    c = db.cursor()
-    
-    # First get the pill_dispenser for this patient
-    c.execute('''
-        SELECT pd.id, pd.serial_number
-        FROM pill_dispenser pd
-        WHERE pd.patient_id = ?
-    ''', (patient_id,))
-    
-    device = c.fetchone()
-    if not device:
+    # Served from the in-memory device shadow, no DB round trip
+    shadow = device_shadow.get_shadow_for_patient(patient_id)
+    if shadow is None:
         return jsonify({'error': 'No device found for this patient'}), 404
-        
-    # Now get the modules for this dispenser
-    c.execute('''
-        SELECT module_name, pills_left, threshold, pending
-        FROM dispenser_module
-        WHERE pill_dispenser_id = ?
-    ''', (device['id'],))
-    
-    modules = [{
-        'name': row['module_name'],
-        'pills_left': row['pills_left'],
-        'threshold': row['threshold'],
-        'pending': bool(row['pending'])
-    } for row in c.fetchall()]
-    
-    device_status = {
-        'serial_number': device['serial_number'],
-        'modules': modules
-    }
-    
+
+    device_status = shadow.to_dict()
+    del device_status['patient_id']
+    device_status['presence'] = presence.get_presence(shadow.serial_number)
     return jsonify(device_status)
 
+"""
+GET /api/devices/summary
+Response:
+{
+    "device_count": 1,
+    "low_modules": 1,
+    "pending_modules": 0,
+    "devices": [
+        {
+            "serial_number": "SN123456",
+            "patient_id": 1,
+            "low_modules": ["module2"],
+            "pending_modules": [],
+            "last_status": "module1: Pill taken",
+            "last_seen": "2025-06-01T08:00:12"
+        }
+    ]
+}
+"""
+@app.route('/api/devices/summary', methods=['GET'])
+def get_fleet_summary():
+    return jsonify(device_shadow.fleet_summary())
+
+"""
+GET /api/devices/offline?minutes=10
+Devices offline for at least `minutes` (default 0), longest offline first.
+Response:
+{
+    "online": 980,
+    "offline": 20,
+    "devices": [
+        {
+            "serial_number": "SN123456",
+            "offline_since": "2025-06-01T06:12:00",
+            "offline_seconds": 6492,
+            "last_seen": "2025-06-01T06:09:31"
+        }
+    ]
+}
+"""
+@app.route('/api/devices/offline', methods=['GET'])
+def get_offline_devices():
+    minutes = request.args.get('minutes', 0, type=float)
+    return jsonify({**presence.presence_counts(),
+                    'devices': presence.offline_devices(minutes * 60)})
+
+"""
+GET /api/modules/low
+Every module at or below its threshold, fleet-wide. `low_since` is when
+the module last crossed the threshold.
+Response:
+[
+    {
+        "serial_number": "SN123456",
+        "patient_id": 1,
+        "module": "module2",
+        "pills_left": 3,
+        "threshold": 5,
+        "low_since": "2025-06-01T08:00:12"
+    }
+]
+"""
+@app.route('/api/modules/low', methods=['GET'])
+def get_low_modules():
+    return jsonify(low_stock.low_modules(get_db().cursor()))
+
+"""
+GET /api/reports/refill            latest refill plan as JSON
+GET /api/reports/refill?format=csv the CSV file itself
+Response:
+{
+    "report": "refill_plan_2025-06-01.csv",
+    "modules": [
+        {
+            "serial_number": "SN123456",
+            "patient_id": 1,
+            "patient_name": "John Doe",
+            "module": "module2",
+            "medicines": "Aspirin",
+            "pills_left": 4,
+            "threshold": 5,
+            "doses_per_day": 2.0,
+            "days_left": 2.0,
+            "refill_by": "2025-06-01",
+            "pills_needed": 56
+        }
+    ]
+}
+"""
+@app.route('/api/reports/refill', methods=['GET'])
+def get_refill_report():
+    path = refill_report.latest_report_path()
+    if path is None:
+        return jsonify({'error': 'No refill report generated yet'}), 404
+    if request.args.get('format') == 'csv':
+        with open(path, 'rb') as f:
+            response = app.response_class(f.read(), mimetype='text/csv')
+        response.headers['Content-Disposition'] = f'attachment; filename={os.path.basename(path)}'
+        return response
+    return jsonify({'report': os.path.basename(path), 'modules': refill_report.read_report(path)})
+
+"""
+GET /api/jobs
+Background maintenance jobs with their recent runs, newest first.
+Response:
+[
+    {
+        "name": "shadow-checkpoint",
+        "trigger": "every 30s",
+        "timeout": 30,
+        "next_run": "2025-06-01T08:00:30",
+        "running_since": null,
+        "history": [
+            {"started": "2025-06-01T08:00:00", "duration": 0.012, "outcome": "success", "error": null}
+        ]
+    }
+]
+"""
+@app.route('/api/jobs', methods=['GET'])
+def get_jobs():
+    return jsonify(SCHEDULER.jobs())
+
+"""
+POST /api/jobs/{name}/run
+Run a job now, outside its schedule. 409 if it is already running.
+Response:
+{
+    "status": "started",
+    "job": "refill-report"
+}
+"""
+@app.route('/api/jobs/<name>/run', methods=['POST'])
+def run_job(name):
+    started = SCHEDULER.run_now(name)
+    if started is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if not started:
+        return jsonify({'error': 'Job is already running'}), 409
+    return jsonify({'status': 'started', 'job': name}), 202
+
 """
 POST /api/patients/{patient_id}/assign_device
 Request format:
@@ -757,8 +1269,7 @@ def assign_device(patient_id):
     c = db.cursor()
     try:
         # Check if patient exists
-        c.execute('SELECT id FROM patient WHERE id = ?', (patient_id,))
-        if not c.fetchone():
+        if reference_cache.patient_doctor(patient_id) is None:
             return jsonify({'error': 'Patient not found'}), 404
 
         # ! currently only device is there, so no need to check already assigned
@@ -778,13 +1289,10 @@ def assign_device(patient_id):
         # dispenser_id = c.lastrowid
         
         # Get pill dispenser by serial number
-        c.execute('SELECT id FROM pill_dispenser WHERE serial_number = ?', (data['serial_number'],))
-        dispenser = c.fetchone()
-        if not dispenser:
+        dispenser_id = reference_cache.dispenser_id(data['serial_number'])
+        if dispenser_id is None:
             return jsonify({'error': 'Device not found'}), 404
 
-        dispenser_id = dispenser['id']
-
         # Assign patient_id to the dispenser
         c.execute('UPDATE pill_dispenser SET patient_id = ? WHERE id = ?', (patient_id, dispenser_id))
         if c.rowcount == 0:
@@ -800,6 +1308,9 @@ def assign_device(patient_id):
         # ''', (dispenser_id, dispenser_id))
 
         db.commit()
+        reference_cache.assign_dispenser(data['serial_number'], patient_id)
+        device_shadow.assign_patient(data['serial_number'], patient_id)
+        notification_digest.set_device_patient(data['serial_number'], patient_id)
         
         return jsonify({
             'status': 'success',
@@ -839,9 +1350,6 @@ Response:
 """
 @app.route('/api/schedules/<int:schedule_id>', methods=['PUT'])
 def update_schedule(schedule_id):
-    import traceback
-    import sys
-    
     data = request.get_json()
     if not data:
         return jsonify({'error': 'No data provided'}), 400
@@ -862,6 +1370,8 @@ def update_schedule(schedule_id):
         existing = c.fetchone()
         if not existing:
             return jsonify({'error': 'Schedule not found'}), 404
+        if 'time' in data and parse_time(data['time']) is None:
+            return jsonify({'error': f'Invalid time {data["time"]!r}, expected HH:MM'}), 400
 
         # If module is being changed, verify new module exists
         if 'module' in data:
@@ -879,6 +1389,10 @@ def update_schedule(schedule_id):
         else:
             module_id = existing['dispenser_module_id']
 
+        # Daily schedules have no days_of_week stored
+        existing_days = existing['days_of_week'].split(',') if existing['days_of_week'] else []
+        days = data.get('days', existing_days)
+
         # Update the schedule
         c.execute('''
             UPDATE schedule 
@@ -893,7 +1407,7 @@ def update_schedule(schedule_id):
             data.get('time', existing['time']),
             data.get('medicine_name', existing['medicine_name']),
             data.get('repeat_type', existing['repeat_type']),
-            ','.join(data.get('days', existing['days_of_week'].split(','))),
+            ','.join(days) if days else None,
             data.get('until_date', existing['until_date']),
             module_id,
             schedule_id
@@ -930,19 +1444,14 @@ def update_schedule(schedule_id):
                 'module': data.get('module', existing['module_name']),
                 'medicine_name': data.get('medicine_name', existing['medicine_name']),
                 'repeat_type': data.get('repeat_type', existing['repeat_type']),
-                'days': data.get('days', existing['days_of_week'].split(',')),
+                'days': days,
                 'until_date': data.get('until_date', existing['until_date'])
             }
         })
 
     except Exception as e:
         db.rollback()
-        print("error @update_schedule: ", e )
-        exc_type, exc_value, exc_traceback = sys.exc_info()
-        tb = traceback.extract_tb(exc_traceback)
-        for line in tb:
-            print(f'File "{line.filename}", line {line.lineno}, in {line.name}')
-        print(f'  {line.line}')
+        logger.exception("update schedule failed", extra={'fields': {'schedule_id': schedule_id}})
         return jsonify({'error': str(e)}), 500
 
 """
@@ -1009,5 +1518,77 @@ def delete_schedule(schedule_id):
         db.rollback()
         return jsonify({'error': str(e)}), 500
 
+"""
+POST /api/schedules/bulk
+Change every schedule matching the filter (any combination of
+medicine_name, module and doctor_id) in one transaction, then republish
+each affected device's schedule in the background. "delete": true instead
+of "changes" removes the matching schedules (e.g. a recalled medicine).
+Request format:
+{
+    "filter": {"medicine_name": "Aspirin", "doctor_id": 1},
+    "changes": {"time": "09:00", "days": ["mon", "thu"], "repeat_type": "custom"}
+}
+Response (202):
+{
+    "job_id": "5be1f0a2",
+    "state": "running",
+    "action": "update",
+    "schedules": 240,
+    "devices": 180,
+    "done": 0,
+    "published": 0,
+    "queued": 0,
+    "failed": 0,
+    ...
+}
+"""
+@app.route('/api/schedules/bulk', methods=['POST'])
+def bulk_change_schedules():
+    data = request.get_json()
+    if not data or not isinstance(data.get('filter'), dict):
+        return jsonify({'error': 'filter required'}), 400
+    delete = data.get('delete') is True
+    if not delete and not isinstance(data.get('changes'), dict):
+        return jsonify({'error': 'changes or "delete": true required'}), 400
+    changes = None if delete else data['changes']
+
+    try:
+        schedules, payloads = bulk_schedule.apply_bulk_change(get_db(), data['filter'], changes)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.exception("bulk schedule change failed", extra={'fields': {'filter': data['filter']}})
+        return jsonify({'error': str(e)}), 500
+
+    job = bulk_schedule.start_bulk_job(data['filter'], changes, schedules, payloads)
+    return jsonify(job.to_dict()), 202
+
+"""
+GET /api/schedules/bulk/{job_id}
+Progress of a bulk schedule change. `queued` devices were offline (or
+every publish slot was busy) and get the schedule from the command queue.
+`failed` devices could be neither sent nor queued after retries.
+Response:
+{
+    "job_id": "5be1f0a2",
+    "state": "completed",
+    "devices": 180,
+    "done": 180,
+    "published": 171,
+    "queued": 8,
+    "failed": 1,
+    "failures": [{"serial_number": "SN123456", "error": "database is locked"}],
+    "created_at": "2025-06-01T08:00:00",
+    "finished_at": "2025-06-01T08:00:04"
+}
+"""
+@app.route('/api/schedules/bulk/<job_id>', methods=['GET'])
+def get_bulk_schedule_job(job_id):
+    job = bulk_schedule.get_bulk_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
 
 # ! hardmode endpoint left
\ No newline at end of file
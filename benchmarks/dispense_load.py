@@ -0,0 +1,108 @@
+"""
+Concurrent dispense load test.
+
+Hammers POST /api/devices/{device}/dispense on a single module from many
+threads, retrying a share of the requests with the same Idempotency-Key,
+then checks that pills_left went down by exactly the number of distinct
+successful keys and never below zero.
+
+Run against a local server (python main.py) sharing the same database file:
+
+    python benchmarks/dispense_load.py --device device1 --module module1 \
+        --requests 500 --concurrency 32 --refill 200
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from config import DATABASE_FILE
+
+
+def post(url, body, headers=None):
+    req = urllib.request.Request(url, data=json.dumps(body).encode(), method='POST',
+                                 headers={'Content-Type': 'application/json', **(headers or {})})
+    try:
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            return resp.status, json.loads(resp.read()), resp.headers
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read() or b'{}'), e.headers
+
+
+def pills_left(db_file, device, module):
+    conn = sqlite3.connect(db_file)
+    row = conn.execute('''
+        SELECT dm.pills_left
+        FROM dispenser_module dm
+        JOIN pill_dispenser pd ON dm.pill_dispenser_id = pd.id
+        WHERE pd.serial_number = ? AND dm.module_name = ?
+    ''', (device, module)).fetchone()
+    conn.close()
+    return row[0] if row else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:4000')
+    parser.add_argument('--db', default=DATABASE_FILE)
+    parser.add_argument('--device', default='device1')
+    parser.add_argument('--module', default='module1')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--retry-ratio', type=float, default=0.3,
+                        help='share of requests sent twice with the same key')
+    parser.add_argument('--refill', type=int, default=None,
+                        help='refill the module to this count before starting')
+    args = parser.parse_args()
+
+    base = f"{args.url}/api/devices/{args.device}"
+    if args.refill is not None:
+        post(f"{base}/refill", {'module_name': args.module, 'count': args.refill})
+
+    before = pills_left(args.db, args.device, args.module)
+    if before is None:
+        sys.exit(f"Module {args.module} of {args.device} not found in {args.db}")
+
+    keys = [str(uuid.uuid4()) for _ in range(args.requests)]
+    retries = keys[:int(len(keys) * args.retry_ratio)]
+    work = keys + retries
+
+    def dispense(key):
+        started = time.perf_counter()
+        status, body, headers = post(f"{base}/dispense", {'module_name': args.module},
+                                     {'Idempotency-Key': key})
+        return key, status, body, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(dispense, work))
+    elapsed = time.perf_counter() - started
+
+    succeeded = {key for key, status, _, _ in results if status == 200}
+    statuses = {}
+    for _, status, _, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    latencies = sorted(latency for _, _, _, latency in results)
+    after = pills_left(args.db, args.device, args.module)
+
+    print(f"requests: {len(work)} ({len(retries)} retried keys) in {elapsed:.2f}s "
+          f"-> {len(work) / elapsed:.0f} req/s")
+    print(f"status codes: {statuses}")
+    print(f"latency p50={latencies[len(latencies) // 2] * 1000:.1f}ms "
+          f"p99={latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f}ms")
+    print(f"pills_left: {before} -> {after}, distinct successful keys: {len(succeeded)}")
+
+    ok = after >= 0 and before - after == len(succeeded)
+    print("OK: no double or negative dispense" if ok else "FAIL: pill count does not match successful dispenses")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""
+Synthetic fleet generator.
+
+Fills a database created by database.init_db with doctors, patients, one
+dispenser per patient, modules, schedules and log rows at a configurable
+scale. Generation is deterministic for a given --seed.
+
+    python benchmarks/generate_fleet.py --db bench.db --patients 10000 \
+        --modules-per-device 2 --logs 50000000
+
+Serial numbers are "SN00000001", "SN00000002", ... (one per patient);
+doctor emails are "doctor{n}@bench.local".
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import database
+
+FIRST_NAMES = ['John', 'Mary', 'Ahmed', 'Priya', 'Chen', 'Olga', 'Luis', 'Fatima', 'Kenji', 'Amara']
+LAST_NAMES = ['Smith', 'Garcia', 'Khan', 'Patel', 'Wang', 'Ivanova', 'Silva', 'Okafor', 'Sato', 'Cohen']
+CONDITIONS = ['Diabetes patient', 'Hypertension', 'Post-surgery recovery', 'Asthma',
+              'Heart failure', 'Chronic pain', 'Parkinson', None]
+MEDICINES = ['Aspirin', 'Metformin', 'Lisinopril', 'Atorvastatin', 'Levothyroxine',
+             'Amlodipine', 'Omeprazole', 'Losartan', 'Gabapentin', 'Salbutamol']
+DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+LOG_MESSAGES = ['{m}: Pill dispensed', '{m}: Pill taken', '{m}: Pill NOT taken',
+                '{m}: Pills low', 'Dispense command sent', 'Refilled with 30 pills']
+
+
+def serial_number(n):
+    return f"SN{n:08d}"
+
+
+def chunks(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def insert_many(conn, sql, rows, batch_size):
+    count = 0
+    for batch in chunks(rows, batch_size):
+        conn.executemany(sql, batch)
+        conn.commit()
+        count += len(batch)
+    return count
+
+
+def generate(args):
+    rnd = random.Random(args.seed)
+    database.DATABASE_FILE = args.db
+    database.init_db()
+
+    conn = sqlite3.connect(args.db)
+    conn.execute('PRAGMA synchronous=OFF')
+
+    started = time.perf_counter()
+
+    def step(label, count):
+        print(f"{label:>10}: {count:>12,} rows  ({time.perf_counter() - started:7.1f}s)")
+
+    step('doctors', insert_many(conn, 'INSERT INTO doctor (name, email) VALUES (?, ?)', (
+        (f"Dr. {rnd.choice(LAST_NAMES)} {n}", f"doctor{n}@bench.local")
+        for n in range(1, args.doctors + 1)), args.batch))
+
+    step('patients', insert_many(conn, 'INSERT INTO patient (name, age, doctor_id, notes) VALUES (?, ?, ?, ?)', (
+        (f"{rnd.choice(FIRST_NAMES)} {rnd.choice(LAST_NAMES)} {n}", rnd.randint(18, 95),
+         rnd.randint(1, args.doctors), rnd.choice(CONDITIONS))
+        for n in range(1, args.patients + 1)), args.batch))
+
+    # Patients, dispensers and modules are inserted into empty tables, so
+    # their ids are predictable: dispenser n belongs to patient n and owns
+    # modules (n-1)*M+1 .. n*M.
+    step('devices', insert_many(conn, 'INSERT INTO pill_dispenser (patient_id, serial_number) VALUES (?, ?)', (
+        (n, serial_number(n)) for n in range(1, args.patients + 1)), args.batch))
+
+    modules_per_device = args.modules_per_device
+    step('modules', insert_many(conn, '''
+        INSERT INTO dispenser_module (pill_dispenser_id, module_name, pills_left, threshold, pending)
+        VALUES (?, ?, ?, ?, ?)''', (
+        (n, f"module{m}", rnd.randint(0, 60), 5, int(rnd.random() < 0.05))
+        for n in range(1, args.patients + 1) for m in range(1, modules_per_device + 1)), args.batch))
+
+    def schedules():
+        for n in range(1, args.patients + 1):
+            for m in range(1, modules_per_device + 1):
+                module_id = (n - 1) * modules_per_device + m
+                for _ in range(args.schedules_per_module):
+                    custom = rnd.random() < 0.3
+                    yield (n, module_id, rnd.choice(MEDICINES),
+                           f"{rnd.randint(6, 22):02d}:{rnd.choice(['00', '15', '30', '45'])}",
+                           'custom' if custom else 'daily',
+                           ','.join(sorted(rnd.sample(DAYS, 3), key=DAYS.index)) if custom else None,
+                           None)
+
+    step('schedules', insert_many(conn, '''
+        INSERT INTO schedule (patient_id, dispenser_module_id, medicine_name, time,
+                              repeat_type, days_of_week, until_date)
+        VALUES (?, ?, ?, ?, ?, ?, ?)''', schedules(), args.batch))
+
+    module_count = args.patients * modules_per_device
+    start = datetime.now() - timedelta(days=args.log_days)
+    step_seconds = args.log_days * 86400 / max(args.logs, 1)
+
+    def logs():
+        for i in range(args.logs):
+            module_id = rnd.randint(1, module_count)
+            message = rnd.choice(LOG_MESSAGES).format(m=f"module{(module_id - 1) % modules_per_device + 1}")
+            yield ((start + timedelta(seconds=i * step_seconds)).isoformat(), module_id, message)
+
+    step('logs', insert_many(conn, 'INSERT INTO logs (timestamp, dispenser_module_id, message) VALUES (?, ?, ?)',
+                             logs(), args.batch))
+
+    conn.execute('ANALYZE')
+    conn.close()
+    print(f"Done: {args.db}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default='bench.db')
+    parser.add_argument('--doctors', type=int, default=200)
+    parser.add_argument('--patients', type=int, default=10000)
+    parser.add_argument('--modules-per-device', type=int, default=2)
+    parser.add_argument('--schedules-per-module', type=int, default=2)
+    parser.add_argument('--logs', type=int, default=1000000)
+    parser.add_argument('--log-days', type=int, default=365)
+    parser.add_argument('--batch', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    if os.path.exists(args.db):
+        sys.exit(f"{args.db} already exists; remove it or pick another --db")
+    generate(args)
+
+
+if __name__ == '__main__':
+    main()
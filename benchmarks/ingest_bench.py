@@ -0,0 +1,248 @@
+"""
+MQTT ingest throughput benchmark.
+
+Replays synthetic device traffic (status, alerts, schedule/status and
+settings/status across N devices) through mqtt_handler.on_message plus
+log_event and measures sustained msgs/sec, end-to-end persistence lag
+(publish -> row committed) and memory.
+
+Two transports:
+
+    direct  (default) a fake client: a producer thread enqueues messages at
+            --rate msgs/sec (0 = as fast as possible) and a single consumer
+            thread, like paho's loop thread, calls on_message
+    broker  messages are published to a local MQTT broker (e.g. mosquitto
+            on localhost:1883) and received by start_mqtt_listener(), or
+            with --shards N by N ingest_shards.py processes
+
+    python benchmarks/generate_fleet.py --db bench.db --logs 0
+    python benchmarks/ingest_bench.py --db bench.db --devices 1000 --messages 50000
+"""
+import argparse
+import json
+import os
+import queue
+import random
+import resource
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+BASELINE_FILE = os.path.join(RESULTS_DIR, 'baseline_ingest.json')
+
+# (topic suffix, weight, message templates)
+TRAFFIC_MIX = [
+    ('status', 60, ['{m}: Pill dispensed', '{m}: Pill taken', '{m}: Pill NOT taken']),
+    ('alerts', 10, ['{m}: Pills low', '{m} is empty']),
+    ('schedule/status', 15, ['Schedule updated', 'Schedule triggered for {m}']),
+    ('settings/status', 15, ['Settings applied', 'hard_mode: true']),
+]
+
+
+class FakeMessage:
+    __slots__ = ('topic', 'payload', 'published_at')
+
+    def __init__(self, topic, payload, published_at):
+        self.topic = topic
+        self.payload = payload
+        self.published_at = published_at
+
+
+def traffic(devices, count, seed):
+    rnd = random.Random(seed)
+    kinds = [k for k in TRAFFIC_MIX for _ in range(k[1])]
+    for _ in range(count):
+        suffix, _, templates = rnd.choice(kinds)
+        module = f"module{rnd.randint(1, 2)}"
+        yield f"pill/{rnd.choice(devices)}/{suffix}", rnd.choice(templates).format(m=module).encode()
+
+
+def load_devices(db_file, limit):
+    conn = sqlite3.connect(db_file)
+    devices = [r[0] for r in conn.execute('SELECT serial_number FROM pill_dispenser LIMIT ?', (limit,))]
+    conn.close()
+    return devices
+
+
+def log_count(db_file):
+    conn = sqlite3.connect(db_file)
+    count = conn.execute('SELECT COUNT(*) FROM logs').fetchone()[0]
+    conn.close()
+    return count
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values))) - 1))]
+
+
+def run_direct(mqtt_handler, messages, rate):
+    inbox = queue.Queue()
+    lags = []
+
+    def consumer():
+        while True:
+            msg = inbox.get()
+            if msg is None:
+                return
+            mqtt_handler.on_message(None, None, msg)
+            lags.append(time.perf_counter() - msg.published_at)
+
+    worker = threading.Thread(target=consumer)
+    worker.start()
+    started = time.perf_counter()
+    interval = 1.0 / rate if rate else 0
+    for i, (topic, payload) in enumerate(messages):
+        if interval:
+            delay = started + i * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        inbox.put(FakeMessage(topic, payload, time.perf_counter()))
+    inbox.put(None)
+    worker.join()
+    return time.perf_counter() - started, lags
+
+
+def start_shards(count, db_file):
+    env = dict(os.environ, PILL_DATABASE_FILE=db_file, PILL_LOG_LEVEL='WARNING')
+    return [subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, 'ingest_shards.py'), '--node', f"bench{n}"],
+                             cwd=ROOT_DIR, env=env, stdout=subprocess.DEVNULL)
+            for n in range(1, count + 1)]
+
+
+def stop_shards(shards):
+    for shard in shards:
+        shard.send_signal(signal.SIGINT)  # graceful leave
+    for shard in shards:
+        shard.wait()
+
+
+def run_broker(mqtt_handler, messages, rate, db_file, host, port, shards=0):
+    import paho.mqtt.client as mqtt
+
+    before = log_count(db_file)
+    if shards:
+        processes = start_shards(shards, db_file)
+        time.sleep(3)  # let the shards start and see each other
+    else:
+        processes = []
+        mqtt_handler.start_mqtt_listener()
+        time.sleep(1)  # let the listener subscribe
+
+    publisher = mqtt.Client()
+    publisher.connect(host, port, 60)
+    publisher.loop_start()
+
+    sent = 0
+    started = time.perf_counter()
+    interval = 1.0 / rate if rate else 0
+    for i, (topic, payload) in enumerate(messages):
+        if interval:
+            delay = started + i * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        publisher.publish(topic, payload, qos=1).wait_for_publish()
+        sent += 1
+    publish_done = time.perf_counter()
+
+    # Persistence lag: how long after the last publish the last row lands
+    while log_count(db_file) - before < sent:
+        time.sleep(0.05)
+    finished = time.perf_counter()
+    publisher.loop_stop()
+    stop_shards(processes)
+    return finished - started, [finished - publish_done]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=None, help='fleet database to copy (default: empty schema)')
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--rate', type=float, default=0, help='target msgs/sec, 0 = unthrottled')
+    parser.add_argument('--transport', choices=['direct', 'broker'], default='direct')
+    parser.add_argument('--broker', default='localhost:1883')
+    parser.add_argument('--shards', type=int, default=0, help='broker transport: ingest shard processes')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    # Work on a scratch copy so the benchmark never grows the real database
+    workdir = tempfile.mkdtemp(prefix='ingest_bench_')
+    db_file = os.path.join(workdir, 'ingest.db')
+    if args.db:
+        shutil.copy(args.db, db_file)
+    os.environ['PILL_DATABASE_FILE'] = db_file
+    # The synthetic traffic repeats identical untimed messages, which the
+    # redelivery filter would drop; every message must reach the database
+    os.environ['PILL_DEDUP'] = '0'
+
+    sys.path.insert(0, ROOT_DIR)
+    import database
+    import mqtt_handler
+    from logging_setup import setup_logging
+    database.init_db()
+    # Include the real logging pipeline in the measurement, minus the terminal
+    setup_logging(stream=open(os.devnull, 'w'))
+
+    devices = load_devices(db_file, args.devices) or [f"device{n}" for n in range(1, args.devices + 1)]
+    messages = list(traffic(devices, args.messages, args.seed))
+
+    tracemalloc.start()
+    if args.transport == 'direct':
+        elapsed, lags = run_direct(mqtt_handler, messages, args.rate)
+    else:
+        host, _, port = args.broker.partition(':')
+        elapsed, lags = run_broker(mqtt_handler, messages, args.rate, db_file, host, int(port or 1883),
+                                   args.shards)
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    lags.sort()
+    result = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'transport': args.transport,
+        'shards': args.shards,
+        'devices': len(devices),
+        'messages': len(messages),
+        'target_rate': args.rate,
+        'msgs_per_sec': len(messages) / elapsed,
+        'lag_p50_ms': percentile(lags, 0.50) * 1000,
+        'lag_p99_ms': percentile(lags, 0.99) * 1000,
+        'lag_max_ms': lags[-1] * 1000,
+        'peak_traced_mb': peak_traced / 1e6,
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+    for key, value in result.items():
+        print(f"{key:>16}: {value:.2f}" if isinstance(value, float) else f"{key:>16}: {value}")
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    with open(os.path.join(RESULTS_DIR, f"ingest_{time.strftime('%Y%m%d_%H%M%S')}.json"), 'w') as f:
+        json.dump(result, f, indent=2)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.save_baseline:
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"Baseline saved to {BASELINE_FILE}")
+    elif os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f)
+        if result['msgs_per_sec'] < baseline['msgs_per_sec'] * (1 - args.tolerance):
+            print(f"Regression: {baseline['msgs_per_sec']:.0f} -> {result['msgs_per_sec']:.0f} msgs/sec")
+            sys.exit(1)
+        print(f"No regression against baseline ({baseline['msgs_per_sec']:.0f} msgs/sec)")
+
+
+if __name__ == '__main__':
+    main()
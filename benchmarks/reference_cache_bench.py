@@ -0,0 +1,94 @@
+"""
+Reference cache memory and lookup benchmark.
+
+Loads reference_cache.py from a fleet database and reports the memory it
+holds (tracemalloc, so Python allocations only) and the cost of the
+lookups the API makes, next to the SQL queries they replace.
+
+    python benchmarks/generate_fleet.py --db bench.db --patients 100000 --logs 0
+    python benchmarks/reference_cache_bench.py --db bench.db
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+sys.path.insert(0, ROOT_DIR)
+
+
+def per_call(func, args, repeat):
+    started = time.perf_counter()
+    for i in range(repeat):
+        func(*args[i % len(args)])
+    return (time.perf_counter() - started) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default='bench.db')
+    parser.add_argument('--lookups', type=int, default=100000)
+    args = parser.parse_args()
+
+    os.environ['PILL_DATABASE_FILE'] = args.db
+    import reference_cache
+    from database import connect
+
+    conn = connect()
+    counts = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+              for table in ('doctor', 'patient', 'pill_dispenser', 'dispenser_module')}
+    sample = conn.execute('''
+        SELECT pd.serial_number, dm.module_name
+        FROM dispenser_module dm JOIN pill_dispenser pd ON dm.pill_dispenser_id = pd.id
+    ''').fetchall()
+    random.seed(42)
+    sample = random.sample(sample, min(len(sample), 1000))
+    doctors = [(row[0],) for row in conn.execute('SELECT id FROM doctor')]
+
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    reference_cache.load_reference_data()
+    load_seconds = time.perf_counter() - started
+    gc.collect()
+    cache_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    def sql_module_id(serial_number, module_name):
+        return conn.execute('''
+            SELECT dm.id
+            FROM dispenser_module dm
+            JOIN pill_dispenser pd ON dm.pill_dispenser_id = pd.id
+            WHERE pd.serial_number = ? AND dm.module_name = ?
+        ''', (serial_number, module_name)).fetchone()
+
+    def sql_doctor_exists(doctor_id):
+        return conn.execute('SELECT id FROM doctor WHERE id = ?', (doctor_id,)).fetchone()
+
+    result = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        **counts,
+        'load_seconds': load_seconds,
+        'cache_mb': cache_bytes / 1e6,
+        'bytes_per_patient': cache_bytes / max(counts['patient'], 1),
+        'module_id_us': per_call(reference_cache.module_id, sample, args.lookups),
+        'module_id_sql_us': per_call(sql_module_id, sample, args.lookups),
+        'doctor_exists_us': per_call(reference_cache.doctor_exists, doctors, args.lookups),
+        'doctor_exists_sql_us': per_call(sql_doctor_exists, doctors, args.lookups),
+    }
+    conn.close()
+    for key, value in result.items():
+        print(f"{key:>22}: {value:.2f}" if isinstance(value, float) else f"{key:>22}: {value}")
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    with open(os.path.join(RESULTS_DIR, f"reference_cache_{time.strftime('%Y%m%d_%H%M%S')}.json"), 'w') as f:
+        json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
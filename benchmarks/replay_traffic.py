@@ -0,0 +1,152 @@
+"""
+Replay a recorded MQTT traffic file through the ingest path.
+
+Record production traffic by starting the server with
+PILL_TRAFFIC_RECORD=traffic.rec, then replay it at the original pace
+(--speed 1), N times faster (--speed N) or as fast as possible
+(--speed 0), and report msgs/sec and processing lag:
+
+    direct  (default) into mqtt_handler.on_message on a single consumer
+            thread, against a scratch copy of --db
+    broker  published to a local MQTT broker (e.g. mosquitto on
+            localhost:1883) for whatever server is listening there
+
+    python benchmarks/replay_traffic.py traffic.rec --db pill_data.db --speed 10
+    python benchmarks/replay_traffic.py traffic.rec --transport broker --speed 1
+"""
+import argparse
+import json
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+sys.path.insert(0, ROOT_DIR)
+
+from traffic_recorder import read_recording  # noqa: E402
+
+
+class FakeMessage:
+    __slots__ = ('topic', 'payload', 'published_at')
+
+    def __init__(self, topic, payload, published_at):
+        self.topic = topic
+        self.payload = payload
+        self.published_at = published_at
+
+
+def paced(recording, speed):
+    """Yield (topic, payload) at the recorded pace divided by `speed` (0 = no pacing)"""
+    started = time.perf_counter()
+    first = None
+    for timestamp, topic, payload in recording:
+        if speed:
+            first = timestamp if first is None else first
+            delay = started + (timestamp - first) / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        yield topic, payload
+
+
+def replay_direct(recording, speed):
+    import mqtt_handler
+
+    inbox = queue.Queue()
+    lags = []
+
+    def consumer():
+        while True:
+            msg = inbox.get()
+            if msg is None:
+                return
+            mqtt_handler.on_message(None, None, msg)
+            lags.append(time.perf_counter() - msg.published_at)
+
+    worker = threading.Thread(target=consumer)
+    worker.start()
+    started = time.perf_counter()
+    for topic, payload in paced(recording, speed):
+        inbox.put(FakeMessage(topic, payload, time.perf_counter()))
+    inbox.put(None)
+    worker.join()
+    return time.perf_counter() - started, lags
+
+
+def replay_broker(recording, speed, host, port, qos):
+    import paho.mqtt.client as mqtt
+
+    publisher = mqtt.Client()
+    publisher.connect(host, port, 60)
+    publisher.loop_start()
+    started = time.perf_counter()
+    pending = [publisher.publish(topic, payload, qos=qos) for topic, payload in paced(recording, speed)]
+    for info in pending:
+        info.wait_for_publish()
+    elapsed = time.perf_counter() - started
+    publisher.loop_stop()
+    publisher.disconnect()
+    return elapsed, []
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('recording')
+    parser.add_argument('--speed', type=float, default=1.0, help='pace multiplier, 0 = as fast as possible')
+    parser.add_argument('--transport', choices=['direct', 'broker'], default='direct')
+    parser.add_argument('--db', default=None, help='direct: database to copy (default: empty schema)')
+    parser.add_argument('--broker', default='localhost:1883')
+    parser.add_argument('--qos', type=int, choices=[0, 1, 2], default=1)
+    args = parser.parse_args()
+
+    recording = list(read_recording(args.recording))
+    if not recording:
+        sys.exit(f"{args.recording} has no messages")
+    span = recording[-1][0] - recording[0][0]
+
+    if args.transport == 'direct':
+        # Scratch copy so a replay never writes into the real database
+        workdir = tempfile.mkdtemp(prefix='replay_')
+        db_file = os.path.join(workdir, 'replay.db')
+        if args.db:
+            shutil.copy(args.db, db_file)
+        os.environ['PILL_DATABASE_FILE'] = db_file
+        import database
+        from logging_setup import setup_logging
+        database.init_db()
+        setup_logging(stream=open(os.devnull, 'w'))
+        elapsed, lags = replay_direct(recording, args.speed)
+        shutil.rmtree(workdir, ignore_errors=True)
+    else:
+        host, _, port = args.broker.partition(':')
+        elapsed, lags = replay_broker(recording, args.speed, host, int(port or 1883), args.qos)
+
+    lags.sort()
+    result = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'recording': os.path.basename(args.recording),
+        'transport': args.transport,
+        'speed': args.speed,
+        'messages': len(recording),
+        'recorded_seconds': span,
+        'replay_seconds': elapsed,
+        'msgs_per_sec': len(recording) / elapsed if elapsed else 0.0,
+    }
+    if lags:
+        result['lag_p50_ms'] = lags[len(lags) // 2] * 1000
+        result['lag_p99_ms'] = lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000
+        result['lag_max_ms'] = lags[-1] * 1000
+    for key, value in result.items():
+        print(f"{key:>16}: {value:.2f}" if isinstance(value, float) else f"{key:>16}: {value}")
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    with open(os.path.join(RESULTS_DIR, f"replay_{time.strftime('%Y%m%d_%H%M%S')}.json"), 'w') as f:
+        json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+"""
+REST load-test benchmark suite.
+
+Drives every endpoint of api_server.py with concurrent clients against a
+local server and reports p50/p95/p99 latency, throughput and errors per
+endpoint. Results are written to benchmarks/results/; pass
+--save-baseline to make a run the baseline that later runs are compared
+against (a regression is flagged when p95 grows or throughput drops by
+more than --tolerance).
+
+    python benchmarks/generate_fleet.py --db bench.db
+    PILL_DATABASE_FILE=bench.db python main.py        # in another shell
+    python benchmarks/rest_bench.py --db bench.db --requests 500 --concurrency 16
+
+Write endpoints that publish MQTT commands need a reachable broker, like
+the server itself; use --skip-writes to benchmark the read side only.
+Command endpoints are rate limited per device and per client address
+(RATE_LIMIT_DEVICE / RATE_LIMIT_CLIENT in config.py), so 429 responses
+on dispense/refill/reset_pending at high rates are expected.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+BASELINE_FILE = os.path.join(RESULTS_DIR, 'baseline.json')
+
+
+class Fleet:
+    """Ids sampled from the benchmark database"""
+
+    def __init__(self, db_file, seed):
+        conn = sqlite3.connect(db_file)
+        self.doctor_ids = [r[0] for r in conn.execute('SELECT id FROM doctor')]
+        self.doctor_emails = [r[0] for r in conn.execute('SELECT email FROM doctor LIMIT 1000')]
+        self.patient_ids = [r[0] for r in conn.execute(
+            'SELECT patient_id FROM pill_dispenser WHERE patient_id IS NOT NULL')]
+        self.modules = conn.execute('''
+            SELECT pd.serial_number, dm.module_name, pd.patient_id
+            FROM dispenser_module dm
+            JOIN pill_dispenser pd ON dm.pill_dispenser_id = pd.id
+        ''').fetchall()
+        self.schedule_ids = [r[0] for r in conn.execute('SELECT id FROM schedule LIMIT 100000')]
+        conn.close()
+        if not (self.doctor_ids and self.patient_ids and self.modules):
+            sys.exit(f"{db_file} has no fleet; run benchmarks/generate_fleet.py first")
+        self.rnd = random.Random(seed)
+        self.created_schedules = []
+        self.command_ids = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def new_request(self):
+        # path() and body() of one request must agree on their target, so
+        # targets are picked once per request and per thread
+        self.local.picks = {}
+
+    def _pick(self, key, factory):
+        picks = self.local.picks
+        if key not in picks:
+            picks[key] = factory()
+        return picks[key]
+
+    def command_target(self):
+        """(serial_number, module_name)"""
+        return self._pick('command', lambda: tuple(self.module()[:2]))
+
+    def schedule_target(self):
+        """(patient_id, module_name)"""
+        return self._pick('schedule', lambda: (lambda m: (m[2], m[1]))(self.module()))
+
+    def device_target(self):
+        """(serial_number, patient_id)"""
+        return self._pick('device', lambda: (lambda m: (m[0], m[2]))(self.module()))
+
+    def created_schedule(self):
+        with self.lock:
+            if self.created_schedules:
+                return self.created_schedules.pop()
+        return 0  # nothing created yet: measures the 404 path
+
+    def doctor(self):
+        return self.rnd.choice(self.doctor_ids)
+
+    def patient(self):
+        return self.rnd.choice(self.patient_ids)
+
+    def module(self):
+        return self.rnd.choice(self.modules)
+
+
+# name -> (method, path(fleet), body(fleet) or None, is_write)
+ENDPOINTS = {
+    'list_doctors': ('GET', lambda f: '/api/doctors', None, False),
+    'get_doctor': ('GET', lambda f: f'/api/doctors/{f.doctor()}', None, False),
+    'search_doctor_by_email': ('POST', lambda f: '/api/doctors/search_by_email',
+                               lambda f: {'email': f.rnd.choice(f.doctor_emails)}, False),
+    'doctor_patients': ('GET', lambda f: f'/api/doctors/{f.doctor()}/patients', None, False),
+    'doctor_dashboard': ('GET', lambda f: f'/api/doctors/{f.doctor()}/dashboard', None, False),
+    'list_patients': ('GET', lambda f: '/api/patients', None, False),
+    'search': ('GET', lambda f: f'/api/search?q={f.rnd.choice(["jo", "diab", "aspir", "smith", "met"])}',
+               None, False),
+    'get_patient': ('GET', lambda f: f'/api/patients/{f.patient()}', None, False),
+    'get_patient_schedule': ('GET', lambda f: f'/api/patients/{f.patient()}/schedule', None, False),
+    'get_device_status': ('GET', lambda f: f'/api/patients/{f.patient()}/device', None, False),
+    'device_history': ('GET', lambda f: f'/api/devices/{f.module()[0]}/history?limit=100', None, False),
+    'fleet_summary': ('GET', lambda f: '/api/devices/summary', None, False),
+    'low_modules': ('GET', lambda f: '/api/modules/low', None, False),
+    'refill_report': ('GET', lambda f: '/api/reports/refill', None, False),
+    'offline_devices': ('GET', lambda f: '/api/devices/offline?minutes=10', None, False),
+    'slow_devices': ('GET', lambda f: '/api/devices/slow', None, False),
+    'get_command': ('GET', lambda f: f'/api/commands/{f.rnd.choice(f.command_ids or ["00000000"])}',
+                    None, False),
+    'metrics': ('GET', lambda f: '/metrics', None, False),
+    'create_doctor': ('POST', lambda f: '/api/doctors/create',
+                      lambda f: {'name': 'Dr. Bench', 'email': f'{uuid.uuid4().hex}@bench.local'}, True),
+    'create_patient': ('POST', lambda f: '/api/patients/create',
+                       lambda f: {'name': 'Bench Patient', 'age': 50, 'doctor_id': f.doctor()}, True),
+    'assign_doctor': ('POST', lambda f: f'/api/patients/{f.patient()}/assign_doctor',
+                      lambda f: {'doctor_id': f.doctor()}, True),
+    'create_schedule': ('POST', lambda f: f'/api/patients/{f.schedule_target()[0]}/schedule',
+                        lambda f: [{'time': '08:00', 'module': f.schedule_target()[1],
+                                    'medicine_name': 'Aspirin', 'days': ['mon', 'wed']}], True),
+    'update_schedule': ('PUT', lambda f: f'/api/schedules/{f.rnd.choice(f.schedule_ids)}',
+                        lambda f: {'time': f'{f.rnd.randint(6, 22):02d}:00'}, True),
+    'delete_schedule': ('DELETE', lambda f: f'/api/schedules/{f.created_schedule()}', None, True),
+    'dispense': ('POST', lambda f: f'/api/devices/{f.command_target()[0]}/dispense',
+                 lambda f: {'module_name': f.command_target()[1]}, True),
+    'refill': ('POST', lambda f: f'/api/devices/{f.command_target()[0]}/refill',
+               lambda f: {'module_name': f.command_target()[1], 'count': 30}, True),
+    'reset_pending': ('POST', lambda f: f'/api/devices/{f.command_target()[0]}/reset_pending',
+                      lambda f: {'module_name': f.command_target()[1]}, True),
+    'assign_device': ('POST', lambda f: f'/api/patients/{f.device_target()[1]}/assign_device',
+                      lambda f: {'serial_number': f.device_target()[0]}, True),
+}
+
+
+def request(base_url, method, path, body):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(base_url + path, data=data, method=method,
+                                 headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(req, timeout=60) as resp:
+            return resp.status, resp.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+    except OSError:
+        return 0, b''
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def run_endpoint(base_url, fleet, name, requests, concurrency):
+    method, path_fn, body_fn, _ = ENDPOINTS[name]
+
+    def one(_):
+        fleet.new_request()
+        path = path_fn(fleet)
+        body = body_fn(fleet) if body_fn else None
+        started = time.perf_counter()
+        status, payload = request(base_url, method, path, body)
+        elapsed = time.perf_counter() - started
+        if status in (200, 201) and name in ('create_schedule', 'dispense', 'refill', 'reset_pending'):
+            remember_ids(fleet, name, payload)
+        return status, elapsed
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - started
+
+    latencies = sorted(elapsed for _, elapsed in results)
+    statuses = {}
+    for status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    errors = sum(n for status, n in statuses.items() if status == '0' or int(status) >= 500)
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'throughput_rps': requests / wall,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'errors': errors,
+        'status_codes': statuses
+    }
+
+
+def remember_ids(fleet, name, payload):
+    try:
+        body = json.loads(payload)
+    except ValueError:
+        return
+    with fleet.lock:
+        if name == 'create_schedule':
+            fleet.created_schedules.extend(s['id'] for s in body.get('schedules', []))
+        elif body.get('command_id'):
+            fleet.command_ids.append(body['command_id'])
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get('endpoints', {}).get(name)
+        if not base:
+            continue
+        if result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {base['p95_ms']:.1f}ms -> {result['p95_ms']:.1f}ms")
+        if result['throughput_rps'] < base['throughput_rps'] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {base['throughput_rps']:.0f} -> "
+                               f"{result['throughput_rps']:.0f} req/s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:4000')
+    parser.add_argument('--db', default='bench.db', help='database the server is running on')
+    parser.add_argument('--requests', type=int, default=500, help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--only', nargs='*', help='endpoint names to run (default: all)')
+    parser.add_argument('--skip-writes', action='store_true')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    fleet = Fleet(args.db, args.seed)
+    names = args.only or list(ENDPOINTS)
+    if args.skip_writes:
+        names = [n for n in names if not ENDPOINTS[n][3]]
+    # Run writes that produce ids (schedules, commands) before their readers/deleters
+    order = ['create_schedule', 'dispense', 'refill', 'reset_pending']
+    names.sort(key=lambda n: order.index(n) if n in order else len(order))
+
+    results = {}
+    print(f"{'endpoint':<24}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}")
+    for name in names:
+        result = run_endpoint(args.url, fleet, name, args.requests, args.concurrency)
+        results[name] = result
+        print(f"{name:<24}{result['throughput_rps']:>9.0f}{result['p50_ms']:>9.1f}"
+              f"{result['p95_ms']:>9.1f}{result['p99_ms']:>9.1f}{result['errors']:>8}")
+
+    run = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'db': os.path.basename(args.db),
+        'patients': len(fleet.patient_ids),
+        'modules': len(fleet.modules),
+        'endpoints': results
+    }
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    out_file = os.path.join(RESULTS_DIR, f"rest_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(out_file, 'w') as f:
+        json.dump(run, f, indent=2)
+    print(f"Results written to {out_file}")
+
+    if args.save_baseline:
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump(run, f, indent=2)
+        print(f"Baseline saved to {BASELINE_FILE}")
+    elif os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressions against baseline:")
+            for line in regressions:
+                print(f" - {line}")
+            sys.exit(1)
+        print("No regressions against baseline")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from config import BULK_PUBLISH_WORKERS, BULK_JOB_HISTORY, BULK_PUBLISH_RETRIES
+from mqtt_publisher import publish_schedule
+from utils import transform_schedule_for_mqtt, parse_time, valid_days
+
+logger = logging.getLogger(__name__)
+
+# Fleet-wide schedule edits (medicine recalls, timing changes). The
+# selected schedules are updated or deleted in one transaction, each
+# affected device's full schedule is rebuilt once from a single query, and
+# the payloads are published concurrently in the background. Progress is
+# tracked in memory per job (GET /api/schedules/bulk/<job_id>).
+
+FILTERS = ('medicine_name', 'module', 'doctor_id')
+CHANGES = ('time', 'medicine_name', 'repeat_type', 'days', 'until_date')
+
+RUNNING = 'running'
+COMPLETED = 'completed'
+
+
+class BulkJob:
+    def __init__(self, job_id, filters, changes, schedules, devices):
+        self.job_id = job_id
+        self.filters = filters
+        self.changes = changes  # None for a delete
+        self.schedules = schedules
+        self.devices = devices
+        self.published = 0
+        self.queued = 0  # device offline or publish slots busy; delivered later (command_queue.py)
+        self.failures = []
+        self.state = RUNNING if devices else COMPLETED
+        self.created_at = time.time()
+        self.finished_at = None if devices else self.created_at
+        self._lock = threading.Lock()
+
+    def record(self, serial_number, published=None, error=None):
+        with self._lock:
+            if error is not None:
+                self.failures.append({'serial_number': serial_number, 'error': error})
+            elif published:
+                self.published += 1
+            else:
+                self.queued += 1
+
+    def to_dict(self):
+        with self._lock:
+            done = self.published + self.queued + len(self.failures)
+            return {
+                'job_id': self.job_id,
+                'state': self.state,
+                'filter': self.filters,
+                'changes': self.changes,
+                'action': 'delete' if self.changes is None else 'update',
+                'schedules': self.schedules,
+                'devices': self.devices,
+                'done': done,
+                'published': self.published,
+                'queued': self.queued,
+                'failed': len(self.failures),
+                'failures': self.failures[:100],
+                'created_at': datetime.fromtimestamp(self.created_at).isoformat(),
+                'finished_at': datetime.fromtimestamp(self.finished_at).isoformat() if self.finished_at else None
+            }
+
+
+_lock = threading.Lock()
+_jobs = OrderedDict()  # job_id -> BulkJob, oldest first
+
+
+def _selection(filters):
+    """SELECT of the ids of the schedules matching every given filter"""
+    clauses, params = [], []
+    if 'medicine_name' in filters:
+        clauses.append('s.medicine_name = ?')
+        params.append(filters['medicine_name'])
+    if 'module' in filters:
+        clauses.append('dm.module_name = ?')
+        params.append(filters['module'])
+    if 'doctor_id' in filters:
+        clauses.append('p.doctor_id = ?')
+        params.append(filters['doctor_id'])
+    sql = f'''
+        SELECT s.id
+        FROM schedule s
+        JOIN dispenser_module dm ON s.dispenser_module_id = dm.id
+        JOIN patient p ON s.patient_id = p.id
+        WHERE {' AND '.join(clauses)}
+    '''
+    return sql, params
+
+
+def apply_bulk_change(conn, filters, changes=None):
+    """Update (or, with changes=None, delete) the matching schedules in one transaction.
+
+    Returns (number of schedules, {serial_number: mqtt schedule}) with the
+    full new schedule of every affected device.
+    """
+    filters = {key: value for key, value in filters.items() if key in FILTERS}
+    if not filters:
+        raise ValueError(f"filter needs at least one of {', '.join(FILTERS)}")
+    selection, params = _selection(filters)
+    c = conn.cursor()
+    try:
+        if changes is None:
+            c.execute(f'DELETE FROM schedule WHERE id IN ({selection}) RETURNING patient_id', params)
+        else:
+            unknown = set(changes) - set(CHANGES)
+            if unknown or not changes:
+                raise ValueError(f"changes may only set {', '.join(CHANGES)}")
+            if 'time' in changes and parse_time(changes['time']) is None:
+                raise ValueError(f"invalid time {changes['time']!r}, expected HH:MM")
+            if 'days' in changes and not valid_days(changes['days']):
+                raise ValueError(f"invalid days {changes['days']!r}, expected a list of weekday names")
+            columns, values = [], []
+            for key, value in changes.items():
+                if key == 'days':
+                    key, value = 'days_of_week', ','.join(value) if value else None
+                columns.append(f'{key} = ?')
+                values.append(value)
+            c.execute(f'UPDATE schedule SET {", ".join(columns)} WHERE id IN ({selection}) RETURNING patient_id',
+                      values + params)
+        patient_ids = [row[0] for row in c.fetchall()]
+
+        # Every affected device's whole schedule, in one query
+        c.execute('''
+            SELECT pd.serial_number, s.time, dm.module_name, s.days_of_week, s.until_date
+            FROM pill_dispenser pd
+            LEFT JOIN schedule s ON s.patient_id = pd.patient_id
+            LEFT JOIN dispenser_module dm ON s.dispenser_module_id = dm.id
+            WHERE pd.patient_id IN (SELECT value FROM json_each(?))
+            ORDER BY pd.serial_number, s.time
+        ''', (json.dumps(sorted(set(patient_ids))),))
+        schedules = {}
+        for serial_number, at, module_name, days_of_week, until_date in c.fetchall():
+            rows = schedules.setdefault(serial_number, [])
+            if at is not None:
+                rows.append({'time': at, 'module': module_name, 'until_date': until_date,
+                             'days': days_of_week.split(',') if days_of_week else ['daily']})
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(patient_ids), {serial: transform_schedule_for_mqtt(rows) for serial, rows in schedules.items()}
+
+
+def _publish(job, serial_number, schedule):
+    # The change is committed, so a device must not be left out of sync:
+    # publish_schedule queues what it cannot send (offline device, busy
+    # publish slots, broker errors) and only raises if queueing fails too
+    for attempt in range(BULK_PUBLISH_RETRIES + 1):
+        try:
+            job.record(serial_number, published=publish_schedule(serial_number, schedule))
+            return
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            logger.warning("bulk schedule publish failed", exc_info=True, extra={'fields': {
+                'job_id': job.job_id, 'device_id': serial_number, 'attempt': attempt + 1}})
+            if attempt < BULK_PUBLISH_RETRIES:
+                time.sleep(2 ** attempt)
+    job.record(serial_number, error=error)
+
+
+def start_bulk_job(filters, changes, schedules, payloads):
+    """Track a bulk change and publish its payloads in the background; returns the job"""
+    job = BulkJob(uuid.uuid4().hex[:8], filters, changes, schedules, len(payloads))
+    with _lock:
+        _jobs[job.job_id] = job
+        while len(_jobs) > BULK_JOB_HISTORY:
+            _jobs.popitem(last=False)
+
+    def run():
+        started = time.perf_counter()
+        # Fewer workers than publish slots, so single commands still get through
+        with ThreadPoolExecutor(max_workers=BULK_PUBLISH_WORKERS, thread_name_prefix="bulk-publish") as pool:
+            for serial_number, schedule in payloads.items():
+                pool.submit(_publish, job, serial_number, schedule)
+        with job._lock:
+            job.state = COMPLETED
+            job.finished_at = time.time()
+        logger.info("bulk schedule change published", extra={'fields': {
+            'job_id': job.job_id, 'devices': job.devices, 'published': job.published, 'queued': job.queued,
+            'failed': len(job.failures), 'seconds': round(time.perf_counter() - started, 3)}})
+
+    if payloads:
+        threading.Thread(target=run, name=f"bulk-{job.job_id}", daemon=True).start()
+    return job
+
+
+def get_bulk_job(job_id):
+    with _lock:
+        job = _jobs.get(job_id)
+    return job.to_dict() if job else None
@@ -0,0 +1,134 @@
+import json
+
+# Optional compact binary encoding for MQTT payloads.
+#
+# Binary payloads are a 2-byte header followed by a MessagePack body:
+#     0xB1 <schema version> <msgpack>
+# 0xB1 can never start a UTF-8 text or JSON payload, so both formats can
+# share a topic. Devices opt in by publishing their supported encodings
+# on pill/{id}/capabilities; everything else keeps using text/JSON.
+#
+# Schema version 1 bodies:
+#     command          {"c": "refill", "a": ["module2", "20"], "id": "3f9a01c2"}
+#     schedule/set     {"s": [...same list as the JSON schedule...]}
+#     settings/update  {"s": {...same object as the JSON settings...}}
+#     device -> server {"t": "Pill taken", "m": "module1", "id": "3f9a01c2", "ts": 1717228800.5}
+#                      (only "t" is required)
+#     status/batch     {"b": [<device -> server body>, ...]}
+
+try:
+    import msgpack
+except ImportError:  # optional dependency
+    msgpack = None
+
+ENCODING_TEXT = 'text'
+ENCODING_MSGPACK = 'msgpack/1'
+
+MAGIC = 0xB1
+SCHEMA_VERSION = 1
+
+
+def supported_encodings():
+    """Encodings this server can speak, most preferred first"""
+    return [ENCODING_MSGPACK, ENCODING_TEXT] if msgpack else [ENCODING_TEXT]
+
+
+def choose_encoding(offered):
+    """Pick the best encoding both sides support (falls back to text)"""
+    for encoding in supported_encodings():
+        if encoding in offered:
+            return encoding
+    return ENCODING_TEXT
+
+
+def parse_capabilities(payload):
+    """'{"encodings": ["msgpack/1", "text"]}' -> ['msgpack/1', 'text']"""
+    try:
+        capabilities = json.loads(payload)
+    except ValueError:
+        return []
+    encodings = capabilities.get('encodings') if isinstance(capabilities, dict) else None
+    return [e for e in encodings if isinstance(e, str)] if isinstance(encodings, list) else []
+
+
+def is_binary(payload):
+    return len(payload) >= 2 and payload[0] == MAGIC
+
+
+def _pack(body):
+    return bytes((MAGIC, SCHEMA_VERSION)) + msgpack.packb(body, use_bin_type=True)
+
+
+def encode_command(command, command_id, encoding):
+    """'refill:module2:20' -> wire payload in the device's encoding"""
+    if encoding == ENCODING_MSGPACK and msgpack:
+        name, *args = command.split(':')
+        return _pack({'c': name, 'a': args, 'id': command_id})
+    return f"{command}#{command_id}"
+
+
+def encode_document(obj, encoding):
+    """Schedule/settings payload in the device's encoding"""
+    if encoding == ENCODING_MSGPACK and msgpack:
+        return _pack({'s': obj})
+    return json.dumps(obj)
+
+
+def decode_device_payload(payload):
+    """Decode a device -> server payload.
+
+    Returns (text, module, command_id, device_timestamp); module, command_id
+    and device_timestamp are None when the payload does not carry them
+    (text payloads never do; callers parse the text instead).
+    """
+    if not is_binary(payload):
+        return payload.decode(), None, None, None
+    return _event_fields(_unpack(payload))
+
+
+def _unpack(payload):
+    if msgpack is None:
+        raise ValueError("binary payload received but msgpack is not installed")
+    if payload[1] != SCHEMA_VERSION:
+        raise ValueError(f"unsupported payload schema version {payload[1]}")
+    return msgpack.unpackb(payload[2:], raw=False)
+
+
+def _label(value, field):
+    """Module names and command ids are strings (numbers are accepted); None if absent"""
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    raise ValueError(f"event {field} must be a string")
+
+
+def _event_fields(body):
+    if not isinstance(body, dict) or 't' not in body:
+        raise ValueError("event without text field")
+    return str(body['t']), _label(body.get('m'), 'module'), _label(body.get('id'), 'id'), body.get('ts')
+
+
+def decode_batch(payload):
+    """Decode a status/batch payload into a list of decode_device_payload() tuples.
+
+    Text batches are a JSON array of {"msg": ..., "ts": ..., "module": ..., "id": ...}
+    objects (only "msg" is required); binary batches use the "b" body.
+    """
+    if is_binary(payload):
+        body = _unpack(payload)
+        events = body.get('b') if isinstance(body, dict) else None
+        if not isinstance(events, list):
+            raise ValueError("binary batch without event list")
+        return [_event_fields(event) for event in events]
+
+    events = json.loads(payload)
+    if not isinstance(events, list):
+        raise ValueError("batch payload is not a JSON array")
+    decoded = []
+    for event in events:
+        if not isinstance(event, dict) or 'msg' not in event:
+            raise ValueError("batch event without msg field")
+        decoded.append((str(event['msg']), _label(event.get('module'), 'module'), _label(event.get('id'), 'id'),
+                        event.get('ts')))
+    return decoded
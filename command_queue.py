@@ -0,0 +1,138 @@
+import logging
+import time
+from datetime import datetime
+from config import COMMAND_QUEUE_TTL, COMMAND_QUEUE_DISPENSE_TTL
+from database import connect
+
+logger = logging.getLogger(__name__)
+
+# Outgoing messages for devices that are offline, persisted in SQLite and
+# delivered in order when the device comes back (mqtt_publisher.drain_queue).
+#
+# A newer message with the same collapse key replaces the queued one, so a
+# device that was away gets the latest settings, schedule, hard mode or
+# refill count once rather than every intermediate value. Dispenses never
+# collapse but expire after COMMAND_QUEUE_DISPENSE_TTL; a dose that late
+# should not be pushed out by a reconnect. The API took the pill when the
+# dispense was requested, so an expired dispense puts it back.
+
+
+def collapse_key(kind, command=None):
+    """Messages with equal keys supersede each other; None never collapses"""
+    if kind in ('schedule', 'settings'):
+        return kind
+    name, _, args = command.partition(':')
+    if name in ('refill', 'reset_pending'):
+        return f"{name}:{args.split(':')[0]}"  # per module
+    if name == 'set_hard_mode':
+        return name
+    return None
+
+
+def ttl_for(kind, command=None):
+    if kind == 'command' and command.startswith('dispense:'):
+        return COMMAND_QUEUE_DISPENSE_TTL
+    return COMMAND_QUEUE_TTL
+
+
+def enqueue(device_id, kind, topic, payload, command=None, command_id=None, now=None):
+    """Queue a message; returns the command ids (or None) of the messages it superseded"""
+    now = now or time.time()
+    key = collapse_key(kind, command)
+    conn = connect()
+    c = conn.cursor()
+    superseded = []
+    if key is not None:
+        c.execute('''
+            DELETE FROM command_queue
+            WHERE serial_number = ? AND collapse_key = ?
+            RETURNING command_id
+        ''', (device_id, key))
+        superseded = [row[0] for row in c.fetchall()]
+    c.execute('''
+        INSERT INTO command_queue (serial_number, kind, topic, payload, command_id, command,
+                                   collapse_key, created_at, expires_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (device_id, kind, topic, payload, command_id, command, key, now, now + ttl_for(kind, command)))
+    conn.commit()
+    conn.close()
+    return superseded
+
+
+def pending(device_id, now=None):
+    """Unexpired queued messages for a device, oldest first: (id, kind, topic, payload, command_id)"""
+    conn = connect()
+    rows = conn.execute('''
+        SELECT id, kind, topic, payload, command_id
+        FROM command_queue
+        WHERE serial_number = ? AND expires_at > ?
+        ORDER BY id
+    ''', (device_id, now or time.time())).fetchall()
+    conn.close()
+    return rows
+
+
+def has_pending(device_id):
+    conn = connect()
+    row = conn.execute('SELECT 1 FROM command_queue WHERE serial_number = ? LIMIT 1', (device_id,)).fetchone()
+    conn.close()
+    return row is not None
+
+
+def remove(queue_id):
+    conn = connect()
+    conn.execute('DELETE FROM command_queue WHERE id = ?', (queue_id,))
+    conn.commit()
+    conn.close()
+
+
+def queued_devices():
+    """Serial numbers with queued messages"""
+    conn = connect()
+    rows = conn.execute('SELECT DISTINCT serial_number FROM command_queue').fetchall()
+    conn.close()
+    return [row[0] for row in rows]
+
+
+def purge_expired(now=None):
+    """Drop expired messages.
+
+    Returns (command ids (or None) of the dropped messages, [(serial, module,
+    pills_left)] of the modules whose undelivered dispense was put back).
+    """
+    conn = connect()
+    c = conn.cursor()
+    rows = c.execute('''
+        DELETE FROM command_queue WHERE expires_at <= ?
+        RETURNING command_id, serial_number, command
+    ''', (now or time.time(),)).fetchall()
+    restored = []
+    for _, serial_number, command in rows:
+        if not command or not command.startswith('dispense:'):
+            continue
+        module_name = command.split(':')[1]
+        c.execute('''
+            UPDATE dispenser_module SET pills_left = pills_left + 1
+            WHERE module_name = ?
+              AND pill_dispenser_id = (SELECT id FROM pill_dispenser WHERE serial_number = ?)
+            RETURNING id, pills_left
+        ''', (module_name, serial_number))
+        module = c.fetchone()
+        if module is None:
+            continue
+        c.execute('INSERT INTO logs (timestamp, dispenser_module_id, message) VALUES (?, ?, ?)',
+                  (datetime.now().isoformat(), module[0], "Dispense expired undelivered, pill restored"))
+        restored.append((serial_number, module_name, module[1]))
+    conn.commit()
+    conn.close()
+    if rows:
+        logger.info("expired queued commands dropped", extra={'fields': {
+            'count': len(rows), 'dispenses_restored': len(restored)}})
+    return [row[0] for row in rows], restored
+
+
+def queue_depth():
+    conn = connect()
+    depth = conn.execute('SELECT COUNT(*) FROM command_queue').fetchone()[0]
+    conn.close()
+    return depth
@@ -0,0 +1,233 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from config import COMMAND_TIMEOUT, COMMAND_HISTORY_SIZE
+
+# Correlates commands sent on pill/{id}/command with the device replies on
+# pill/{id}/status. Outgoing commands get a "#<id>" suffix, e.g.
+# "dispense:module1#3f9a01c2"; the device echoes it at the end of its
+# replies ("ack#3f9a01c2", "module1: Pill dispensed#3f9a01c2"). Binary
+# (codec.py) payloads carry the same id in their "id" field.
+#
+# Commands for offline devices start QUEUED (command_queue.py) and only
+# become SENT, and start their latency clock, when actually published;
+# a queued command that expires or is superseded ends up DROPPED.
+
+QUEUED = 'queued'
+SENT = 'sent'
+ACKED = 'acked'
+COMPLETED = 'completed'
+TIMED_OUT = 'timed_out'
+DROPPED = 'dropped'
+
+CORRELATION_SEPARATOR = '#'
+
+# Upper bounds (seconds) of the round-trip latency histogram buckets
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf'))
+
+
+class Command:
+    __slots__ = ('command_id', 'device_id', 'command', 'state', 'queued_at', 'sent_at',
+                 'acked_at', 'completed_at', 'reply')
+
+    def __init__(self, command_id, device_id, command, queued=False):
+        self.command_id = command_id
+        self.device_id = device_id
+        self.command = command
+        self.state = QUEUED if queued else SENT
+        self.queued_at = time.time() if queued else None
+        self.sent_at = None if queued else time.time()
+        self.acked_at = None
+        self.completed_at = None
+        self.reply = None
+
+    def to_dict(self):
+        return {
+            'command_id': self.command_id,
+            'device_id': self.device_id,
+            'command': self.command,
+            'state': self.state,
+            'queued_at': self.queued_at,
+            'sent_at': self.sent_at,
+            'acked_at': self.acked_at,
+            'completed_at': self.completed_at,
+            'reply': self.reply
+        }
+
+
+class DeviceLatency:
+    __slots__ = ('buckets', 'count', 'total', 'timeouts', 'consecutive_timeouts',
+                 'last_completed_at')
+
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.timeouts = 0
+        self.consecutive_timeouts = 0
+        self.last_completed_at = None
+
+    def observe(self, seconds):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, q):
+        """Upper bucket bound containing the q-th quantile"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return bound
+        return LATENCY_BUCKETS[-1]
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'timeouts': self.timeouts,
+            'consecutive_timeouts': self.consecutive_timeouts,
+            'last_completed_at': self.last_completed_at,
+            'histogram': {('+Inf' if b == float('inf') else str(b)): n
+                          for b, n in zip(LATENCY_BUCKETS, self.buckets)}
+        }
+
+
+_lock = threading.Lock()
+_commands = OrderedDict()  # command_id -> Command, oldest first
+_latency = {}  # device_id -> DeviceLatency
+
+
+def _latency_for(device_id):
+    latency = _latency.get(device_id)
+    if latency is None:
+        latency = _latency[device_id] = DeviceLatency()
+    return latency
+
+
+def track_command(device_id, command, queued=False):
+    """Register an outgoing command and return its correlation id"""
+    command_id = uuid.uuid4().hex[:8]
+    with _lock:
+        _commands[command_id] = Command(command_id, device_id, command, queued)
+        while len(_commands) > COMMAND_HISTORY_SIZE:
+            _commands.popitem(last=False)
+    return command_id
+
+
+def mark_queued(command_id):
+    """A command whose publish failed went to the offline queue instead"""
+    with _lock:
+        command = _commands.get(command_id)
+        if command is not None and command.state == SENT:
+            command.state = QUEUED
+            command.queued_at = command.sent_at
+            command.sent_at = None
+
+
+def mark_sent(command_id):
+    """A queued command was published; its latency is measured from now"""
+    with _lock:
+        command = _commands.get(command_id)
+        if command is not None and command.state == QUEUED:
+            command.state = SENT
+            command.sent_at = time.time()
+            _commands.move_to_end(command_id)  # keep sent commands ordered by sent_at
+
+
+def mark_dropped(command_ids):
+    """Queued commands that expired or were superseded before delivery"""
+    with _lock:
+        for command_id in command_ids:
+            command = _commands.get(command_id)
+            if command is not None and command.state == QUEUED:
+                command.state = DROPPED
+
+
+def split_correlation_id(message):
+    """'module1: Pill dispensed#3f9a01c2' -> ('module1: Pill dispensed', '3f9a01c2')"""
+    body, sep, command_id = message.rpartition(CORRELATION_SEPARATOR)
+    if not sep or not command_id or ' ' in command_id:
+        return message, None
+    return body, command_id
+
+
+def match_reply(device_id, message, command_id=None):
+    """Advance the state of the command a device reply refers to, if any.
+
+    Binary payloads carry the id in a field and pass it as `command_id`;
+    text replies carry it as a "#<id>" suffix.
+    """
+    if command_id is None:
+        body, command_id = split_correlation_id(message)
+        if command_id is None:
+            return None
+    else:
+        body = message
+    now = time.time()
+    with _lock:
+        command = _commands.get(command_id)
+        if command is None or command.device_id != device_id:
+            return None
+        if body.strip().lower() == 'ack':
+            if command.state == SENT:
+                command.state = ACKED
+                command.acked_at = now
+            return command
+
+        if command.state in (SENT, ACKED, TIMED_OUT):
+            latency = _latency_for(device_id)
+            command.state = COMPLETED
+            command.completed_at = now
+            command.reply = body
+            latency.observe(now - command.sent_at)
+            latency.last_completed_at = now
+            latency.consecutive_timeouts = 0
+        return command
+
+
+def expire_commands(timeout=COMMAND_TIMEOUT):
+    """Mark commands without a completion after `timeout` seconds as timed out"""
+    cutoff = time.time() - timeout
+    with _lock:
+        for command in _commands.values():
+            if command.sent_at is None:
+                continue  # queued or dropped, never sent
+            if command.sent_at > cutoff:
+                break  # ordered by sent_at
+            if command.state in (SENT, ACKED):
+                command.state = TIMED_OUT
+                latency = _latency_for(command.device_id)
+                latency.timeouts += 1
+                latency.consecutive_timeouts += 1
+
+
+def get_command(command_id):
+    expire_commands()
+    with _lock:
+        command = _commands.get(command_id)
+        return command.to_dict() if command else None
+
+
+def slow_devices(p95_threshold=2.5):
+    """Devices whose p95 round trip exceeds the threshold or that time out"""
+    expire_commands()
+    with _lock:
+        result = []
+        for device_id, latency in _latency.items():
+            p95 = latency.quantile(0.95)
+            unresponsive = latency.consecutive_timeouts > 0
+            if unresponsive or (p95 is not None and p95 > p95_threshold):
+                result.append({'device_id': device_id, 'unresponsive': unresponsive,
+                               **latency.to_dict()})
+    result.sort(key=lambda d: (not d['unresponsive'], -(d['p95'] or 0)))
+    return result
@@ -1,5 +1,101 @@
+import os
+
 MQTT_BROKER = "localhost"  # or your network IP for LAN
 MQTT_PORT = 1883
 DEVICE_TOPIC_WITH_HARDCODED_DEVICE_ID = "pill/device1"
 
-DATABASE_FILE = "pill_data.db"
+DATABASE_FILE = os.environ.get("PILL_DATABASE_FILE", "pill_data.db")
+
+# Sharded MQTT ingest (off unless PILL_INGEST_NODE is set, see ingest_shards.py)
+INGEST_NODE_ID = os.environ.get("PILL_INGEST_NODE")  # unique name per ingest process/node
+INGEST_MEMBERS_TOPIC = "pill/_ingest/members"  # retained heartbeats, one subtopic per node
+INGEST_HEARTBEAT_INTERVAL = 5  # seconds between membership heartbeats
+INGEST_MEMBER_TIMEOUT = 15  # seconds without a heartbeat before a node is dropped
+INGEST_HANDOFF_DELAY = 2  # seconds before reloading state for devices taken over
+
+# Traffic recording (PILL_TRAFFIC_RECORD=path appends every received MQTT message)
+TRAFFIC_RECORD_FILE = os.environ.get("PILL_TRAFFIC_RECORD")
+
+# Device presence (devices send a heartbeat on pill/{id}/presence)
+PRESENCE_TIMEOUT = 3 * 60  # seconds without any message before a device is marked offline
+PRESENCE_SWEEP_INTERVAL = 15  # seconds between checks for silent devices
+
+# Device shadow
+SHADOW_CHECKPOINT_INTERVAL = 30  # seconds between shadow -> SQLite checkpoints
+
+# SQLite
+DB_BUSY_TIMEOUT = 10  # seconds a writer waits for the lock before failing
+
+# Columnar event history (older events move out of the logs table)
+EVENT_SEGMENT_DIR = os.environ.get("PILL_EVENT_SEGMENT_DIR", "event_segments")
+EVENT_SEGMENT_MIN_AGE_DAYS = 30  # events older than this are sealed into segment files
+EVENT_SEGMENT_MAX_ROWS = 1000000  # events per segment file
+EVENT_SEAL_INTERVAL = 60 * 60  # seconds between sealing runs
+
+# Alert digests (one summary per doctor per window; urgent alerts go out at once)
+DIGEST_WINDOW = 15 * 60  # seconds alerts are collected before a doctor's digest is sent
+DIGEST_CHECK_INTERVAL = 10  # seconds between checks for closed windows
+DIGEST_URGENT_PHRASES = ("is empty", "❌")  # alerts containing these bypass the digest
+
+# Refill planning report (daily CSV for pharmacy staff)
+REFILL_REPORT_DIR = os.environ.get("PILL_REFILL_REPORT_DIR", "reports")
+REFILL_REPORT_CRON = "5 0 * * *"  # daily, just after midnight (cron syntax, local time)
+REFILL_PLAN_HORIZON_DAYS = 7  # modules running out within this many days are listed
+REFILL_TARGET_DAYS = 30  # refill enough pills for this many days of doses
+
+# Admission control for the command endpoints (dispense, refill, reset_pending)
+RATE_LIMIT_DEVICE = (0.5, 5)  # (tokens per second, burst) per device serial
+RATE_LIMIT_CLIENT = (10.0, 50)  # (tokens per second, burst) per API client address
+RATE_LIMIT_MAX_KEYS = 100000  # buckets kept per limiter (least recently used dropped)
+MQTT_MAX_INFLIGHT_PUBLISHES = 32  # concurrent broker connections for publishing
+MQTT_PUBLISH_WAIT = 2  # seconds a publish waits for a free slot before failing
+
+# Idempotent dispense
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60  # seconds a dispense Idempotency-Key is remembered
+IDEMPOTENCY_PURGE_INTERVAL = 10 * 60  # seconds between expired-key sweeps
+
+# Command round-trip tracking
+COMMAND_TIMEOUT = 30  # seconds before an unanswered command is marked timed out
+COMMAND_HISTORY_SIZE = 10000  # most recent commands kept in memory
+COMMAND_EXPIRE_INTERVAL = 5  # seconds between sweeps marking unanswered commands timed out
+
+# Duplicate-delivery suppression for MQTT ingest (dedup.py); PILL_DEDUP=0 to disable
+DEDUP_ENABLED = os.environ.get("PILL_DEDUP", "1") == "1"
+DEDUP_TTL = 60 * 60  # seconds an event with a device timestamp or command id is remembered
+DEDUP_UNTIMED_WINDOW = 3  # seconds an identical event without either counts as a redelivery (keep short: real repeats are dropped too)
+DEDUP_KEYS_PER_DEVICE = 64  # most recent event keys kept per device
+DEDUP_MAX_DEVICES = 200000  # devices tracked (least recently active dropped)
+DEDUP_BLOOM_BITS = 0  # bits per Bloom filter generation for keys evicted from the LRU, 0 = off (e.g. 8 * 2**20)
+DEDUP_BLOOM_HASHES = 7  # hash functions per key
+
+# Offline command queue (delivered when the device reconnects)
+MQTT_COMMAND_QOS = 1  # QoS for commands, schedules and settings; devices keep a persistent session
+MQTT_PUBACK_TIMEOUT = 2  # seconds to wait for the broker to acknowledge a QoS 1 publish
+COMMAND_QUEUE_TTL = 7 * 24 * 60 * 60  # seconds a queued schedule, settings or command is kept
+COMMAND_QUEUE_DISPENSE_TTL = 10 * 60  # seconds a queued dispense stays worth delivering
+COMMAND_QUEUE_PURGE_INTERVAL = 60  # seconds between expired-message sweeps
+COMMAND_QUEUE_RETRY_INTERVAL = 30  # seconds between retries of queued messages for reachable devices
+COMMAND_QUEUE_DRAIN_WORKERS = 4  # threads delivering queued messages to reconnected devices
+
+# Bulk schedule changes (bulk_schedule.py)
+BULK_PUBLISH_WORKERS = 16  # concurrent schedule publishes per bulk job (below MQTT_MAX_INFLIGHT_PUBLISHES)
+BULK_JOB_HISTORY = 100  # most recent bulk jobs kept for status queries
+BULK_PUBLISH_RETRIES = 3  # further attempts (1s, 2s, 4s apart) when a device's schedule can be neither sent nor queued
+
+# Background job scheduler (scheduler.py)
+JOB_WORKERS = 4  # threads shared by all scheduled jobs
+JOB_HISTORY_SIZE = 20  # recent runs kept per job for /api/jobs
+
+# Per-request SQL profiling (off by default; PILL_SQL_PROFILE=1 to enable)
+SQL_PROFILING = os.environ.get("PILL_SQL_PROFILE") == "1"
+SQL_PROFILE_REPEAT_THRESHOLD = 3  # same query shape this often in one request is flagged as N+1
+SQL_PROFILE_SLOWEST = 5  # slowest statements reported per request
+
+# Logging (JSON lines on stdout, written off the hot path by a queue listener)
+LOG_LEVEL = os.environ.get("PILL_LOG_LEVEL", "INFO")
+LOG_LEVELS = {  # per-logger overrides, e.g. "mqtt.messages": "WARNING"
+}
+LOG_SAMPLE_RATES = {  # share of INFO/DEBUG records kept for high-volume loggers
+    "mqtt.messages": float(os.environ.get("PILL_LOG_MQTT_SAMPLE_RATE", "1.0")),
+}
+LOG_QUEUE_SIZE = 10000  # records buffered before new ones are dropped
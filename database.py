@@ -1,10 +1,70 @@
+import logging
 import sqlite3
-from config import DATABASE_FILE
+import time
+from config import DATABASE_FILE, DB_BUSY_TIMEOUT, IDEMPOTENCY_KEY_TTL
 from datetime import datetime
+from metrics import DB_QUERY_SECONDS, DB_COMMIT_SECONDS, statement_kind
+import sql_profiler
+from search_index import init_search_index
+import low_stock
+
+logger = logging.getLogger(__name__)
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that records statement execution time in the metrics registry
+    and in the active per-request SQL profile, if any"""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - started
+            DB_QUERY_SECONDS.observe(elapsed, statement_kind(sql))
+            sql_profiler.record(sql, elapsed)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            elapsed = time.perf_counter() - started
+            DB_QUERY_SECONDS.observe(elapsed, statement_kind(sql))
+            sql_profiler.record(sql, elapsed)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose cursors and commits are timed"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            DB_COMMIT_SECONDS.observe(time.perf_counter() - started)
+
+
+def connect():
+    """Open an instrumented connection to the pill database"""
+    return sqlite3.connect(DATABASE_FILE, timeout=DB_BUSY_TIMEOUT, factory=TimedConnection)
+
 
 def init_db():
-    conn = sqlite3.connect(DATABASE_FILE)
+    conn = connect()
     c = conn.cursor()
+
+    # WAL lets API readers run while ingest/dispense writers hold the lock
+    c.execute('PRAGMA journal_mode=WAL')
     
     # Doctor
     c.execute('''
@@ -78,27 +138,145 @@ def init_db():
         )
     ''')
 
+    # Foreign-key lookups used by the per-doctor / per-patient views
+    c.execute('CREATE INDEX IF NOT EXISTS idx_patient_doctor ON patient(doctor_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_module_dispenser ON dispenser_module(pill_dispenser_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_schedule_patient ON schedule(patient_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_schedule_module ON schedule(dispenser_module_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_schedule_medicine ON schedule(medicine_name)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_logs_module ON logs(dispenser_module_id, id)')
+
+    # Last reported device state, checkpointed from the in-memory shadow
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS device_shadow (
+            serial_number TEXT PRIMARY KEY,
+            last_status TEXT,
+            last_alert TEXT,
+            last_seen TEXT
+        )
+    ''')
+
+    # Client idempotency keys for dispense requests (evicted after IDEMPOTENCY_KEY_TTL)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_key (
+            key TEXT PRIMARY KEY,
+            device_id TEXT,
+            response TEXT,
+            status_code INTEGER,
+            created_at REAL
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_key_created ON idempotency_key(created_at)')
+
+    # Online/offline transitions reported by presence.py
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS presence_event (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            serial_number TEXT NOT NULL,
+            state TEXT NOT NULL CHECK(state IN ('online', 'offline')),
+            reason TEXT,  -- presence message, other message or heartbeat timeout
+            at TEXT NOT NULL
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_presence_event_serial ON presence_event(serial_number, id)')
+
+    # Messages held for offline devices until they reconnect (command_queue.py)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS command_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            serial_number TEXT NOT NULL,
+            kind TEXT NOT NULL,  -- command, schedule or settings
+            topic TEXT NOT NULL,
+            payload BLOB NOT NULL,
+            command_id TEXT,
+            command TEXT,  -- command string (dispense:module1) for kind = command
+            collapse_key TEXT,  -- a newer message with the same key replaces this one
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_command_queue_serial ON command_queue(serial_number, collapse_key)')
+
+    # Per-segment min/max index of events sealed out of logs (event_segments.py)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS event_segment (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file TEXT NOT NULL UNIQUE,
+            rows INTEGER NOT NULL,
+            min_id INTEGER NOT NULL,
+            max_id INTEGER NOT NULL,
+            min_ts INTEGER NOT NULL,  -- epoch microseconds
+            max_ts INTEGER NOT NULL,
+            min_device INTEGER NOT NULL,
+            max_device INTEGER NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    ''')
+
+    # Threshold crossings recorded by triggers at write time
+    low_stock.init_low_stock(c)
+
+    # Full-text search over patients, doctors and medicines
+    init_search_index(c)
+
     conn.commit()
     conn.close()
 
 
-def log_event(dispenser_module_name, message):
-    conn = sqlite3.connect(DATABASE_FILE)
+def purge_idempotency_keys(ttl=IDEMPOTENCY_KEY_TTL):
+    conn = connect()
+    c = conn.cursor()
+    c.execute("DELETE FROM idempotency_key WHERE created_at < ?", (time.time() - ttl,))
+    deleted = c.rowcount
+    conn.commit()
+    conn.close()
+    return deleted
+
+
+_MODULE_ID_QUERY = """
+    SELECT dm.id
+    FROM dispenser_module dm
+    JOIN pill_dispenser pd ON dm.pill_dispenser_id = pd.id
+    WHERE pd.serial_number = ? AND dm.module_name = ?
+"""
+
+
+def log_event(serial_number, dispenser_module_name, message, timestamp=None):
+    """Log one event; `timestamp` is the device-side ISO time if known"""
+    conn = connect()
     c = conn.cursor()
     
-    # Look up the dispenser_module_id
-    c.execute("SELECT id FROM dispenser_module WHERE module_name = ?", (dispenser_module_name,))
+    # Look up the dispenser_module_id (module names repeat on every device)
+    c.execute(_MODULE_ID_QUERY, (serial_number, dispenser_module_name))
     row = c.fetchone()
     module_id = row[0] if row else None
 
     c.execute("INSERT INTO logs (timestamp, dispenser_module_id, message) VALUES (?, ?, ?)",
-              (datetime.now().isoformat(), module_id, message))
+              (timestamp or datetime.now().isoformat(), module_id, message))
+    conn.commit()
+    conn.close()
+
+
+def log_events(serial_number, events):
+    """Log many (dispenser_module_name, message, timestamp) events of one device in one transaction"""
+    conn = connect()
+    c = conn.cursor()
+
+    module_ids = {}
+    for name in {name for name, _, _ in events}:
+        c.execute(_MODULE_ID_QUERY, (serial_number, name))
+        row = c.fetchone()
+        module_ids[name] = row[0] if row else None
+
+    now = datetime.now().isoformat()
+    c.executemany("INSERT INTO logs (timestamp, dispenser_module_id, message) VALUES (?, ?, ?)",
+                  [(timestamp or now, module_ids[name], message) for name, message, timestamp in events])
     conn.commit()
     conn.close()
 
 
 def get_logs(limit=50):
-    conn = sqlite3.connect(DATABASE_FILE)
+    conn = connect()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("""
@@ -0,0 +1,133 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from config import (DEDUP_TTL, DEDUP_UNTIMED_WINDOW, DEDUP_KEYS_PER_DEVICE, DEDUP_MAX_DEVICES,
+                    DEDUP_BLOOM_BITS, DEDUP_BLOOM_HASHES)
+from metrics import REGISTRY
+
+# Suppresses device events the broker delivers twice. With QoS 1, a
+# message whose PUBACK was lost is sent again after a reconnect, and
+# logging it again would double-count doses and repeat notifications.
+#
+# Every decoded event gets a key: a hash of device, topic kind, message,
+# module, command id and device timestamp. An event with a timestamp or
+# command id is unique, so its key is remembered for DEDUP_TTL. A bare
+# text event ("module1: Pill taken") can legitimately repeat, so an
+# identical one is only treated as a redelivery within
+# DEDUP_UNTIMED_WINDOW of the first. The window is a few seconds: enough
+# for the resend after a quick reconnect, short enough that a real second
+# dose is rarely lost. A redelivery arriving later is logged twice.
+#
+# Memory is bounded. Each device keeps its DEDUP_KEYS_PER_DEVICE most
+# recent keys in an LRU, and at most DEDUP_MAX_DEVICES devices are
+# tracked. DEDUP_BLOOM_BITS > 0 adds two rotating Bloom filters
+# (DEDUP_BLOOM_BITS / 4 bytes in total) that remember keys the LRU has
+# already evicted, until the TTL. A false positive drops a real event,
+# so the filter is off by default.
+
+DEDUP_CHECKS = REGISTRY.counter('mqtt_dedup_checks_total', 'Device events checked for redelivery')
+DEDUP_HITS = REGISTRY.counter(
+    'mqtt_duplicates_total', 'Redelivered device events dropped, by where they were found', ('source',))
+DEDUP_DEVICES = REGISTRY.gauge('mqtt_dedup_devices', 'Devices with a deduplication window')
+
+
+def event_key(device_id, kind, message, module=None, command_id=None, device_ts=None, batch_index=None):
+    """(key, ttl) for a decoded device event.
+
+    `batch_index` is the event's position in a status batch. Entries of one
+    batch are separate events, so untimed ones are told apart by position;
+    only a redelivery of the same batch matches them again.
+    """
+    timed = bool(command_id) or device_ts is not None
+    position = None if timed else batch_index
+    digest = hashlib.blake2b(repr((device_id, kind, message, module, command_id, device_ts, position)).encode(),
+                             digest_size=16).digest()
+    return digest, DEDUP_TTL if timed else DEDUP_UNTIMED_WINDOW
+
+
+class BloomFilter:
+    """Two generations of `bits` bits; a generation lives for `ttl` seconds"""
+
+    def __init__(self, bits, hashes, ttl):
+        self.bits = bits
+        self.hashes = hashes
+        self.ttl = ttl
+        self.current = bytearray(bits // 8 + 1)
+        self.previous = bytearray(bits // 8 + 1)
+        self.rotated_at = time.monotonic()
+
+    def _positions(self, digest):
+        # Double hashing (Kirsch-Mitzenmacher) from the two halves of the key
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def _rotate(self, now):
+        if now - self.rotated_at >= self.ttl:
+            self.previous = self.current
+            self.current = bytearray(len(self.current))
+            self.rotated_at = now
+
+    def check_and_add(self, digest, now):
+        """True if the key was (probably) seen before"""
+        self._rotate(now)
+        positions = self._positions(digest)
+        seen = (all(self.current[p >> 3] & (1 << (p & 7)) for p in positions)
+                or all(self.previous[p >> 3] & (1 << (p & 7)) for p in positions))
+        for p in positions:
+            self.current[p >> 3] |= 1 << (p & 7)
+        return seen
+
+
+class Deduplicator:
+    def __init__(self, keys_per_device=DEDUP_KEYS_PER_DEVICE, max_devices=DEDUP_MAX_DEVICES,
+                 bloom_bits=DEDUP_BLOOM_BITS, bloom_hashes=DEDUP_BLOOM_HASHES, bloom_ttl=DEDUP_TTL):
+        self.keys_per_device = keys_per_device
+        self.max_devices = max_devices
+        self._devices = OrderedDict()  # device_id -> OrderedDict(key -> expires), least recently active first
+        self._bloom = BloomFilter(bloom_bits, bloom_hashes, bloom_ttl) if bloom_bits else None
+        self._lock = threading.Lock()
+
+    def is_duplicate(self, device_id, key, ttl, now=None):
+        """Record an event; True if the same event was already seen within its TTL"""
+        now = now or time.monotonic()
+        DEDUP_CHECKS.inc()
+        with self._lock:
+            window = self._devices.get(device_id)
+            if window is None:
+                window = self._devices[device_id] = OrderedDict()
+                if len(self._devices) > self.max_devices:
+                    self._devices.popitem(last=False)
+                DEDUP_DEVICES.set(len(self._devices))
+            else:
+                self._devices.move_to_end(device_id)
+
+            expires = window.get(key)
+            if expires is not None and expires > now:
+                window.move_to_end(key)  # the window is not extended by the duplicate
+            else:
+                window[key] = now + ttl
+                window.move_to_end(key)
+                if len(window) > self.keys_per_device:
+                    window.popitem(last=False)
+            # Untimed keys are only remembered for a short window, so they
+            # stay out of the Bloom filter, which holds keys for DEDUP_TTL
+            in_bloom = (self._bloom is not None and ttl >= DEDUP_TTL
+                        and self._bloom.check_and_add(key, now))
+
+        if expires is not None and expires > now:
+            DEDUP_HITS.inc('lru')
+            return True
+        if expires is None and in_bloom:
+            DEDUP_HITS.inc('bloom')
+            return True
+        return False
+
+
+DEDUPLICATOR = Deduplicator()
+
+
+def is_duplicate(device_id, kind, message, module=None, command_id=None, device_ts=None, batch_index=None):
+    key, ttl = event_key(device_id, kind, message, module, command_id, device_ts, batch_index)
+    return DEDUPLICATOR.is_duplicate(device_id, key, ttl)
@@ -0,0 +1,281 @@
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+from codec import ENCODING_TEXT
+from database import connect
+
+logger = logging.getLogger(__name__)
+
+# In-memory "digital twin" of every dispenser, keyed by serial number.
+# Written by MQTT ingest and by the REST write endpoints, read by the
+# status endpoints without touching SQLite.
+
+
+class ModuleShadow:
+    __slots__ = ('module_id', 'name', 'pills_left', 'threshold', 'pending')
+
+    def __init__(self, module_id, name, pills_left, threshold, pending):
+        self.module_id = module_id
+        self.name = name
+        self.pills_left = pills_left
+        self.threshold = threshold
+        self.pending = pending
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'pills_left': self.pills_left,
+            'threshold': self.threshold,
+            'pending': bool(self.pending)
+        }
+
+
+class DeviceShadow:
+    __slots__ = ('dispenser_id', 'serial_number', 'patient_id', 'modules',
+                 'last_status', 'last_alert', 'last_seen', 'encoding', 'dirty')
+
+    def __init__(self, dispenser_id, serial_number, patient_id):
+        self.dispenser_id = dispenser_id
+        self.serial_number = serial_number
+        self.patient_id = patient_id
+        self.modules = {}  # module_name -> ModuleShadow
+        self.last_status = None
+        self.last_alert = None
+        self.last_seen = None
+        self.encoding = ENCODING_TEXT  # negotiated payload encoding (codec.py)
+        self.dirty = False
+
+    def to_dict(self):
+        return {
+            'serial_number': self.serial_number,
+            'patient_id': self.patient_id,
+            'modules': [m.to_dict() for m in self.modules.values()],
+            'last_status': self.last_status,
+            'last_alert': self.last_alert,
+            'last_seen': self.last_seen
+        }
+
+
+_lock = threading.RLock()
+_by_serial = {}
+_by_patient = {}
+_loaded = False
+
+
+def load_shadows():
+    """Build the shadow registry from the database"""
+    global _loaded
+    conn = connect()
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+
+    c.execute('SELECT id, serial_number, patient_id FROM pill_dispenser')
+    shadows = {}
+    by_id = {}
+    for row in c.fetchall():
+        shadow = DeviceShadow(row['id'], row['serial_number'], row['patient_id'])
+        shadows[row['serial_number']] = shadow
+        by_id[row['id']] = shadow
+
+    c.execute('''
+        SELECT id, pill_dispenser_id, module_name, pills_left, threshold, pending
+        FROM dispenser_module
+    ''')
+    for row in c.fetchall():
+        shadow = by_id.get(row['pill_dispenser_id'])
+        if shadow is not None:
+            shadow.modules[row['module_name']] = ModuleShadow(
+                row['id'], row['module_name'], row['pills_left'],
+                row['threshold'], row['pending'])
+
+    c.execute('SELECT serial_number, last_status, last_alert, last_seen FROM device_shadow')
+    for row in c.fetchall():
+        shadow = shadows.get(row['serial_number'])
+        if shadow is not None:
+            shadow.last_status = row['last_status']
+            shadow.last_alert = row['last_alert']
+            shadow.last_seen = row['last_seen']
+    conn.close()
+
+    with _lock:
+        _by_serial.clear()
+        _by_serial.update(shadows)
+        _by_patient.clear()
+        _by_patient.update({s.patient_id: s for s in shadows.values() if s.patient_id is not None})
+        _loaded = True
+
+
+def _ensure_loaded():
+    if not _loaded:
+        load_shadows()
+
+
+def _get_or_create(serial_number):
+    shadow = _by_serial.get(serial_number)
+    if shadow is None:
+        # Device we have not seen in pill_dispenser yet (e.g. not provisioned)
+        shadow = DeviceShadow(None, serial_number, None)
+        _by_serial[serial_number] = shadow
+    return shadow
+
+
+def get_shadow(serial_number):
+    _ensure_loaded()
+    return _by_serial.get(serial_number)
+
+
+def get_shadow_for_patient(patient_id):
+    _ensure_loaded()
+    return _by_patient.get(patient_id)
+
+
+def assign_patient(serial_number, patient_id):
+    """Keep the patient -> device index in sync with assign_device"""
+    _ensure_loaded()
+    with _lock:
+        shadow = _by_serial.get(serial_number)
+        if shadow is None:
+            return
+        if shadow.patient_id is not None and _by_patient.get(shadow.patient_id) is shadow:
+            del _by_patient[shadow.patient_id]
+        previous = _by_patient.get(patient_id)
+        if previous is not None and previous is not shadow:
+            previous.patient_id = None
+        shadow.patient_id = patient_id
+        _by_patient[patient_id] = shadow
+
+
+def update_module(serial_number, module_name, **fields):
+    """Apply committed module changes (pills_left, threshold, pending)"""
+    _ensure_loaded()
+    with _lock:
+        shadow = _by_serial.get(serial_number)
+        if shadow is None:
+            return
+        module = shadow.modules.get(module_name)
+        if module is None:
+            return
+        for key, value in fields.items():
+            setattr(module, key, value)
+
+
+def record_status(serial_number, message):
+    _ensure_loaded()
+    with _lock:
+        shadow = _get_or_create(serial_number)
+        shadow.last_status = message
+        shadow.last_seen = datetime.now().isoformat()
+        shadow.dirty = True
+
+
+def record_alert(serial_number, message):
+    _ensure_loaded()
+    with _lock:
+        shadow = _get_or_create(serial_number)
+        shadow.last_alert = message
+        shadow.last_seen = datetime.now().isoformat()
+        shadow.dirty = True
+
+
+def set_encoding(serial_number, encoding):
+    """Remember the payload encoding negotiated with a device"""
+    _ensure_loaded()
+    with _lock:
+        _get_or_create(serial_number).encoding = encoding
+
+
+def get_encoding(serial_number):
+    shadow = get_shadow(serial_number)
+    return shadow.encoding if shadow else ENCODING_TEXT
+
+
+def serial_numbers():
+    _ensure_loaded()
+    with _lock:
+        return list(_by_serial)
+
+
+def refresh_shadows(serial_numbers):
+    """Reload last status/alert/seen for devices this process just took over.
+
+    Devices already updated locally since the handoff keep their newer state.
+    """
+    serial_numbers = list(serial_numbers)
+    if not serial_numbers:
+        return
+    conn = connect()
+    conn.row_factory = sqlite3.Row
+    rows = []
+    for start in range(0, len(serial_numbers), 500):
+        chunk = serial_numbers[start:start + 500]
+        rows += conn.execute(f'''
+            SELECT serial_number, last_status, last_alert, last_seen
+            FROM device_shadow
+            WHERE serial_number IN ({', '.join('?' * len(chunk))})
+        ''', chunk).fetchall()
+    conn.close()
+
+    with _lock:
+        for row in rows:
+            shadow = _by_serial.get(row['serial_number'])
+            if shadow is not None and not shadow.dirty:
+                shadow.last_status = row['last_status']
+                shadow.last_alert = row['last_alert']
+                shadow.last_seen = row['last_seen']
+
+
+def fleet_summary():
+    """Per-device status plus fleet totals, straight from memory"""
+    _ensure_loaded()
+    with _lock:
+        devices = []
+        low_modules = 0
+        pending_modules = 0
+        for shadow in _by_serial.values():
+            low = [m.name for m in shadow.modules.values()
+                   if m.pills_left is not None and m.threshold is not None
+                   and m.pills_left <= m.threshold]
+            pending = [m.name for m in shadow.modules.values() if m.pending]
+            low_modules += len(low)
+            pending_modules += len(pending)
+            devices.append({
+                'serial_number': shadow.serial_number,
+                'patient_id': shadow.patient_id,
+                'low_modules': low,
+                'pending_modules': pending,
+                'last_status': shadow.last_status,
+                'last_seen': shadow.last_seen
+            })
+    return {
+        'device_count': len(devices),
+        'low_modules': low_modules,
+        'pending_modules': pending_modules,
+        'devices': devices
+    }
+
+
+def checkpoint_shadows():
+    """Persist fields only the shadow knows about (last status/alert/seen)"""
+    with _lock:
+        rows = []
+        for shadow in _by_serial.values():
+            if shadow.dirty:
+                rows.append((shadow.serial_number, shadow.last_status,
+                              shadow.last_alert, shadow.last_seen))
+                shadow.dirty = False
+    if not rows:
+        return 0
+
+    conn = connect()
+    conn.executemany('''
+        INSERT INTO device_shadow (serial_number, last_status, last_alert, last_seen)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(serial_number) DO UPDATE SET
+            last_status = excluded.last_status,
+            last_alert = excluded.last_alert,
+            last_seen = excluded.last_seen
+    ''', rows)
+    conn.commit()
+    conn.close()
+    return len(rows)
@@ -0,0 +1,289 @@
+import bisect
+import json
+import logging
+import mmap
+import os
+import sys
+import threading
+import zlib
+from array import array
+from datetime import datetime, timedelta
+from config import EVENT_SEGMENT_DIR, EVENT_SEGMENT_MIN_AGE_DAYS, EVENT_SEGMENT_MAX_ROWS
+from database import connect
+
+logger = logging.getLogger(__name__)
+
+# Cold event history. Events older than EVENT_SEGMENT_MIN_AGE_DAYS are
+# sealed out of the logs table into immutable columnar segment files; the
+# event_segment table (database.py) is the per-segment min/max index used
+# to skip files. The newest event of each module always stays in logs,
+# so "last event" lookups (dashboard, get_logs) never need the segments.
+#
+# Segment file layout (native little-endian, every column 8-byte aligned):
+#     b"PILLSEG1" <uint32 header length> <JSON header>
+#     id        int64   logs.id
+#     ts        int64   epoch microseconds
+#     device    int32   pill_dispenser.id (-1 if unknown)
+#     module    int32   dispenser_module.id (-1 if unknown)
+#     kind      uint8   index into EVENT_KINDS
+#     message   uint32  index into the message dictionary
+#     <zlib-compressed JSON list of distinct messages>
+# Rows are sorted by (device, ts, id), so one device's time range is two
+# binary searches over memory-mapped columns, without copying them.
+
+MAGIC = b"PILLSEG1"
+
+EVENT_KINDS = ('other', 'dispensed', 'taken', 'not_taken', 'low', 'empty', 'refill', 'command')
+
+# (column, array typecode) in file order
+COLUMNS = (('id', 'q'), ('ts', 'q'), ('device', 'i'), ('module', 'i'), ('kind', 'B'), ('message', 'I'))
+
+
+def event_kind(message):
+    """'module1: Pill NOT taken' -> 'not_taken' (coarse kind for analytics)"""
+    text = message.lower() if message else ''
+    if 'not taken' in text:
+        return 'not_taken'
+    if 'taken' in text:
+        return 'taken'
+    if 'dispensed' in text:
+        return 'dispensed'
+    if 'pills low' in text:
+        return 'low'
+    if 'empty' in text:
+        return 'empty'
+    if 'refill' in text:
+        return 'refill'
+    if 'command sent' in text or text.startswith('ack'):
+        return 'command'
+    return 'other'
+
+
+def to_micros(timestamp):
+    try:
+        return int(datetime.fromisoformat(timestamp).timestamp() * 1_000_000)
+    except (TypeError, ValueError):
+        return 0
+
+
+def from_micros(micros):
+    return datetime.fromtimestamp(micros / 1_000_000).isoformat()
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def write_segment(path, rows):
+    """Write (id, ts_micros, device, module, message) rows as a segment file"""
+    rows = sorted(rows, key=lambda row: (row[2], row[1], row[0]))
+    codes = {}
+    columns = {name: array(code) for name, code in COLUMNS}
+    for log_id, ts, device, module, message in rows:
+        columns['id'].append(log_id)
+        columns['ts'].append(ts)
+        columns['device'].append(device)
+        columns['module'].append(module)
+        columns['kind'].append(EVENT_KINDS.index(event_kind(message)))
+        columns['message'].append(codes.setdefault(message, len(codes)))
+    messages = zlib.compress(json.dumps(list(codes), ensure_ascii=False).encode())
+
+    # Offsets depend on the header length, which depends on the offsets;
+    # reserve room for them with a fixed-width placeholder pass
+    header = {'rows': len(rows), 'columns': {}, 'messages': [0, len(messages)]}
+    size = len(json.dumps(header)) + 40 * (len(COLUMNS) + 1)
+    offset = _align(len(MAGIC) + 4 + size)
+    for name, code in COLUMNS:
+        header['columns'][name] = [offset, code]
+        offset = _align(offset + len(columns[name]) * columns[name].itemsize)
+    header['messages'][0] = offset
+    encoded = json.dumps(header).encode().ljust(size)
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC + len(encoded).to_bytes(4, 'little') + encoded)
+        for name, _ in COLUMNS:
+            f.seek(header['columns'][name][0])
+            columns[name].tofile(f)
+        f.seek(header['messages'][0])
+        f.write(messages)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class EventSegment:
+    """Read-only, memory-mapped view of one segment file"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not an event segment")
+        length = int.from_bytes(self._map[len(MAGIC):len(MAGIC) + 4], 'little')
+        start = len(MAGIC) + 4
+        header = json.loads(bytes(self._map[start:start + length]))
+
+        self.rows = header['rows']
+        view = memoryview(self._map)
+        self.columns = {}
+        for name, (offset, code) in header['columns'].items():
+            itemsize = array(code).itemsize
+            self.columns[name] = view[offset:offset + self.rows * itemsize].cast(code)
+        self._messages_at = header['messages']
+        self._messages = None
+
+    def messages(self):
+        if self._messages is None:
+            offset, length = self._messages_at
+            self._messages = json.loads(zlib.decompress(self._map[offset:offset + length]))
+        return self._messages
+
+    def select(self, device, start=None, end=None):
+        """Row range [lo, hi) for one device within [start, end) epoch microseconds"""
+        devices, ts = self.columns['device'], self.columns['ts']
+        lo = bisect.bisect_left(devices, device)
+        hi = bisect.bisect_right(devices, device, lo)
+        if start is not None:
+            lo = bisect.bisect_left(ts, start, lo, hi)
+        if end is not None:
+            hi = bisect.bisect_left(ts, end, lo, hi)
+        return lo, hi
+
+    def kind_counts(self, lo, hi):
+        counts = [0] * len(EVENT_KINDS)
+        for kind in self.columns['kind'][lo:hi]:
+            counts[kind] += 1
+        return counts
+
+    def events(self, lo, hi):
+        """(id, ts_micros, module, message) tuples for a row range"""
+        messages = self.messages()
+        c = self.columns
+        return [(c['id'][i], c['ts'][i], c['module'][i], messages[c['message'][i]]) for i in range(lo, hi)]
+
+
+_segments = {}
+_segments_lock = threading.Lock()
+
+
+def open_segment(name):
+    """Segments are immutable, so each file is mapped once per process"""
+    with _segments_lock:
+        segment = _segments.get(name)
+        if segment is None:
+            segment = EventSegment(os.path.join(EVENT_SEGMENT_DIR, name))
+            _segments[name] = segment
+        return segment
+
+
+def seal_events(min_age_days=EVENT_SEGMENT_MIN_AGE_DAYS, max_rows=EVENT_SEGMENT_MAX_ROWS):
+    """Move events older than `min_age_days` from logs into new segments.
+
+    Returns the number of events sealed.
+    """
+    if sys.byteorder != 'little':
+        raise RuntimeError("event segments are little-endian only")
+    os.makedirs(EVENT_SEGMENT_DIR, exist_ok=True)
+    cutoff = (datetime.now() - timedelta(days=min_age_days)).isoformat()
+    sealed = 0
+    while True:
+        conn = connect()
+        rows = conn.execute('''
+            SELECT l.id, l.timestamp, dm.pill_dispenser_id, l.dispenser_module_id, l.message
+            FROM logs l
+            LEFT JOIN dispenser_module dm ON dm.id = l.dispenser_module_id
+            WHERE l.timestamp < ?
+              AND l.id NOT IN (SELECT MAX(id) FROM logs GROUP BY dispenser_module_id)
+            ORDER BY l.id
+            LIMIT ?
+        ''', (cutoff, max_rows)).fetchall()
+        if not rows:
+            conn.close()
+            return sealed
+
+        rows = [(log_id, to_micros(ts), device if device is not None else -1,
+                 module if module is not None else -1, message or '')
+                for log_id, ts, device, module, message in rows]
+        min_id, max_id = rows[0][0], rows[-1][0]
+        name = f"events_{min_id:012d}_{max_id:012d}.seg"
+        # A crash before the commit below leaves an unindexed file that the
+        # next run overwrites; readers only see files listed in event_segment
+        write_segment(os.path.join(EVENT_SEGMENT_DIR, name), rows)
+
+        # Delete by id: the newest row of each module was skipped, so the
+        # range [min_id, max_id] may still hold rows that stay in logs
+        conn.execute('''
+            INSERT INTO event_segment (file, rows, min_id, max_id, min_ts, max_ts,
+                                       min_device, max_device, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (name, len(rows), min_id, max_id,
+              min(r[1] for r in rows), max(r[1] for r in rows),
+              min(r[2] for r in rows), max(r[2] for r in rows), datetime.now().isoformat()))
+        conn.execute('DELETE FROM logs WHERE id IN (SELECT value FROM json_each(?))',
+                     (json.dumps([r[0] for r in rows]),))
+        conn.commit()
+        conn.close()
+        sealed += len(rows)
+        logger.info("events sealed", extra={'fields': {'file': name, 'rows': len(rows)}})
+
+
+def _segments_for(c, dispenser_id, start, end):
+    c.execute('''
+        SELECT file FROM event_segment
+        WHERE min_device <= ? AND max_device >= ?
+          AND max_ts >= ? AND min_ts < ?
+        ORDER BY min_id
+    ''', (dispenser_id, dispenser_id,
+          start if start is not None else -2 ** 63, end if end is not None else 2 ** 63 - 1))
+    return [open_segment(row[0]) for row in c.fetchall()]
+
+
+def device_history(c, dispenser_id, start=None, end=None, limit=500):
+    """Events for one dispenser in [start, end) (ISO strings), newest first.
+
+    Returns (events, kind_counts); kind_counts covers the whole range, not just
+    the `limit` newest events. Sealed events come from the segment files,
+    recent ones from the logs table.
+    """
+    start_us = to_micros(start) if start else None
+    end_us = to_micros(end) if end else None
+
+    c.execute('SELECT id, module_name FROM dispenser_module WHERE pill_dispenser_id = ?', (dispenser_id,))
+    module_names = {row[0]: row[1] for row in c.fetchall()}
+
+    counts = [0] * len(EVENT_KINDS)
+    events = []
+    for segment in _segments_for(c, dispenser_id, start_us, end_us):
+        lo, hi = segment.select(dispenser_id, start_us, end_us)
+        for kind, count in enumerate(segment.kind_counts(lo, hi)):
+            counts[kind] += count
+        # Rows are in time order, so only the newest `limit` can be returned
+        for log_id, ts, module, message in segment.events(max(lo, hi - limit), hi):
+            events.append((ts, log_id, module_names.get(module), message))
+
+    where = f'''
+        FROM logs l
+        JOIN dispenser_module dm ON dm.id = l.dispenser_module_id
+        WHERE dm.pill_dispenser_id = ?
+          {'AND l.timestamp >= ?' if start else ''}
+          {'AND l.timestamp < ?' if end else ''}
+    '''
+    params = [dispenser_id] + [v for v in (start, end) if v]
+    # Counts over the whole range, but only the newest `limit` rows leave SQLite
+    c.execute(f'SELECT l.message, COUNT(*) {where} GROUP BY l.message', params)
+    for message, count in c.fetchall():
+        counts[EVENT_KINDS.index(event_kind(message))] += count
+    c.execute(f'''
+        SELECT l.id, l.timestamp, dm.module_name, l.message {where}
+        ORDER BY l.timestamp DESC, l.id DESC
+        LIMIT ?
+    ''', params + [limit])
+    for log_id, timestamp, module, message in c.fetchall():
+        events.append((to_micros(timestamp), log_id, module, message))
+
+    events.sort(reverse=True)
+    return ([{'id': log_id, 'timestamp': from_micros(ts), 'module': module,
+              'message': message, 'kind': event_kind(message)}
+             for ts, log_id, module, message in events[:limit]],
+            {kind: count for kind, count in zip(EVENT_KINDS, counts) if count})
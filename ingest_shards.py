@@ -0,0 +1,242 @@
+import argparse
+import atexit
+import hashlib
+import json
+import logging
+import threading
+import time
+import paho.mqtt.client as mqtt
+from config import (MQTT_BROKER, MQTT_PORT, INGEST_NODE_ID, INGEST_MEMBERS_TOPIC,
+                    INGEST_HEARTBEAT_INTERVAL, INGEST_MEMBER_TIMEOUT, INGEST_HANDOFF_DELAY,
+                    TRAFFIC_RECORD_FILE)
+import device_shadow
+import presence
+import mqtt_handler
+import mqtt_publisher
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# MQTT ingest split across processes/nodes by device serial.
+#
+# Every ingest node subscribes to the usual pill/+/... topics but only
+# handles devices it owns; the owner of a serial is chosen by rendezvous
+# hashing over the live members, so adding or removing a node only moves
+# that node's share of the fleet. Shared subscriptions ($share/...) are not
+# used: the broker would spread a device's messages over all nodes, and
+# each node keeps the in-memory shadow of the devices it owns.
+#
+# Membership: each node publishes a retained heartbeat on
+# pill/_ingest/members/{node_id} and registers an empty retained last will
+# on the same topic, so crashed nodes disappear when the broker notices
+# and hung ones after INGEST_MEMBER_TIMEOUT.
+#
+# Only SQLite is shared. The shadow, command tracking, digests and live
+# presence stay in the owner's memory, so the REST API must run inside a
+# node (main.py) and only answers for the devices that node owns; an API
+# process without a shard never sees device replies (mqtt_topics.md).
+
+INGEST_MEMBERS = REGISTRY.gauge(
+    'ingest_shard_members', 'Live ingest nodes seen by this node')
+INGEST_OWNED_DEVICES = REGISTRY.gauge(
+    'ingest_shard_owned_devices', 'Known devices owned by this ingest node')
+INGEST_NOT_OWNED = REGISTRY.counter(
+    'ingest_messages_not_owned_total', 'MQTT messages skipped because another node owns the device')
+INGEST_REBALANCES = REGISTRY.counter(
+    'ingest_rebalances_total', 'Membership changes that moved device ownership')
+
+
+def shard_weight(node_id, serial_number):
+    # Stable across processes (unlike hash(), which is salted per process)
+    return hashlib.blake2b(f"{node_id}/{serial_number}".encode(), digest_size=8).digest()
+
+
+def owner(serial_number, members):
+    """Rendezvous hashing: the member with the highest weight owns the device"""
+    return max(members, key=lambda node_id: shard_weight(node_id, serial_number))
+
+
+class ShardMembership:
+    """Live ingest nodes and which devices this node owns"""
+
+    def __init__(self, node_id, timeout=INGEST_MEMBER_TIMEOUT):
+        self.node_id = node_id
+        self.timeout = timeout
+        self._seen = {node_id: time.monotonic()}  # node_id -> last heartbeat
+        self._members = (node_id,)
+        self._owned = {}  # serial -> bool, cleared whenever membership changes
+        self._lock = threading.Lock()
+
+    def members(self):
+        return self._members
+
+    def owns(self, serial_number):
+        # Under the lock, so an answer computed from the old members is
+        # never cached in the dict _update() just replaced
+        with self._lock:
+            owned = self._owned.get(serial_number)
+            if owned is None:
+                owned = owner(serial_number, self._members) == self.node_id
+                self._owned[serial_number] = owned
+            return owned
+
+    def heard(self, node_id, alive=True):
+        """Record a heartbeat (or a leave); returns the previous members if they changed"""
+        with self._lock:
+            if alive:
+                joined = node_id not in self._seen
+                self._seen[node_id] = time.monotonic()
+                return self._update() if joined else None
+            if node_id == self.node_id or node_id not in self._seen:
+                return None
+            del self._seen[node_id]
+            return self._update()
+
+    def expire(self):
+        """Drop nodes whose heartbeats stopped; returns the previous members if any were dropped"""
+        cutoff = time.monotonic() - self.timeout
+        with self._lock:
+            self._seen[self.node_id] = time.monotonic()
+            stale = [node_id for node_id, seen in self._seen.items() if seen < cutoff]
+            for node_id in stale:
+                del self._seen[node_id]
+            return self._update() if stale else None
+
+    def _update(self):
+        previous = self._members
+        self._members = tuple(sorted(self._seen))
+        self._owned = {}
+        INGEST_MEMBERS.set(len(self._members))
+        return previous
+
+
+class ShardedIngest:
+    """One ingest node: an MQTT client that only handles the devices it owns"""
+
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.membership = ShardMembership(node_id)
+        self.member_topic = f"{INGEST_MEMBERS_TOPIC}/{node_id}"
+        self.client = mqtt.Client(client_id=f"pill-ingest-{node_id}")
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        self.client.will_set(self.member_topic, b'', qos=1, retain=True)
+        self._stop = threading.Event()
+
+    def start(self, host=MQTT_BROKER, port=MQTT_PORT):
+        INGEST_MEMBERS.set(1)
+        INGEST_OWNED_DEVICES.set(len(device_shadow.serial_numbers()))
+        self.client.connect(host, port, 60)
+        self.client.loop_start()
+        threading.Thread(target=self._heartbeat, name="ingest-heartbeat", daemon=True).start()
+        return self
+
+    def stop(self):
+        """Leave the group: hand state over, clear our heartbeat and disconnect"""
+        self._stop.set()
+        device_shadow.checkpoint_shadows()
+        self.client.publish(self.member_topic, b'', qos=1, retain=True).wait_for_publish()
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def announce(self):
+        heartbeat = json.dumps({'node': self.node_id, 'ts': time.time()})
+        self.client.publish(self.member_topic, heartbeat, qos=1, retain=True)
+
+    def on_connect(self, client, userdata, flags, rc):
+        mqtt_handler.on_connect(client, userdata, flags, rc)
+        client.subscribe(f"{INGEST_MEMBERS_TOPIC}/+", qos=1)
+        self.announce()
+
+    def on_message(self, client, userdata, msg):
+        if msg.topic.startswith(INGEST_MEMBERS_TOPIC + '/'):
+            self.handle_member(msg)
+            return
+        if not self.membership.owns(mqtt_handler.device_id_from_topic(msg.topic)):
+            INGEST_NOT_OWNED.inc()
+            return
+        mqtt_handler.on_message(client, userdata, msg)
+
+    def handle_member(self, msg):
+        node_id = msg.topic[len(INGEST_MEMBERS_TOPIC) + 1:]
+        previous = self.membership.heard(node_id, alive=bool(msg.payload))
+        if previous is not None:
+            self.rebalance(previous)
+
+    def rebalance(self, previous):
+        members = self.membership.members()
+        serials = device_shadow.serial_numbers()
+        owned = [s for s in serials if self.membership.owns(s)]
+        gained = [s for s in owned if owner(s, previous) != self.node_id]
+        INGEST_REBALANCES.inc()
+        INGEST_OWNED_DEVICES.set(len(owned))
+        logger.info("ingest shards rebalanced", extra={'fields': {
+            'node': self.node_id, 'members': list(members), 'owned': len(owned), 'gained': len(gained)}})
+
+        # Persist what we know so the new owners of our former devices can load it,
+        # then (once they have done the same) load the state of the devices we gained
+        device_shadow.checkpoint_shadows()
+        presence.retain(self.membership.owns)  # the new owners track the devices we lost
+        if gained:
+            timer = threading.Timer(INGEST_HANDOFF_DELAY, self._load_gained, (gained,))
+            timer.daemon = True
+            timer.start()
+
+    def _load_gained(self, gained):
+        try:
+            gained = [s for s in gained if self.membership.owns(s)]
+            device_shadow.refresh_shadows(gained)
+            presence.refresh_presence(gained)
+        except Exception:
+            logger.exception("loading state for gained devices failed")
+
+    def _heartbeat(self):
+        while not self._stop.wait(INGEST_HEARTBEAT_INTERVAL):
+            try:
+                self.announce()
+                previous = self.membership.expire()
+                if previous is not None:
+                    self.rebalance(previous)
+            except Exception:
+                logger.exception("ingest heartbeat failed")
+
+
+def start_sharded_listener(node_id=INGEST_NODE_ID):
+    return ShardedIngest(node_id).start()
+
+
+if __name__ == "__main__":
+    from logging_setup import setup_logging
+    from database import init_db
+    from traffic_recorder import start_recording
+    from scheduler import SCHEDULER
+    from config import (SHADOW_CHECKPOINT_INTERVAL, PRESENCE_SWEEP_INTERVAL, COMMAND_QUEUE_PURGE_INTERVAL,
+                        COMMAND_QUEUE_RETRY_INTERVAL, DIGEST_CHECK_INTERVAL, COMMAND_EXPIRE_INTERVAL)
+    from command_tracker import expire_commands
+    from notification_digest import flush_digests
+
+    parser = argparse.ArgumentParser(description="Run one MQTT ingest shard (no REST API)")
+    parser.add_argument('--node', default=INGEST_NODE_ID, required=INGEST_NODE_ID is None,
+                        help='unique node name (default: $PILL_INGEST_NODE)')
+    args = parser.parse_args()
+
+    setup_logging()
+    init_db()
+    if TRAFFIC_RECORD_FILE:
+        start_recording(TRAFFIC_RECORD_FILE)
+    device_shadow.load_shadows()
+    SCHEDULER.add_job('shadow-checkpoint', device_shadow.checkpoint_shadows, every=SHADOW_CHECKPOINT_INTERVAL)
+    SCHEDULER.add_job('presence-sweep', presence.sweep_presence, every=PRESENCE_SWEEP_INTERVAL)
+    SCHEDULER.add_job('command-queue-purge', mqtt_publisher.purge_queue, every=COMMAND_QUEUE_PURGE_INTERVAL)
+    SCHEDULER.add_job('command-queue-retry', mqtt_publisher.retry_queue, every=COMMAND_QUEUE_RETRY_INTERVAL)
+    SCHEDULER.add_job('command-expiry', expire_commands, every=COMMAND_EXPIRE_INTERVAL)
+    # Alerts of owned devices are collected here, so their digests are sent from here too
+    SCHEDULER.add_job('notification-digest', flush_digests, every=DIGEST_CHECK_INTERVAL)
+    atexit.register(flush_digests, force=True)
+    SCHEDULER.start()
+    mqtt_publisher.start_drain_workers()
+    ingest = start_sharded_listener(args.node)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        ingest.stop()
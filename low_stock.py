@@ -0,0 +1,125 @@
+import logging
+import notification_digest
+
+logger = logging.getLogger(__name__)
+
+# Low-stock detection at write time. Triggers on dispenser_module record a
+# stock_transition row whenever pills_left crosses threshold (either way),
+# so each crossing is stored exactly once no matter which code path wrote
+# it. Writers call dispatch_transitions() after committing to turn new
+# transitions into (digested) alerts; a partial index keeps that a lookup of
+# the few undelivered rows. "Modules at or below threshold" is served by
+# the partial index idx_module_low.
+
+_IS_LOW = "{row}.pills_left <= {row}.threshold"
+_WAS_NOT_LOW = "({row}.pills_left IS NULL OR {row}.threshold IS NULL OR {row}.pills_left > {row}.threshold)"
+_NOW = "strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime')"
+
+
+def _record(state):
+    return (f"INSERT INTO stock_transition (dispenser_module_id, state, pills_left, threshold, created_at) "
+            f"VALUES (new.id, '{state}', new.pills_left, new.threshold, {_NOW});")
+
+
+def init_low_stock(c):
+    """Create the transition table, triggers and indexes"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS stock_transition (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dispenser_module_id INTEGER NOT NULL,
+            state TEXT NOT NULL CHECK(state IN ('low', 'ok')),
+            pills_left INTEGER,
+            threshold INTEGER,
+            created_at TEXT NOT NULL,
+            notified INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (dispenser_module_id) REFERENCES dispenser_module(id)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_stock_transition_module '
+              'ON stock_transition(dispenser_module_id, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_stock_transition_pending '
+              'ON stock_transition(id) WHERE notified = 0')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_module_low '
+              'ON dispenser_module(pill_dispenser_id) WHERE pills_left <= threshold')
+
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS dispenser_module_stock_insert
+        AFTER INSERT ON dispenser_module
+        WHEN {_IS_LOW.format(row='new')}
+        BEGIN {_record('low')} END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS dispenser_module_stock_low
+        AFTER UPDATE OF pills_left, threshold ON dispenser_module
+        WHEN {_IS_LOW.format(row='new')} AND {_WAS_NOT_LOW.format(row='old')}
+        BEGIN {_record('low')} END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS dispenser_module_stock_ok
+        AFTER UPDATE OF pills_left, threshold ON dispenser_module
+        WHEN {_IS_LOW.format(row='old')} AND {_WAS_NOT_LOW.format(row='new')}
+        BEGIN {_record('ok')} END
+    ''')
+
+    # Modules already low before the triggers existed get their current
+    # state recorded once, without notifying about old news
+    c.execute(f'''
+        INSERT INTO stock_transition (dispenser_module_id, state, pills_left, threshold, created_at, notified)
+        SELECT dm.id, 'low', dm.pills_left, dm.threshold, {_NOW}, 1
+        FROM dispenser_module dm
+        WHERE dm.pills_left <= dm.threshold
+          AND NOT EXISTS (SELECT 1 FROM stock_transition st WHERE st.dispenser_module_id = dm.id)
+    ''')
+
+
+def dispatch_transitions(conn):
+    """Claim undelivered transitions and send notifications; returns how many"""
+    c = conn.cursor()
+    # Claiming in one UPDATE means concurrent writers never notify twice
+    c.execute('''
+        UPDATE stock_transition SET notified = 1
+        WHERE notified = 0
+        RETURNING id
+    ''')
+    ids = [row[0] for row in c.fetchall()]
+    conn.commit()
+    if not ids:
+        return 0
+
+    c.execute(f'''
+        SELECT st.state, st.pills_left, st.threshold, dm.module_name, pd.serial_number
+        FROM stock_transition st
+        JOIN dispenser_module dm ON dm.id = st.dispenser_module_id
+        LEFT JOIN pill_dispenser pd ON pd.id = dm.pill_dispenser_id
+        WHERE st.id IN ({', '.join('?' * len(ids))})
+        ORDER BY st.id
+    ''', ids)
+    for state, pills_left, threshold, module_name, serial_number in c.fetchall():
+        if state == 'low':
+            notification_digest.alert(serial_number, module_name,
+                                      f"Pills low ({pills_left} left, threshold {threshold})")
+        else:
+            logger.info("module restocked", extra={'fields': {
+                'device_id': serial_number, 'module': module_name, 'pills_left': pills_left}})
+    return len(ids)
+
+
+def low_modules(c):
+    """Every module at or below its threshold (served by idx_module_low)"""
+    c.execute('''
+        SELECT pd.serial_number, pd.patient_id, dm.module_name, dm.pills_left, dm.threshold,
+               (SELECT MAX(st.created_at) FROM stock_transition st
+                WHERE st.dispenser_module_id = dm.id AND st.state = 'low') AS low_since
+        FROM dispenser_module dm
+        JOIN pill_dispenser pd ON pd.id = dm.pill_dispenser_id
+        WHERE dm.pills_left <= dm.threshold
+        ORDER BY pd.serial_number, dm.module_name
+    ''')
+    return [{
+        'serial_number': row[0],
+        'patient_id': row[1],
+        'module': row[2],
+        'pills_left': row[3],
+        'threshold': row[4],
+        'low_since': row[5]
+    } for row in c.fetchall()]
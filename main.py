@@ -1,7 +1,27 @@
+import atexit
+import logging
+from logging_setup import setup_logging
 from api_server import start_api
 from mqtt_handler import start_mqtt_listener
-from database import init_db
+from ingest_shards import start_sharded_listener
+from config import (INGEST_NODE_ID, TRAFFIC_RECORD_FILE, SHADOW_CHECKPOINT_INTERVAL,
+                    IDEMPOTENCY_PURGE_INTERVAL, EVENT_SEAL_INTERVAL, DIGEST_CHECK_INTERVAL,
+                    REFILL_REPORT_CRON, PRESENCE_SWEEP_INTERVAL, COMMAND_QUEUE_PURGE_INTERVAL,
+                    COMMAND_QUEUE_RETRY_INTERVAL, COMMAND_EXPIRE_INTERVAL)
+from traffic_recorder import start_recording
+from scheduler import SCHEDULER
+from database import init_db, purge_idempotency_keys
+from device_shadow import load_shadows, checkpoint_shadows
+from event_segments import seal_events
+from notification_digest import flush_digests
+from refill_report import generate_refill_report, report_missing
+from presence import sweep_presence
+from command_tracker import expire_commands
+from reference_cache import load_reference_data
 from mqtt_publisher import (
+   start_drain_workers,
+   purge_queue,
+   retry_queue,
    send_dispense_command,
    send_refill_command,
    set_hard_mode,
@@ -11,10 +31,38 @@ from mqtt_publisher import (
 import time
 # from api_server import start_api  # Optional if REST needed
 
+
+def schedule_maintenance():
+    """Register the periodic maintenance jobs; they run on the scheduler's worker pool"""
+    SCHEDULER.add_job('shadow-checkpoint', checkpoint_shadows, every=SHADOW_CHECKPOINT_INTERVAL)
+    SCHEDULER.add_job('idempotency-purge', purge_idempotency_keys, every=IDEMPOTENCY_PURGE_INTERVAL)
+    SCHEDULER.add_job('event-seal', seal_events, every=EVENT_SEAL_INTERVAL)
+    SCHEDULER.add_job('notification-digest', flush_digests, every=DIGEST_CHECK_INTERVAL)
+    # Catch up at startup if today's report is missing
+    SCHEDULER.add_job('refill-report', generate_refill_report, cron=REFILL_REPORT_CRON,
+                      run_at_start=report_missing())
+    SCHEDULER.add_job('presence-sweep', sweep_presence, every=PRESENCE_SWEEP_INTERVAL)
+    SCHEDULER.add_job('command-queue-purge', purge_queue, every=COMMAND_QUEUE_PURGE_INTERVAL)
+    SCHEDULER.add_job('command-queue-retry', retry_queue, every=COMMAND_QUEUE_RETRY_INTERVAL)
+    # Timeouts count towards device latency even if nobody looks the command up
+    SCHEDULER.add_job('command-expiry', expire_commands, every=COMMAND_EXPIRE_INTERVAL)
+    atexit.register(flush_digests, force=True)
+
 if __name__ == "__main__":
-    print("Starting Pill Server...")
+    setup_logging()
+    logging.getLogger("main").info("starting pill server")
     init_db()
-    start_mqtt_listener()
+    load_shadows()
+    load_reference_data()
+    schedule_maintenance()
+    SCHEDULER.start()
+    start_drain_workers()
+    if TRAFFIC_RECORD_FILE:
+        start_recording(TRAFFIC_RECORD_FILE)
+    if INGEST_NODE_ID:
+        start_sharded_listener(INGEST_NODE_ID)
+    else:
+        start_mqtt_listener()
     start_api()  
     
     # time.sleep(10)
@@ -0,0 +1,173 @@
+import bisect
+import threading
+
+# Minimal process-wide metrics registry rendered in the Prometheus text
+# exposition format at /metrics. Recording is a dict lookup plus a couple
+# of additions under a per-metric lock, cheap enough to leave on.
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, labels, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [0] * (len(self.buckets) + 3)
+            state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(labels, list(state)) for labels, state in self._values.items()]
+        for labels, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), state):
+                cumulative += count
+                yield (f'{self.name}_bucket',
+                       _format_labels(self.labelnames, labels, f'le="{_format_value(bound)}"'),
+                       cumulative)
+            yield f'{self.name}_sum', _format_labels(self.labelnames, labels), state[-2]
+            yield f'{self.name}_count', _format_labels(self.labelnames, labels), state[-1]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# HTTP
+HTTP_REQUESTS = REGISTRY.counter(
+    'http_requests_total', 'REST requests by route and status code', ('method', 'route', 'status'))
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    'http_request_duration_seconds', 'REST request latency by route', ('method', 'route'))
+
+# MQTT ingest
+MQTT_MESSAGES = REGISTRY.counter(
+    'mqtt_messages_total', 'MQTT messages received by topic kind', ('topic',))
+MQTT_INGEST_SECONDS = REGISTRY.histogram(
+    'mqtt_ingest_duration_seconds', 'Time spent in on_message by topic kind', ('topic',))
+MQTT_INGEST_LAG_SECONDS = REGISTRY.histogram(
+    'mqtt_ingest_lag_seconds', 'Time from receipt by the MQTT client to processed')
+
+# MQTT publish
+MQTT_PUBLISH_INFLIGHT = REGISTRY.gauge(
+    'mqtt_publish_inflight', 'MQTT publishes currently holding a broker connection')
+MQTT_PUBLISH_SECONDS = REGISTRY.histogram(
+    'mqtt_publish_duration_seconds', 'Connect + publish + flush time by message kind', ('kind',))
+MQTT_PUBLISH_ERRORS = REGISTRY.counter(
+    'mqtt_publish_errors_total', 'Failed MQTT publishes by message kind', ('kind',))
+COMMANDS_QUEUED = REGISTRY.counter(
+    'commands_queued_total', 'Messages queued for offline devices by kind', ('kind',))
+COMMANDS_DEQUEUED = REGISTRY.counter(
+    'commands_dequeued_total', 'Queued messages leaving the queue by outcome', ('outcome',))
+
+# Admission control
+HTTP_REJECTED = REGISTRY.counter(
+    'http_rejected_total', 'Command requests rejected by admission control', ('reason',))
+
+# SQLite
+DB_QUERY_SECONDS = REGISTRY.histogram(
+    'sqlite_query_duration_seconds', 'SQLite statement execution time by statement type', ('statement',))
+DB_COMMIT_SECONDS = REGISTRY.histogram(
+    'sqlite_commit_duration_seconds', 'SQLite commit time')
+
+
+def topic_kind(topic):
+    """'pill/SN1/schedule/status' -> 'schedule/status' (keeps label cardinality low)"""
+    parts = topic.split('/', 2)
+    return parts[2] if len(parts) == 3 else topic
+
+
+def statement_kind(sql):
+    return sql.lstrip()[:6].rstrip().upper()
@@ -1,43 +1,139 @@
+import logging
+import time
 import paho.mqtt.client as mqtt
-from config import MQTT_BROKER, MQTT_PORT, DEVICE_TOPIC_WITH_HARDCODED_DEVICE_ID
-from database import log_event
-from notifier import send_notification
+from config import MQTT_BROKER, MQTT_PORT, DEDUP_ENABLED
+from database import log_event, log_events
+import notification_digest
+import device_shadow
+import command_tracker
+import codec
+import presence
+import mqtt_publisher
+import traffic_recorder
+import dedup
+from utils import normalize_timestamp
+from metrics import MQTT_MESSAGES, MQTT_INGEST_SECONDS, MQTT_INGEST_LAG_SECONDS, topic_kind
 
-# Derived topics
-STATUS_TOPIC = f"{DEVICE_TOPIC_WITH_HARDCODED_DEVICE_ID}/status"
-SCHEDULE_STATUS_TOPIC = f"{DEVICE_TOPIC_WITH_HARDCODED_DEVICE_ID}/schedule/status"
-SETTINGS_STATUS_TOPIC = f"{DEVICE_TOPIC_WITH_HARDCODED_DEVICE_ID}/settings/status"
-ALERTS_TOPIC = f"{DEVICE_TOPIC_WITH_HARDCODED_DEVICE_ID}/alerts"
+logger = logging.getLogger(__name__)
+# Every received payload; high volume, sampled via LOG_SAMPLE_RATES
+message_logger = logging.getLogger("mqtt.messages")
+
+# Derived topics (any device: pill/{device_id}/...)
+STATUS_TOPIC = "pill/+/status"
+STATUS_BATCH_TOPIC = "pill/+/status/batch"
+SCHEDULE_STATUS_TOPIC = "pill/+/schedule/status"
+SETTINGS_STATUS_TOPIC = "pill/+/settings/status"
+ALERTS_TOPIC = "pill/+/alerts"
+CAPABILITIES_TOPIC = "pill/+/capabilities"
+PRESENCE_TOPIC = "pill/+/presence"
+
+def device_id_from_topic(topic):
+    parts = topic.split("/")
+    return parts[1] if len(parts) > 1 else None
 
 def on_connect(client, userdata, flags, rc):
-    print("✅ Connected to MQTT Broker with result code:", rc)
+    logger.info("connected to MQTT broker", extra={'fields': {'rc': rc}})
 
     # Subscribe to all relevant topics from the device
     client.subscribe(STATUS_TOPIC)
+    client.subscribe(STATUS_BATCH_TOPIC)
     client.subscribe(SCHEDULE_STATUS_TOPIC)
     client.subscribe(SETTINGS_STATUS_TOPIC)
     client.subscribe(ALERTS_TOPIC)
+    client.subscribe(CAPABILITIES_TOPIC)
+    client.subscribe(PRESENCE_TOPIC)
 
-    print("📡 Subscribed to:")
-    print(f" - {STATUS_TOPIC}")
-    print(f" - {SCHEDULE_STATUS_TOPIC}")
-    print(f" - {SETTINGS_STATUS_TOPIC}")
-    print(f" - {ALERTS_TOPIC}")
+    logger.info("subscribed", extra={'fields': {'topics': [
+        STATUS_TOPIC, STATUS_BATCH_TOPIC, SCHEDULE_STATUS_TOPIC, SETTINGS_STATUS_TOPIC, ALERTS_TOPIC,
+        CAPABILITIES_TOPIC, PRESENCE_TOPIC]}})
 
 def on_message(client, userdata, msg):
+    started = time.perf_counter()
+    kind = topic_kind(msg.topic)
+    MQTT_MESSAGES.inc(kind)
+    traffic_recorder.record(msg.topic, msg.payload)
+    try:
+        handle_message(msg)
+    finally:
+        MQTT_INGEST_SECONDS.observe(time.perf_counter() - started, kind)
+        # paho stamps incoming messages with time.monotonic() on receipt
+        received = getattr(msg, 'timestamp', None)
+        if received:
+            MQTT_INGEST_LAG_SECONDS.observe(time.monotonic() - received)
+
+def handle_capabilities(device_id, payload):
+    encoding = codec.choose_encoding(codec.parse_capabilities(payload))
+    device_shadow.set_encoding(device_id, encoding)
+    logger.info("payload encoding negotiated", extra={'fields': {'device_id': device_id, 'encoding': encoding}})
+
+def handle_message(msg):
     topic = msg.topic
-    message = msg.payload.decode()
-    print(f"[MQTT] ⬇ Message on `{topic}`: {message}")
+    device_id = device_id_from_topic(topic)
+    if topic.endswith("/presence"):
+        if presence.handle_presence(device_id, msg.payload):
+            mqtt_publisher.request_drain(device_id)
+        return
+    if presence.seen(device_id):
+        mqtt_publisher.request_drain(device_id)
+    if topic.endswith("/capabilities"):
+        handle_capabilities(device_id, msg.payload)
+        return
+    if topic.endswith("/status/batch"):
+        handle_batch(topic, device_id, msg.payload)
+        return
+
+    try:
+        message, module, command_id, device_ts = codec.decode_device_payload(msg.payload)
+    except ValueError:
+        logger.warning("undecodable payload", extra={'fields': {'topic': topic, 'payload': msg.payload.hex()}})
+        return
+    if message_logger.isEnabledFor(logging.INFO):
+        message_logger.info("mqtt message", extra={'fields': {'topic': topic, 'payload': message}})
+    if DEDUP_ENABLED and dedup.is_duplicate(device_id, topic_kind(topic), message, module, command_id, device_ts):
+        return  # broker redelivery (QoS 1), already logged
+
+    # Log all events (with the device's own timestamp when it sends one)
+    log_event(device_id, module_label(message, module), message, normalize_timestamp(device_ts))
+    apply_event(topic, device_id, message, command_id, module)
+
+def handle_batch(topic, device_id, payload):
+    """Ingest an array of timestamped device events in one transaction"""
+    try:
+        events = codec.decode_batch(payload)
+    except ValueError:
+        logger.warning("undecodable batch", extra={'fields': {'topic': topic, 'bytes': len(payload)}})
+        return
+    if not events:
+        return
+    if message_logger.isEnabledFor(logging.INFO):
+        message_logger.info("mqtt batch", extra={'fields': {'topic': topic, 'events': len(events)}})
+    if DEDUP_ENABLED:
+        # A redelivered batch may overlap a later one, so check event by event
+        kind = topic_kind(topic)
+        events = [event for index, event in enumerate(events)
+                  if not dedup.is_duplicate(device_id, kind, *event, batch_index=index)]
+        if not events:
+            return
+
+    log_events(device_id, [(module_label(message, module), message, normalize_timestamp(ts))
+                           for message, module, _, ts in events])
+    for message, module, command_id, _ in events:
+        apply_event(topic, device_id, message, command_id, module)
 
-    # Smart motor/module label extraction (if message follows pattern)
-    motor = message.split(":")[0] if ":" in message else "system"
+def module_label(message, module=None):
+    # Smart motor/module label extraction (binary payloads name the module)
+    return module or (message.split(":")[0] if ":" in message else "system")
 
-    # Log all events
-    log_event(motor, message)
+def apply_event(topic, device_id, message, command_id=None, module=None):
+    """In-memory side effects of a persisted event: commands, shadow, alerts"""
+    command_tracker.match_reply(device_id, message, command_id)
+    if not topic.endswith("alerts"):
+        device_shadow.record_status(device_id, message)
 
     # Trigger alerts based on content
     if topic.endswith("alerts") or any(phrase in message for phrase in ["Pills low", "NOT taken", "is empty", "⚠️", "❌"]):
-        send_notification(f"🚨 ALERT: {message}")
+        device_shadow.record_alert(device_id, message)
+        notification_digest.alert(device_id, module_label(message, module), message)
 
 def start_mqtt_listener():
     client = mqtt.Client()
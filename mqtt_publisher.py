@@ -1,17 +1,193 @@
-import json
+import logging
+import queue
+import threading
+import time
 import paho.mqtt.client as mqtt
-from config import MQTT_BROKER, MQTT_PORT
+from config import (MQTT_BROKER, MQTT_PORT, MQTT_MAX_INFLIGHT_PUBLISHES, MQTT_PUBLISH_WAIT,
+                    MQTT_COMMAND_QOS, MQTT_PUBACK_TIMEOUT, COMMAND_QUEUE_DRAIN_WORKERS)
+from command_tracker import track_command, mark_queued, mark_sent, mark_dropped
+from codec import encode_command, encode_document
+from device_shadow import get_encoding, update_module
+import command_queue
+import presence
+from metrics import (MQTT_PUBLISH_SECONDS, MQTT_PUBLISH_ERRORS, MQTT_PUBLISH_INFLIGHT,
+                     COMMANDS_QUEUED, COMMANDS_DEQUEUED)
+
+logger = logging.getLogger(__name__)
+
+# Global cap on concurrent publishes (each holds a broker connection)
+_publish_slots = threading.BoundedSemaphore(MQTT_MAX_INFLIGHT_PUBLISHES)
+_inflight = 0
+_inflight_lock = threading.Lock()
+
+
+class PublishOverloaded(Exception):
+    """Every publish slot stayed busy for MQTT_PUBLISH_WAIT seconds"""
+
+
+def publish_saturated():
+    return _inflight >= MQTT_MAX_INFLIGHT_PUBLISHES
 
 def get_client():
     client = mqtt.Client()
     client.connect(MQTT_BROKER, MQTT_PORT, 60)
     return client
 
+def publish(topic, payload, kind):
+    """Connect, publish and wait for the broker's PUBACK, recording publish latency"""
+    global _inflight
+    if not _publish_slots.acquire(timeout=MQTT_PUBLISH_WAIT):
+        MQTT_PUBLISH_ERRORS.inc(kind)
+        raise PublishOverloaded(f"no free publish slot for {topic}")
+    with _inflight_lock:
+        _inflight += 1
+        MQTT_PUBLISH_INFLIGHT.set(_inflight)
+    started = time.perf_counter()
+    try:
+        client = get_client()
+        info = client.publish(topic, payload, qos=MQTT_COMMAND_QOS)
+        deadline = time.monotonic() + MQTT_PUBACK_TIMEOUT
+        while not info.is_published() and time.monotonic() < deadline:
+            client.loop(0.1)
+        client.disconnect()
+        if not info.is_published():
+            raise TimeoutError(f"no PUBACK for {topic}")
+    except Exception:
+        MQTT_PUBLISH_ERRORS.inc(kind)
+        raise
+    finally:
+        MQTT_PUBLISH_SECONDS.observe(time.perf_counter() - started, kind)
+        with _inflight_lock:
+            _inflight -= 1
+            MQTT_PUBLISH_INFLIGHT.set(_inflight)
+        _publish_slots.release()
+
+# ────── Offline Queue ──────
+# Devices that are offline (presence.py) or whose publish fails get their
+# messages queued in SQLite (command_queue.py); the first message or
+# presence heartbeat after a reconnect triggers drain_queue, and a failed
+# publish to a reachable device is retried at once and then by retry_queue. While a
+# device is being drained, new messages join the back of its queue so
+# they cannot overtake the queued ones.
+
+_drain_requests = queue.Queue()
+_draining = set()  # devices with a drain requested or running
+_drain_lock = threading.Lock()
+
+
+def _enqueue(device_id, kind, topic, payload, command=None, command_id=None):
+    if command_id:
+        mark_queued(command_id)
+    superseded = command_queue.enqueue(device_id, kind, topic, payload, command, command_id)
+    COMMANDS_QUEUED.inc(kind)
+    if superseded:
+        mark_dropped(superseded)
+        COMMANDS_DEQUEUED.inc('superseded', amount=len(superseded))
+
+
+def deliver(device_id, kind, topic, payload, command=None, command_id=None):
+    """Publish now if the device is reachable, else queue it; returns True if published"""
+    with _drain_lock:
+        # Decided under the lock, so a direct publish never overtakes queued
+        # messages, whether their drain is running, starting or still due
+        offline = presence.is_offline(device_id)
+        if offline or device_id in _draining or command_queue.has_pending(device_id):
+            _enqueue(device_id, kind, topic, payload, command, command_id)
+            queued = True
+        else:
+            queued = False
+    if queued:
+        if not offline:
+            request_drain(device_id)
+        return False
+    try:
+        publish(topic, payload, kind)
+        return True
+    except PublishOverloaded:
+        logger.warning("publish slots busy, queued", extra={'fields': {'device_id': device_id, 'kind': kind}})
+    except Exception:
+        logger.warning("publish failed, queued for retry", exc_info=True,
+                       extra={'fields': {'device_id': device_id, 'kind': kind}})
+    # Callers have usually committed the change already, so the message must
+    # not be lost: a drain worker retries it now, retry_queue until it gets through
+    _enqueue(device_id, kind, topic, payload, command, command_id)
+    request_drain(device_id)
+    return False
+
+
+def request_drain(device_id):
+    """Schedule delivery of a device's queued messages (when it comes online or a publish failed)"""
+    if not command_queue.has_pending(device_id):
+        return
+    with _drain_lock:
+        if device_id in _draining:
+            return
+        _draining.add(device_id)
+    _drain_requests.put(device_id)
+
+
+def drain_queue(device_id):
+    """Publish a device's queued messages oldest first; returns False if a publish failed"""
+    for queue_id, kind, topic, payload, command_id in command_queue.pending(device_id):
+        try:
+            publish(topic, payload, kind)
+        except Exception:
+            # Keep the rest queued, in order, for the next reconnect
+            logger.warning("queued delivery failed", exc_info=True,
+                           extra={'fields': {'device_id': device_id, 'kind': kind}})
+            return False
+        command_queue.remove(queue_id)
+        if command_id:
+            mark_sent(command_id)
+        COMMANDS_DEQUEUED.inc('delivered')
+    return True
+
+
+def _drain_worker():
+    while True:
+        device_id = _drain_requests.get()
+        try:
+            while True:
+                delivered = drain_queue(device_id)
+                with _drain_lock:
+                    # Checked under the lock so nothing is queued behind our back
+                    if not delivered or not command_queue.pending(device_id):
+                        _draining.discard(device_id)
+                        break
+        except Exception:
+            logger.exception("queue drain failed", extra={'fields': {'device_id': device_id}})
+            with _drain_lock:
+                _draining.discard(device_id)
+
+
+def purge_queue():
+    dropped, restored = command_queue.purge_expired()
+    if dropped:
+        mark_dropped(dropped)
+        COMMANDS_DEQUEUED.inc('expired', amount=len(dropped))
+    for device_id, module, pills_left in restored:
+        update_module(device_id, module, pills_left=pills_left)
+
+
+def retry_queue():
+    """Drain queued messages of devices that are not offline (their last publish failed)"""
+    for device_id in command_queue.queued_devices():
+        if presence.tracks(device_id) and not presence.is_offline(device_id):
+            request_drain(device_id)
+
+
+def start_drain_workers(workers=COMMAND_QUEUE_DRAIN_WORKERS):
+    for i in range(workers):
+        threading.Thread(target=_drain_worker, name=f"queue-drainer-{i}", daemon=True).start()
+
+
 def publish_command(device_id, command_str):
+    """Publish (or queue) a command tagged with a correlation id; returns the id"""
     topic = f"pill/{device_id}/command"
-    client = get_client()
-    client.publish(topic, command_str)
-    client.loop(2)  # ensure delivery
+    command_id = track_command(device_id, command_str)
+    payload = encode_command(command_str, command_id, get_encoding(device_id))
+    deliver(device_id, 'command', topic, payload, command_str, command_id)
+    return command_id
 
 '''
 Schedule format: 
@@ -32,33 +208,30 @@ new_schedule = [
 ]
 '''
 def publish_schedule(device_id, schedule_obj):
+    """Returns True if published, False if queued for the device's reconnect"""
     topic = f"pill/{device_id}/schedule/set"
-    payload = json.dumps(schedule_obj)
-    client = get_client()
-    client.publish(topic, payload)
-    client.loop(2)
+    payload = encode_document(schedule_obj, get_encoding(device_id))
+    return deliver(device_id, 'schedule', topic, payload)
 
 def publish_settings(device_id, settings_obj):
     topic = f"pill/{device_id}/settings/update"
-    payload = json.dumps(settings_obj)
-    client = get_client()
-    client.publish(topic, payload)
-    client.loop(2)
+    payload = encode_document(settings_obj, get_encoding(device_id))
+    deliver(device_id, 'settings', topic, payload)
     
 # ────── Command Shortcuts (Wrappers) ──────
 def send_dispense_command(device_id, dispenser_module):
     command = f"dispense:{dispenser_module}"
-    publish_command(device_id, command)
+    return publish_command(device_id, command)
 
 def send_refill_command(device_id, dispenser_module, count):
     command = f"refill:{dispenser_module}:{count}"
-    publish_command(device_id, command)
+    return publish_command(device_id, command)
 
 def set_hard_mode(device_id, enabled=True):
     command = f"set_hard_mode:{str(enabled).lower()}"
-    publish_command(device_id, command)
+    return publish_command(device_id, command)
 
 def reset_pending_module(device_id, dispenser_module):
     command = f"reset_pending:{dispenser_module}"
-    publish_command(device_id, command)
+    return publish_command(device_id, command)
 
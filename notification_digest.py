@@ -0,0 +1,126 @@
+import logging
+import threading
+import time
+from config import DIGEST_WINDOW, DIGEST_URGENT_PHRASES
+from notifier import send_notification
+from metrics import REGISTRY
+import database
+
+logger = logging.getLogger(__name__)
+
+# Alerts are grouped per doctor (via patient.doctor_id) into digests sent
+# once per DIGEST_WINDOW. Repeats for the same device and module within a
+# window are folded into one line with a count; urgent alerts skip the
+# digest but are still deduplicated per window.
+#
+# Routing uses an in-memory serial -> patient -> doctor index, loaded once
+# and kept current by the REST endpoints that change those links.
+
+NOTIFICATIONS_SENT = REGISTRY.counter(
+    'notifications_sent_total', 'Notifications delivered by type', ('type',))
+ALERTS_SUPPRESSED = REGISTRY.counter(
+    'alerts_suppressed_total', 'Alerts folded into an earlier alert for the same device and module')
+
+
+class DigestBucket:
+    __slots__ = ('opened_at', 'alerts')
+
+    def __init__(self, opened_at):
+        self.opened_at = opened_at
+        self.alerts = {}  # (serial_number, module) -> [latest message, count]
+
+
+_lock = threading.Lock()
+_patient_by_serial = {}
+_doctor_by_patient = {}
+_loaded = False
+_buckets = {}  # doctor_id (None = unassigned device) -> DigestBucket
+_urgent_sent = {}  # (serial_number, module) -> time of the last urgent notification
+
+
+def load_recipients():
+    global _loaded
+    conn = database.connect()
+    devices = conn.execute('SELECT serial_number, patient_id FROM pill_dispenser').fetchall()
+    patients = conn.execute('SELECT id, doctor_id FROM patient').fetchall()
+    conn.close()
+    with _lock:
+        _patient_by_serial.clear()
+        _patient_by_serial.update(devices)
+        _doctor_by_patient.clear()
+        _doctor_by_patient.update(patients)
+        _loaded = True
+
+
+def _ensure_loaded():
+    if not _loaded:
+        load_recipients()
+
+
+def set_device_patient(serial_number, patient_id):
+    _ensure_loaded()
+    with _lock:
+        _patient_by_serial[serial_number] = patient_id
+
+
+def set_patient_doctor(patient_id, doctor_id):
+    _ensure_loaded()
+    with _lock:
+        _doctor_by_patient[patient_id] = doctor_id
+
+
+def is_urgent(message):
+    return any(phrase in message for phrase in DIGEST_URGENT_PHRASES)
+
+
+def alert(serial_number, module, message, now=None):
+    """Route one alert to its doctor's digest, or straight out if urgent"""
+    _ensure_loaded()
+    now = now or time.time()
+    key = (serial_number, module)
+    with _lock:
+        doctor_id = _doctor_by_patient.get(_patient_by_serial.get(serial_number))
+        if is_urgent(message):
+            last = _urgent_sent.get(key)
+            if last is not None and now - last < DIGEST_WINDOW:
+                ALERTS_SUPPRESSED.inc()
+                return
+            _urgent_sent[key] = now
+        else:
+            bucket = _buckets.get(doctor_id)
+            if bucket is None:
+                bucket = _buckets[doctor_id] = DigestBucket(now)
+            entry = bucket.alerts.get(key)
+            if entry is None:
+                bucket.alerts[key] = [message, 1]
+            else:
+                entry[0] = message
+                entry[1] += 1
+                ALERTS_SUPPRESSED.inc()
+            return
+
+    NOTIFICATIONS_SENT.inc('urgent')
+    send_notification(f"🚨 URGENT {serial_number}: {message}", doctor_id=doctor_id)
+
+
+def flush_digests(now=None, force=False):
+    """Send every digest whose window has closed; returns how many were sent"""
+    now = now or time.time()
+    with _lock:
+        due = [(doctor_id, bucket) for doctor_id, bucket in _buckets.items()
+               if force or now - bucket.opened_at >= DIGEST_WINDOW]
+        for doctor_id, _ in due:
+            del _buckets[doctor_id]
+        for key in [key for key, sent in _urgent_sent.items() if now - sent >= DIGEST_WINDOW]:
+            del _urgent_sent[key]
+
+    for doctor_id, bucket in due:
+        total = sum(count for _, count in bucket.alerts.values())
+        lines = []
+        for (serial_number, module), (message, count) in sorted(bucket.alerts.items(), key=lambda i: str(i[0])):
+            label = serial_number if module and message.startswith(module) else f"{serial_number} {module}"
+            lines.append(f"{label}: {message}" + (f" (x{count})" if count > 1 else ""))
+        NOTIFICATIONS_SENT.inc('digest')
+        send_notification(f"📋 {total} alerts from {len(bucket.alerts)} modules:\n" + "\n".join(lines),
+                          doctor_id=doctor_id)
+    return len(due)
@@ -1,3 +1,7 @@
-def send_notification(message):
+import logging
+
+logger = logging.getLogger(__name__)
+
+def send_notification(message, doctor_id=None):
     # You can later integrate email, SMS or push (like Pushover/FCM)
-    print(f"[NOTIFY] {message}")
+    logger.info("notification", extra={'fields': {'notification': message, 'doctor_id': doctor_id}})
@@ -0,0 +1,244 @@
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+from config import PRESENCE_TIMEOUT
+from database import connect
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Online/offline index of the fleet. Devices publish "online" (retained)
+# on pill/{id}/presence when they connect and then every heartbeat
+# interval, and register a retained "offline" last will on the same
+# topic. Any other message from a device also counts as a heartbeat; a
+# device silent for PRESENCE_TIMEOUT is marked offline by the sweeper.
+# Every transition is appended to presence_event; the current state is
+# served from memory.
+
+DEVICES_ONLINE = REGISTRY.gauge('devices_online', 'Devices currently online')
+PRESENCE_TRANSITIONS = REGISTRY.counter(
+    'presence_transitions_total', 'Device online/offline transitions', ('state', 'reason'))
+
+ONLINE = 'online'
+OFFLINE = 'offline'
+
+
+class Presence:
+    __slots__ = ('online', 'since', 'last_seen')
+
+    def __init__(self, online, since, last_seen):
+        self.online = online
+        self.since = since  # epoch seconds of the last transition
+        self.last_seen = last_seen  # epoch seconds of the last heartbeat or message
+
+    def to_dict(self):
+        return {
+            'online': self.online,
+            'since': datetime.fromtimestamp(self.since).isoformat(),
+            'last_seen': datetime.fromtimestamp(self.last_seen).isoformat() if self.last_seen else None
+        }
+
+
+_lock = threading.Lock()
+_devices = {}  # serial_number -> Presence
+_online_count = 0
+_loaded = False
+_owns = None  # ingest shard ownership predicate (see retain); None = every device
+
+
+def _latest_states(serials=None):
+    """(serial, state, at) of the newest presence_event per device, optionally only for `serials`"""
+    conn = connect()
+    if serials is None:
+        rows = conn.execute('''
+            SELECT serial_number, state, at
+            FROM presence_event
+            WHERE id IN (SELECT MAX(id) FROM presence_event GROUP BY serial_number)
+        ''').fetchall()
+    else:
+        rows = conn.execute('''
+            SELECT serial_number, state, at
+            FROM presence_event
+            WHERE id IN (SELECT MAX(id) FROM presence_event
+                         WHERE serial_number IN (SELECT value FROM json_each(?))
+                         GROUP BY serial_number)
+        ''', (json.dumps(list(serials)),)).fetchall()
+    conn.close()
+    return rows
+
+
+def _restore(state, at):
+    since = datetime.fromisoformat(at).timestamp()
+    # Online devices count as seen at their last transition until they speak again
+    return Presence(state == ONLINE, since, since if state == ONLINE else None)
+
+
+def load_presence():
+    """Restore the last known state of every (owned) device from presence_event"""
+    global _loaded, _online_count
+    rows = _latest_states()
+    with _lock:
+        _devices.clear()
+        for serial_number, state, at in rows:
+            if _owns is None or _owns(serial_number):
+                _devices[serial_number] = _restore(state, at)
+        _online_count = sum(1 for p in _devices.values() if p.online)
+        DEVICES_ONLINE.set(_online_count)
+        _loaded = True
+
+
+def _ensure_loaded():
+    if not _loaded:
+        load_presence()
+
+
+def refresh_presence(serials):
+    """Load the last known state of devices taken over from another ingest shard"""
+    global _online_count
+    _ensure_loaded()
+    rows = _latest_states(serials)
+    with _lock:
+        for serial_number, state, at in rows:
+            # Messages handled since the takeover are newer than the old owner's record
+            if serial_number not in _devices:
+                _devices[serial_number] = _restore(state, at)
+        _online_count = sum(1 for p in _devices.values() if p.online)
+        DEVICES_ONLINE.set(_online_count)
+
+
+def _persist(transitions):
+    conn = connect()
+    conn.executemany('INSERT INTO presence_event (serial_number, state, reason, at) VALUES (?, ?, ?, ?)',
+                     [(serial, ONLINE if online else OFFLINE, reason, datetime.fromtimestamp(at).isoformat())
+                      for serial, online, reason, at in transitions])
+    conn.commit()
+    conn.close()
+
+
+def _transition(serial_number, online, reason, now):
+    """Apply a state change under _lock; returns the transition to persist, or None"""
+    global _online_count
+    presence = _devices.get(serial_number)
+    if presence is None:
+        _devices[serial_number] = Presence(online, now, now if online else None)
+    elif presence.online == online:
+        if online:
+            presence.last_seen = now
+        return None
+    else:
+        presence.online = online
+        presence.since = now
+        if online:
+            presence.last_seen = now
+        else:
+            _online_count -= 1
+    if online:
+        _online_count += 1
+    DEVICES_ONLINE.set(_online_count)
+    PRESENCE_TRANSITIONS.inc(ONLINE if online else OFFLINE, reason)
+    return serial_number, online, reason, now
+
+
+def handle_presence(device_id, payload, now=None):
+    """pill/{id}/presence: b"online" (connect / heartbeat) or b"offline" (last will / clean disconnect)
+
+    Returns True when the device just came online.
+    """
+    _ensure_loaded()
+    state = payload.decode(errors='replace').strip().lower()
+    if state not in (ONLINE, OFFLINE):
+        logger.warning("unknown presence payload", extra={'fields': {'device_id': device_id, 'payload': state}})
+        return False
+    now = now or time.time()
+    with _lock:
+        transition = _transition(device_id, state == ONLINE, 'presence', now)
+    if transition:
+        _persist([transition])
+    return bool(transition) and state == ONLINE
+
+
+def seen(device_id, now=None):
+    """Any message from a device proves it is online; returns True when it just came online"""
+    _ensure_loaded()
+    now = now or time.time()
+    with _lock:
+        presence = _devices.get(device_id)
+        if presence is not None and presence.online:
+            presence.last_seen = now  # hot path: no transition, no I/O
+            return False
+        transition = _transition(device_id, True, 'message', now)
+    if transition:
+        _persist([transition])
+    return bool(transition)
+
+
+def sweep_presence(timeout=PRESENCE_TIMEOUT, now=None):
+    """Mark devices without a heartbeat for `timeout` seconds offline; returns how many"""
+    _ensure_loaded()
+    now = now or time.time()
+    with _lock:
+        stale = [serial for serial, p in _devices.items()
+                 if p.online and p.last_seen is not None and now - p.last_seen >= timeout]
+        transitions = [_transition(serial, False, 'timeout', now) for serial in stale]
+    if transitions:
+        _persist(transitions)
+        logger.info("devices timed out", extra={'fields': {'count': len(transitions)}})
+    return len(transitions)
+
+
+def retain(owns):
+    """Forget devices for which owns(serial) is false (handed to another ingest shard).
+
+    `owns` is kept, so later (re)loads skip devices other shards own.
+    """
+    global _online_count, _owns
+    _owns = owns
+    _ensure_loaded()
+    with _lock:
+        for serial in [serial for serial in _devices if not owns(serial)]:
+            del _devices[serial]
+        _online_count = sum(1 for p in _devices.values() if p.online)
+        DEVICES_ONLINE.set(_online_count)
+
+
+def get_presence(serial_number):
+    _ensure_loaded()
+    with _lock:
+        presence = _devices.get(serial_number)
+        return presence.to_dict() if presence else None
+
+
+def tracks(serial_number):
+    """False for devices another ingest shard owns"""
+    return _owns is None or _owns(serial_number)
+
+
+def is_offline(serial_number):
+    """True only for devices known to be offline; unknown devices are assumed reachable"""
+    _ensure_loaded()
+    presence = _devices.get(serial_number)
+    return presence is not None and not presence.online
+
+
+def offline_devices(min_seconds=0, now=None):
+    """Devices offline for at least `min_seconds`, longest offline first"""
+    _ensure_loaded()
+    now = now or time.time()
+    with _lock:
+        rows = [(p.since, serial, p.last_seen) for serial, p in _devices.items()
+                if not p.online and now - p.since >= min_seconds]
+    rows.sort()
+    return [{
+        'serial_number': serial,
+        'offline_since': datetime.fromtimestamp(since).isoformat(),
+        'offline_seconds': round(now - since),
+        'last_seen': datetime.fromtimestamp(last_seen).isoformat() if last_seen else None
+    } for since, serial, last_seen in rows]
+
+
+def presence_counts():
+    _ensure_loaded()
+    with _lock:
+        return {'online': _online_count, 'offline': len(_devices) - _online_count}
@@ -0,0 +1,210 @@
+import sys
+import threading
+from array import array
+from database import connect
+
+# Process-wide copy of the small, rarely changing reference data the API
+# checks on almost every request: which doctors and patients exist, each
+# patient's doctor, and serial number -> dispenser id / module ids.
+# Loaded once (main.py), updated by the API handlers that write these
+# tables, and consulted without SQL. A miss falls back to one query and
+# caches the answer, so rows written by other processes are still found.
+#
+# Layout, kept compact for large fleets:
+#   doctors              set of ids
+#   patient -> doctor    array('i') indexed by patient id (-1 = no such patient, 0 = no doctor)
+#                        ids past MAX_ID are not cached and always go to SQL
+#   serial -> dispenser  dict of slotted Dispenser records; the tuple of module
+#                        names is shared, so ("module1", "module2") is stored once
+#
+# Measured with benchmarks/reference_cache_bench.py (CPython 3.11, 64-bit):
+# 100k patients, one dispenser each with 2 modules, 200 doctors -> about
+# 35 MB, ~350 bytes per patient. Half of that is the serial number strings
+# and id ints, a third the Dispenser records and their module id tuples;
+# the patient array is 4 bytes per patient. A lookup takes ~1.5 us against
+# ~25 us for the SQL it replaces.
+
+NO_PATIENT = -1
+NO_DOCTOR = 0
+MAX_ID = 2 ** 31 - 1  # largest id the array('i') can hold
+
+
+def as_id(value):
+    """A row id from request data (int or digit string) as an int, or None if it is not one"""
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int) or not 0 < value <= MAX_ID:
+        return None
+    return value
+
+
+class Dispenser:
+    __slots__ = ('id', 'patient_id', 'module_names', 'module_ids')
+
+    def __init__(self, dispenser_id, patient_id):
+        self.id = dispenser_id
+        self.patient_id = patient_id
+        self.module_names = ()  # shared between devices with the same module names
+        self.module_ids = ()
+
+    def module_id(self, module_name):
+        for name, module_id in zip(self.module_names, self.module_ids):
+            if name == module_name:
+                return module_id
+        return None
+
+
+_lock = threading.Lock()
+_doctors = set()
+_patient_doctor = array('i')
+_dispensers = {}  # serial_number -> Dispenser
+_loaded = False
+
+
+def _set_patient(patient_id, doctor_id):
+    """Called under _lock"""
+    if as_id(patient_id) is None or (doctor_id is not None and as_id(doctor_id) is None):
+        return  # not cacheable; lookups fall back to SQL
+    if patient_id >= len(_patient_doctor):
+        # Grow geometrically; ids are dense AUTOINCREMENT values
+        size = max(patient_id + 1, len(_patient_doctor) * 2)
+        _patient_doctor.extend(array('i', [NO_PATIENT]) * (size - len(_patient_doctor)))
+    _patient_doctor[patient_id] = doctor_id or NO_DOCTOR
+
+
+_module_name_sets = {}  # tuple of module names -> the one shared instance
+
+
+def _group_modules(rows):
+    """(serial, dispenser id, patient id, module name, module id) rows -> {serial: Dispenser}"""
+    dispensers = {}
+    for serial_number, dispenser_id, patient_id, module_name, module_id in rows:
+        dispenser = dispensers.get(serial_number)
+        if dispenser is None:
+            dispenser = dispensers[serial_number] = Dispenser(dispenser_id, patient_id)
+        if module_name is not None:
+            names = dispenser.module_names + (sys.intern(module_name),)
+            dispenser.module_names = _module_name_sets.setdefault(names, names)
+            dispenser.module_ids += (module_id,)
+    return dispensers
+
+
+_DISPENSER_QUERY = '''
+    SELECT pd.serial_number, pd.id, pd.patient_id, dm.module_name, dm.id
+    FROM pill_dispenser pd
+    LEFT JOIN dispenser_module dm ON dm.pill_dispenser_id = pd.id
+'''
+
+
+def load_reference_data():
+    global _loaded, _patient_doctor
+    conn = connect()
+    doctors = {row[0] for row in conn.execute('SELECT id FROM doctor')}
+    patients = conn.execute('SELECT id, doctor_id FROM patient').fetchall()
+    dispensers = _group_modules(conn.execute(_DISPENSER_QUERY + ' ORDER BY dm.id'))
+    conn.close()
+    with _lock:
+        _doctors.clear()
+        _doctors.update(doctors)
+        _patient_doctor = array('i')
+        for patient_id, doctor_id in patients:
+            _set_patient(patient_id, doctor_id)
+        _dispensers.clear()
+        _dispensers.update(dispensers)
+        _loaded = True
+
+
+def _ensure_loaded():
+    if not _loaded:
+        load_reference_data()
+
+
+def doctor_exists(doctor_id):
+    doctor_id = as_id(doctor_id)
+    if doctor_id is None:
+        return False
+    _ensure_loaded()
+    if doctor_id in _doctors:
+        return True
+    conn = connect()
+    found = conn.execute('SELECT 1 FROM doctor WHERE id = ?', (doctor_id,)).fetchone() is not None
+    conn.close()
+    if found:
+        add_doctor(doctor_id)
+    return found
+
+
+def patient_doctor(patient_id):
+    """Doctor id of a patient, 0 if it has none, None if there is no such patient"""
+    patient_id = as_id(patient_id)
+    if patient_id is None:
+        return None
+    _ensure_loaded()
+    if 0 < patient_id < len(_patient_doctor) and _patient_doctor[patient_id] != NO_PATIENT:
+        return _patient_doctor[patient_id]
+    conn = connect()
+    row = conn.execute('SELECT doctor_id FROM patient WHERE id = ?', (patient_id,)).fetchone()
+    conn.close()
+    if row is None:
+        return None
+    set_patient_doctor(patient_id, row[0])
+    return row[0] or NO_DOCTOR
+
+
+def dispenser(serial_number):
+    """Dispenser record for a serial number, or None"""
+    _ensure_loaded()
+    found = _dispensers.get(serial_number)
+    if found is None:
+        found = _reload_dispenser(serial_number)
+    return found
+
+
+def _reload_dispenser(serial_number):
+    conn = connect()
+    rows = conn.execute(_DISPENSER_QUERY + ' WHERE pd.serial_number = ? ORDER BY dm.id',
+                        (serial_number,)).fetchall()
+    conn.close()
+    found = _group_modules(rows).get(serial_number)
+    with _lock:
+        if found is None:
+            _dispensers.pop(serial_number, None)
+        else:
+            _dispensers[serial_number] = found
+    return found
+
+
+def dispenser_id(serial_number):
+    found = dispenser(serial_number)
+    return found.id if found else None
+
+
+def module_id(serial_number, module_name):
+    """Id of a device's module by name, or None"""
+    found = dispenser(serial_number)
+    if found is None:
+        return None
+    result = found.module_id(module_name)
+    if result is None:
+        # Module added behind our back?
+        found = _reload_dispenser(serial_number)
+        result = found.module_id(module_name) if found else None
+    return result
+
+
+def add_doctor(doctor_id):
+    with _lock:
+        _doctors.add(doctor_id)
+
+
+def set_patient_doctor(patient_id, doctor_id):
+    """A patient was created or got a (new) doctor"""
+    with _lock:
+        _set_patient(patient_id, doctor_id)
+
+
+def assign_dispenser(serial_number, patient_id):
+    with _lock:
+        found = _dispensers.get(serial_number)
+        if found is not None:
+            found.patient_id = patient_id
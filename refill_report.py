@@ -0,0 +1,143 @@
+import csv
+import glob
+import logging
+import math
+import os
+import time
+from datetime import date, timedelta
+from config import (REFILL_REPORT_DIR, REFILL_PLAN_HORIZON_DAYS,
+                    REFILL_TARGET_DAYS)
+from database import connect
+
+logger = logging.getLogger(__name__)
+
+# Fleet refill plan for pharmacy staff: every module that will run out
+# within REFILL_PLAN_HORIZON_DAYS (or is already at its threshold), with
+# the pills needed to cover REFILL_TARGET_DAYS of doses. Dose rates come
+# from the schedules in one grouped query over the whole fleet; the result
+# is written to a dated CSV in REFILL_REPORT_DIR.
+
+COLUMNS = ['serial_number', 'patient_id', 'patient_name', 'module', 'medicines', 'pills_left',
+           'threshold', 'doses_per_day', 'days_left', 'refill_by', 'pills_needed']
+# CSV stores everything as text; read_report converts these back
+NUMERIC_COLUMNS = ('patient_id', 'pills_left', 'threshold', 'doses_per_day', 'days_left', 'pills_needed')
+
+
+def plan_refills(conn, today=None, horizon_days=REFILL_PLAN_HORIZON_DAYS, target_days=REFILL_TARGET_DAYS):
+    """Rows of the refill plan, most urgent first"""
+    today = today or date.today()
+    rows = conn.execute('''
+        WITH rate AS (
+            -- one pill per dose; custom schedules dose on len(days_of_week) days a week
+            SELECT dispenser_module_id AS module_id,
+                   SUM(CASE
+                           WHEN repeat_type = 'custom' AND days_of_week IS NOT NULL
+                                AND days_of_week NOT IN ('', 'daily')
+                           THEN (LENGTH(days_of_week) - LENGTH(REPLACE(days_of_week, ',', '')) + 1) / 7.0
+                           ELSE 1.0
+                       END) AS doses_per_day,
+                   GROUP_CONCAT(DISTINCT medicine_name) AS medicines
+            FROM schedule
+            WHERE dispenser_module_id IS NOT NULL
+              AND (until_date IS NULL OR until_date >= ?)
+            GROUP BY dispenser_module_id
+        )
+        SELECT pd.serial_number, pd.patient_id, p.name, dm.module_name, r.medicines,
+               dm.pills_left, dm.threshold, r.doses_per_day,
+               dm.pills_left / r.doses_per_day AS days_left
+        FROM dispenser_module dm
+        JOIN pill_dispenser pd ON pd.id = dm.pill_dispenser_id
+        LEFT JOIN patient p ON p.id = pd.patient_id
+        LEFT JOIN rate r ON r.module_id = dm.id
+        WHERE dm.pills_left <= dm.threshold
+           OR dm.pills_left < r.doses_per_day * ?
+        ORDER BY days_left IS NULL, days_left, pd.serial_number, dm.module_name
+    ''', (today.isoformat(), horizon_days)).fetchall()
+
+    plan = []
+    for (serial_number, patient_id, patient_name, module, medicines, pills_left, threshold,
+         doses_per_day, days_left) in rows:
+        if doses_per_day:
+            # Refill before the module drops to its threshold
+            until_threshold = max(0, (pills_left - (threshold or 0)) / doses_per_day)
+            refill_by = (today + timedelta(days=math.floor(until_threshold))).isoformat()
+            pills_needed = max(0, math.ceil(doses_per_day * target_days) - pills_left)
+        else:
+            refill_by, pills_needed = today.isoformat(), None  # low but not scheduled
+        plan.append({
+            'serial_number': serial_number,
+            'patient_id': patient_id,
+            'patient_name': patient_name,
+            'module': module,
+            'medicines': medicines,
+            'pills_left': pills_left,
+            'threshold': threshold,
+            'doses_per_day': round(doses_per_day, 3) if doses_per_day else 0,
+            'days_left': round(days_left, 1) if days_left is not None else None,
+            'refill_by': refill_by,
+            'pills_needed': pills_needed
+        })
+    return plan
+
+
+def generate_refill_report(today=None):
+    """Compute the plan and write refill_plan_<date>.csv; returns its path"""
+    today = today or date.today()
+    started = time.perf_counter()
+    conn = connect()
+    plan = plan_refills(conn, today)
+    conn.close()
+
+    os.makedirs(REFILL_REPORT_DIR, exist_ok=True)
+    path = os.path.join(REFILL_REPORT_DIR, f"refill_plan_{today.isoformat()}.csv")
+    tmp = path + '.tmp'
+    with open(tmp, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(plan)
+    os.replace(tmp, path)  # readers never see a half-written report
+
+    logger.info("refill report generated", extra={'fields': {
+        'path': path, 'modules': len(plan), 'seconds': round(time.perf_counter() - started, 3)}})
+    return path
+
+
+def latest_report_path():
+    # Dated names sort chronologically
+    reports = sorted(glob.glob(os.path.join(REFILL_REPORT_DIR, 'refill_plan_*.csv')))
+    return reports[-1] if reports else None
+
+
+def read_report(path):
+    """Plan rows of a report file, with the numeric columns typed again (empty -> None)"""
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    for row in rows:
+        for column in NUMERIC_COLUMNS:
+            row[column] = _number(row.get(column))
+    return rows
+
+
+def _number(value):
+    """'4' -> 4, '2.0' -> 2.0 (as written by plan_refills), '' -> None"""
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def report_missing():
+    """True if today's report has not been generated yet"""
+    return latest_report_path() != os.path.join(
+        REFILL_REPORT_DIR, f"refill_plan_{date.today().isoformat()}.csv")
+
+
+if __name__ == "__main__":
+    from logging_setup import setup_logging
+    from database import init_db
+
+    setup_logging()
+    init_db()
+    print(generate_refill_report())
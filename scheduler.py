@@ -0,0 +1,280 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from config import JOB_WORKERS, JOB_HISTORY_SIZE
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# In-process scheduler for periodic maintenance (checkpoints, retention,
+# digests, reports). One thread keeps a heap of due times and hands runs
+# to a bounded worker pool, so maintenance never runs on the request or
+# ingest threads and never uses more than JOB_WORKERS threads.
+#
+# A job never overlaps itself: a run that comes due while the previous
+# one is still going is skipped. Threads cannot be killed, so a run that
+# exceeds its timeout is reported (log + metrics) and keeps its job
+# blocked until it returns.
+
+JOB_RUNS = REGISTRY.counter(
+    'job_runs_total', 'Scheduled job runs by outcome (success, error, timeout, skipped)', ('job', 'outcome'))
+JOB_SECONDS = REGISTRY.histogram(
+    'job_duration_seconds', 'Scheduled job run time', ('job',))
+JOB_LAST_SUCCESS = REGISTRY.gauge(
+    'job_last_success_timestamp_seconds', 'When each job last completed successfully', ('job',))
+JOBS_RUNNING = REGISTRY.gauge('jobs_running', 'Scheduled jobs currently running')
+
+TICK = 1.0  # seconds between timeout checks while nothing is due
+
+SUCCESS = 'success'
+ERROR = 'error'
+TIMEOUT = 'timeout'
+SKIPPED = 'skipped'
+
+
+class Interval:
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def next_after(self, at):
+        return at + self.seconds
+
+    def __str__(self):
+        return f"every {self.seconds:g}s"
+
+
+class Cron:
+    """Five-field cron expression (minute hour day-of-month month day-of-week), local time.
+
+    Fields take *, numbers, ranges (1-5), steps (*/15, 0-30/10) and lists
+    (1,15). Day of week is 0-6 from Sunday (7 is Sunday too); as in cron,
+    if both day fields are restricted a day matching either one fires.
+    """
+    BOUNDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"cron expression needs 5 fields: {expression!r}")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self._parse(field, low, high) for field, (low, high) in zip(fields, self.BOUNDS))
+        self.weekdays = {day % 7 for day in weekdays}
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for part in field.split(','):
+            spec, _, step = part.partition('/')
+            if spec == '*':
+                start, end = low, high
+            elif '-' in spec:
+                start, end = (int(v) for v in spec.split('-', 1))
+            else:
+                start = end = int(spec)
+                if step:
+                    end = high
+            if not low <= start <= end <= high:
+                raise ValueError(f"cron field out of range: {field!r}")
+            values.update(range(start, end + 1, int(step or 1)))
+        return sorted(values)
+
+    def _day_matches(self, day):
+        in_month = day.day in self.days
+        in_week = (day.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return in_month and in_week
+        return in_month or in_week
+
+    def next_after(self, at):
+        start = datetime.fromtimestamp(at).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        day = start.replace(hour=0, minute=0)
+        for _ in range(5 * 366):
+            if day.month in self.months and self._day_matches(day):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        candidate = day.replace(hour=hour, minute=minute)
+                        if candidate >= start:
+                            return candidate.timestamp()
+            day += timedelta(days=1)
+        raise ValueError(f"cron expression never fires: {self.expression!r}")
+
+    def __str__(self):
+        return f"cron {self.expression}"
+
+
+class Run:
+    __slots__ = ('started', 'duration', 'outcome', 'error')
+
+    def __init__(self, started, duration, outcome, error=None):
+        self.started = started
+        self.duration = duration
+        self.outcome = outcome
+        self.error = error
+
+    def to_dict(self):
+        return {
+            'started': datetime.fromtimestamp(self.started).isoformat(),
+            'duration': round(self.duration, 3) if self.duration is not None else None,
+            'outcome': self.outcome,
+            'error': self.error
+        }
+
+
+class Job:
+    def __init__(self, name, func, trigger, timeout):
+        self.name = name
+        self.func = func
+        self.trigger = trigger
+        self.timeout = timeout
+        self.next_run = None
+        self.running_since = None
+        self.timed_out = False
+        self.history = deque(maxlen=JOB_HISTORY_SIZE)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'trigger': str(self.trigger),
+            'timeout': self.timeout,
+            'next_run': datetime.fromtimestamp(self.next_run).isoformat() if self.next_run else None,
+            'running_since': (datetime.fromtimestamp(self.running_since).isoformat()
+                              if self.running_since else None),
+            'history': [run.to_dict() for run in reversed(self.history)]
+        }
+
+
+class Scheduler:
+    def __init__(self, workers=JOB_WORKERS):
+        self.workers = workers
+        self._jobs = {}
+        self._heap = []  # (next_run, seq, job)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._pool = None
+        self._stopped = False
+        self._running = 0
+
+    def add_job(self, name, func, every=None, cron=None, timeout=None, run_at_start=False):
+        """Run func() every `every` seconds or on a cron expression.
+
+        `timeout` defaults to the interval (or an hour for cron jobs);
+        `run_at_start` makes the first run immediate instead of one period in.
+        """
+        if (every is None) == (cron is None):
+            raise ValueError("exactly one of every= or cron= is required")
+        trigger = Interval(every) if every is not None else Cron(cron)
+        job = Job(name, func, trigger, timeout or every or 60 * 60)
+        now = time.time()
+        with self._cond:
+            if name in self._jobs:
+                raise ValueError(f"job {name!r} already scheduled")
+            self._jobs[name] = job
+            self._schedule(job, now if run_at_start else trigger.next_after(now))
+        return job
+
+    def _schedule(self, job, at):
+        job.next_run = at
+        heapq.heappush(self._heap, (at, next(self._seq), job))
+        self._cond.notify()
+
+    def start(self):
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job")
+        threading.Thread(target=self._loop, name="scheduler", daemon=True).start()
+        logger.info("scheduler started", extra={'fields': {
+            'workers': self.workers, 'jobs': {name: str(job.trigger) for name, job in self._jobs.items()}}})
+        return self
+
+    def stop(self, wait=True):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait)
+
+    def _loop(self):
+        with self._cond:
+            while not self._stopped:
+                now = time.time()
+                self._check_timeouts(now)
+                while self._heap and self._heap[0][0] <= now:
+                    at, _, job = heapq.heappop(self._heap)
+                    self._dispatch(job, now)
+                    # Keep to the grid; if we fell a whole period behind, restart from now
+                    following = job.trigger.next_after(at)
+                    self._schedule(job, following if following > now else job.trigger.next_after(now))
+                wait = self._heap[0][0] - now if self._heap else TICK
+                self._cond.wait(min(max(wait, 0), TICK))
+
+    def _dispatch(self, job, now):
+        """Called under _cond"""
+        if job.running_since is not None:
+            JOB_RUNS.inc(job.name, SKIPPED)
+            logger.info("job still running, run skipped", extra={'fields': {
+                'job': job.name, 'running_seconds': round(now - job.running_since, 1)}})
+            return False
+        job.running_since = now
+        job.timed_out = False
+        self._running += 1
+        JOBS_RUNNING.set(self._running)
+        self._pool.submit(self._execute, job)
+        return True
+
+    def _check_timeouts(self, now):
+        """Called under _cond"""
+        for job in self._jobs.values():
+            if job.running_since is not None and not job.timed_out and now - job.running_since > job.timeout:
+                job.timed_out = True
+                JOB_RUNS.inc(job.name, TIMEOUT)
+                logger.warning("job exceeded its timeout", extra={'fields': {
+                    'job': job.name, 'timeout': job.timeout}})
+
+    def _execute(self, job):
+        started = job.running_since
+        error = None
+        try:
+            job.func()
+            outcome = SUCCESS
+        except Exception as e:
+            outcome = ERROR
+            error = f"{type(e).__name__}: {e}"
+            logger.exception("job failed", extra={'fields': {'job': job.name}})
+        finished = time.time()
+        duration = finished - started
+        JOB_SECONDS.observe(duration, job.name)
+        with self._cond:
+            if job.timed_out:
+                outcome = TIMEOUT  # already counted when it was detected
+            else:
+                JOB_RUNS.inc(job.name, outcome)
+            if outcome == SUCCESS:
+                JOB_LAST_SUCCESS.set(finished, job.name)
+            job.history.append(Run(started, duration, outcome, error))
+            job.running_since = None
+            self._running -= 1
+            JOBS_RUNNING.set(self._running)
+
+    def run_now(self, name):
+        """Start a job immediately; returns False if it is already running, None if unknown"""
+        with self._cond:
+            job = self._jobs.get(name)
+            if job is None:
+                return None
+            if job.running_since is not None or self._pool is None:
+                return False
+            self._dispatch(job, time.time())
+            return True
+
+    def jobs(self):
+        with self._cond:
+            return [job.to_dict() for job in self._jobs.values()]
+
+
+SCHEDULER = Scheduler()
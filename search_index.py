@@ -0,0 +1,133 @@
+import logging
+import re
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+# FTS5 index over patient names and notes, doctor names and schedule
+# medicine names, kept in sync by triggers. Each indexed field gets a
+# deterministic rowid (source id * 4 + field code) so triggers can replace
+# or delete entries by rowid instead of scanning the index.
+
+FIELD_CODES = {
+    ('patient', 'name'): 0,
+    ('patient', 'notes'): 1,
+    ('doctor', 'name'): 2,
+    ('schedule', 'medicine_name'): 3,
+}
+
+SEARCH_KINDS = ('patient', 'doctor', 'schedule')
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def _row_insert(kind, field, source):
+    code = FIELD_CODES[(kind, field)]
+    return (f"INSERT INTO search_index (rowid, kind, ref_id, field, text) "
+            f"SELECT {source}.id * 4 + {code}, '{kind}', {source}.id, '{field}', {source}.{field} "
+            f"WHERE {source}.{field} IS NOT NULL;")
+
+
+def _row_delete(kind, field, source):
+    code = FIELD_CODES[(kind, field)]
+    return f"DELETE FROM search_index WHERE rowid = {source}.id * 4 + {code};"
+
+
+def _triggers(table, kind, fields):
+    inserts = ' '.join(_row_insert(kind, f, 'new') for f in fields)
+    deletes = ' '.join(_row_delete(kind, f, 'old') for f in fields)
+    columns = ', '.join(fields)
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {table}_search_insert AFTER INSERT ON {table} BEGIN {inserts} END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_search_update AFTER UPDATE OF {columns} ON {table} "
+        f"BEGIN {deletes} {inserts} END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_search_delete AFTER DELETE ON {table} BEGIN {deletes} END",
+    ]
+
+
+def init_search_index(c):
+    """Create the FTS5 table and sync triggers; backfill on first run.
+
+    Returns False (and leaves search disabled) if SQLite lacks FTS5.
+    """
+    try:
+        c.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+                kind UNINDEXED,
+                ref_id UNINDEXED,
+                field UNINDEXED,
+                text,
+                tokenize = 'unicode61 remove_diacritics 2',
+                prefix = '2 3'
+            )
+        ''')
+    except sqlite3.OperationalError:
+        logger.warning("SQLite was built without FTS5, /api/search is disabled")
+        return False
+
+    for sql in (_triggers('patient', 'patient', ['name', 'notes'])
+                + _triggers('doctor', 'doctor', ['name'])
+                + _triggers('schedule', 'schedule', ['medicine_name'])):
+        c.execute(sql)
+
+    c.execute('SELECT 1 FROM search_index LIMIT 1')
+    if c.fetchone() is None:
+        for (kind, field), code in FIELD_CODES.items():
+            c.execute(f'''
+                INSERT INTO search_index (rowid, kind, ref_id, field, text)
+                SELECT id * 4 + {code}, '{kind}', id, '{field}', {field}
+                FROM {kind}
+                WHERE {field} IS NOT NULL
+            ''')
+    return True
+
+
+def build_match_query(text):
+    """'jo dia' -> '"jo"* AND "dia"*' (every term, prefix match)"""
+    terms = _TOKEN.findall(text)
+    return ' AND '.join(f'"{term}"*' for term in terms)
+
+
+def search(c, text, kind=None, limit=20):
+    """Ranked search; returns a list of result dicts"""
+    match = build_match_query(text)
+    if not match:
+        return []
+
+    kind_filter = 'AND si.kind = ?' if kind else ''
+    params = [match] + ([kind] if kind else []) + [limit]
+    c.execute(f'''
+        SELECT si.kind, si.ref_id, si.field,
+               snippet(search_index, 3, '[', ']', '…', 10) AS snippet,
+               si.rank,
+               p.name AS patient_name,
+               d.name AS doctor_name,
+               s.patient_id AS schedule_patient_id,
+               s.medicine_name
+        FROM search_index si
+        LEFT JOIN patient p ON si.kind = 'patient' AND p.id = si.ref_id
+        LEFT JOIN doctor d ON si.kind = 'doctor' AND d.id = si.ref_id
+        LEFT JOIN schedule s ON si.kind = 'schedule' AND s.id = si.ref_id
+        WHERE search_index MATCH ? {kind_filter}
+        ORDER BY si.rank
+        LIMIT ?
+    ''', params)
+
+    results = []
+    for row in c.fetchall():
+        result = {
+            'kind': row['kind'],
+            'id': row['ref_id'],
+            'field': row['field'],
+            'snippet': row['snippet'],
+            'score': -row['rank']
+        }
+        if row['kind'] == 'patient':
+            result['name'] = row['patient_name']
+        elif row['kind'] == 'doctor':
+            result['name'] = row['doctor_name']
+        else:
+            result['patient_id'] = row['schedule_patient_id']
+            result['medicine_name'] = row['medicine_name']
+        results.append(result)
+    return results
@@ -0,0 +1,73 @@
+import re
+import threading
+
+# Optional per-request SQL profiling. While a profile is active on the
+# current thread, every statement run through database.TimedCursor is
+# recorded: query count, total SQL time, the slowest statements and how
+# often each query shape repeats (the N+1 pattern).
+
+_NUMBER = re.compile(r"\b\d+(\.\d+)?\b")
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_WHITESPACE = re.compile(r"\s+")
+_IN_LIST = re.compile(r"\(\s*\?(\s*,\s*\?)*\s*\)")
+
+_local = threading.local()
+
+
+def query_shape(sql):
+    """Normalize a statement so that repeats with different literals match"""
+    shape = _STRING.sub('?', sql)
+    shape = _NUMBER.sub('?', shape)
+    shape = _IN_LIST.sub('(?)', shape)
+    return _WHITESPACE.sub(' ', shape).strip()
+
+
+class QueryProfile:
+    __slots__ = ('query_count', 'total_time', 'slowest', 'shapes', 'keep_slowest')
+
+    def __init__(self, keep_slowest=5):
+        self.query_count = 0
+        self.total_time = 0.0
+        self.slowest = []  # (elapsed, sql), longest first
+        self.shapes = {}  # shape -> count
+        self.keep_slowest = keep_slowest
+
+    def record(self, sql, elapsed):
+        self.query_count += 1
+        self.total_time += elapsed
+        shape = query_shape(sql)
+        self.shapes[shape] = self.shapes.get(shape, 0) + 1
+        if len(self.slowest) < self.keep_slowest or elapsed > self.slowest[-1][0]:
+            self.slowest.append((elapsed, shape))
+            self.slowest.sort(key=lambda item: item[0], reverse=True)
+            del self.slowest[self.keep_slowest:]
+
+    def repeated_shapes(self, threshold):
+        """Query shapes run at least `threshold` times (likely N+1 loops)"""
+        return {shape: count for shape, count in self.shapes.items() if count >= threshold}
+
+    def to_dict(self, repeat_threshold):
+        return {
+            'queries': self.query_count,
+            'sql_ms': round(self.total_time * 1000, 3),
+            'slowest': [{'ms': round(elapsed * 1000, 3), 'sql': sql} for elapsed, sql in self.slowest],
+            'repeated': self.repeated_shapes(repeat_threshold)
+        }
+
+
+def start_profile(keep_slowest=5):
+    profile = QueryProfile(keep_slowest)
+    _local.profile = profile
+    return profile
+
+
+def stop_profile():
+    profile = getattr(_local, 'profile', None)
+    _local.profile = None
+    return profile
+
+
+def record(sql, elapsed):
+    profile = getattr(_local, 'profile', None)
+    if profile is not None:
+        profile.record(sql, elapsed)
@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+# The modules are flat at the repository root and read their settings at
+# import time, so point them at a throwaway database before any import
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("PILL_DATABASE_FILE", os.path.join(tempfile.mkdtemp(prefix="pill-tests-"), "pill_data.db"))
+
+import database  # noqa: E402
+
+database.init_db()
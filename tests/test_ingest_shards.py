@@ -0,0 +1,158 @@
+import socket
+import threading
+import time
+import uuid
+
+import pytest
+
+import ingest_shards
+from config import MQTT_BROKER, MQTT_PORT
+from ingest_shards import ShardMembership, ShardedIngest, owner
+
+SERIALS = [f"SN{i:05d}" for i in range(2000)]
+
+
+def test_owner_is_stable_and_a_member():
+    members = ('a', 'b', 'c')
+    for serial in SERIALS[:100]:
+        assert owner(serial, members) in members
+        assert owner(serial, members) == owner(serial, tuple(reversed(members)))
+
+
+def test_owner_spreads_devices_over_members():
+    members = ('a', 'b', 'c', 'd')
+    counts = {node_id: 0 for node_id in members}
+    for serial in SERIALS:
+        counts[owner(serial, members)] += 1
+    expected = len(SERIALS) / len(members)
+    assert all(0.8 * expected < count < 1.2 * expected for count in counts.values())
+
+
+def test_only_the_leaving_members_devices_move():
+    before = ('a', 'b', 'c')
+    after = ('a', 'b')
+    for serial in SERIALS:
+        if owner(serial, before) != 'c':
+            assert owner(serial, after) == owner(serial, before)
+
+
+def test_heard_reports_joins_and_leaves_once():
+    membership = ShardMembership('a')
+    assert membership.heard('b') == ('a',)
+    assert membership.heard('b') is None  # heartbeat of a known member
+    assert membership.members() == ('a', 'b')
+    assert membership.heard('b', alive=False) == ('a', 'b')
+    assert membership.heard('b', alive=False) is None
+    assert membership.heard('a', alive=False) is None  # a node never removes itself
+    assert membership.members() == ('a',)
+
+
+def test_owns_follows_membership_changes():
+    membership = ShardMembership('a')
+    assert all(membership.owns(serial) for serial in SERIALS[:200])
+    membership.heard('b')
+    owned = {serial for serial in SERIALS[:200] if membership.owns(serial)}
+    assert owned == {serial for serial in SERIALS[:200] if owner(serial, ('a', 'b')) == 'a'}
+    assert 0 < len(owned) < 200
+    membership.heard('b', alive=False)
+    assert all(membership.owns(serial) for serial in SERIALS[:200])
+
+
+def test_expire_drops_silent_members():
+    membership = ShardMembership('a', timeout=5)
+    membership.heard('b')
+    membership.heard('c')
+    assert membership.expire() is None
+    membership._seen['b'] -= 10
+    assert membership.expire() == ('a', 'b', 'c')
+    assert membership.members() == ('a', 'c')
+
+
+@pytest.fixture
+def handoff(monkeypatch):
+    """Record the state handoff calls a rebalance makes instead of touching the database"""
+    calls = {'checkpoints': 0, 'retain': [], 'shadows': [], 'presence': []}
+    loaded = threading.Event()
+
+    def refresh_presence(serials):
+        calls['presence'].append(sorted(serials))
+        loaded.set()
+
+    monkeypatch.setattr(ingest_shards.device_shadow, 'serial_numbers', lambda: list(SERIALS[:300]))
+    monkeypatch.setattr(ingest_shards.device_shadow, 'checkpoint_shadows',
+                        lambda: calls.__setitem__('checkpoints', calls['checkpoints'] + 1))
+    monkeypatch.setattr(ingest_shards.device_shadow, 'refresh_shadows',
+                        lambda serials: calls['shadows'].append(sorted(serials)))
+    monkeypatch.setattr(ingest_shards.presence, 'retain', calls['retain'].append)
+    monkeypatch.setattr(ingest_shards.presence, 'refresh_presence', refresh_presence)
+    monkeypatch.setattr(ingest_shards, 'INGEST_HANDOFF_DELAY', 0.01)
+    calls['loaded'] = loaded
+    return calls
+
+
+def test_rebalance_on_join_hands_devices_over(handoff):
+    ingest = ShardedIngest('a')
+    previous = ingest.membership.heard('b')
+    ingest.rebalance(previous)
+    assert handoff['checkpoints'] == 1
+    assert handoff['retain'] == [ingest.membership.owns]
+    assert not handoff['loaded'].wait(0.2)  # nothing gained when a node joins
+
+
+def test_rebalance_on_leave_loads_gained_devices(handoff):
+    ingest = ShardedIngest('a')
+    ingest.membership.heard('b')
+    previous = ingest.membership.heard('b', alive=False)
+    ingest.rebalance(previous)
+    assert handoff['loaded'].wait(2)
+    gained = sorted(serial for serial in SERIALS[:300] if owner(serial, ('a', 'b')) == 'b')
+    assert handoff['shadows'] == [gained]
+    assert handoff['presence'] == [gained]
+
+
+def test_load_gained_skips_devices_no_longer_owned(handoff):
+    ingest = ShardedIngest('a')
+    ingest.membership.heard('b')
+    ingest._load_gained(SERIALS[:300])
+    assert handoff['shadows'] == [sorted(s for s in SERIALS[:300] if owner(s, ('a', 'b')) == 'a')]
+
+
+def _broker_available():
+    try:
+        socket.create_connection((MQTT_BROKER, MQTT_PORT), timeout=1).close()
+        return True
+    except OSError:
+        return False
+
+
+def _wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+@pytest.mark.skipif(not _broker_available(), reason=f"no MQTT broker on {MQTT_BROKER}:{MQTT_PORT}")
+def test_two_nodes_against_local_broker(monkeypatch):
+    # A private membership topic, so retained heartbeats of other runs cannot join
+    monkeypatch.setattr(ingest_shards, 'INGEST_MEMBERS_TOPIC', f"pill/_ingest_test/{uuid.uuid4().hex}")
+    suffix = uuid.uuid4().hex[:6]
+    first = ShardedIngest(f"a-{suffix}").start()
+    second = ShardedIngest(f"b-{suffix}").start()
+    running = [first, second]
+    try:
+        both = tuple(sorted((first.node_id, second.node_id)))
+        assert _wait_for(lambda: first.membership.members() == both
+                         and second.membership.members() == both)
+        for serial in SERIALS[:500]:
+            assert first.membership.owns(serial) != second.membership.owns(serial)
+
+        second.stop()
+        running.remove(second)
+        assert _wait_for(lambda: first.membership.members() == (first.node_id,))
+        assert all(first.membership.owns(serial) for serial in SERIALS[:500])
+    finally:
+        for ingest in running:
+            ingest.stop()
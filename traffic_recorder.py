@@ -0,0 +1,126 @@
+import atexit
+import logging
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Append-only recording of incoming MQTT traffic, for replaying real load
+# through the ingest path (benchmarks/replay_traffic.py).
+#
+# File layout: b"PILLREC1", then one record per message:
+#     <float64 wall-clock receive time> <uint16 topic length> <uint32 payload length> <topic> <payload>
+# little-endian. A record cut short by a crash is truncated away when the
+# file is next opened for recording, so new records never follow it.
+
+MAGIC = b"PILLREC1"
+_RECORD = struct.Struct('<dHI')
+FLUSH_INTERVAL = 1.0  # seconds buffered records may wait before hitting the file
+
+
+def _complete_length(f):
+    """Bytes of f up to the end of its last complete record"""
+    size = f.seek(0, 2)
+    f.seek(0)
+    magic = f.read(len(MAGIC))
+    if magic != MAGIC:
+        if size < len(MAGIC) and MAGIC.startswith(magic):
+            return 0  # crashed while writing the header
+        raise ValueError(f"{f.name} is not a traffic recording")
+    end = len(MAGIC)
+    while end + _RECORD.size <= size:
+        _, topic_length, payload_length = _RECORD.unpack(f.read(_RECORD.size))
+        following = end + _RECORD.size + topic_length + payload_length
+        if following > size:
+            break
+        end = f.seek(following)
+    return end
+
+
+class TrafficRecorder:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'ab+')
+        end = _complete_length(self._file)
+        if end < self._file.seek(0, 2):
+            logger.warning("truncating incomplete record", extra={'fields': {
+                'path': path, 'bytes': self._file.tell() - end}})
+            self._file.truncate(end)
+        if end == 0:
+            self._file.write(MAGIC)
+        self._lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+        self._stop = threading.Event()
+        self.count = 0
+        threading.Thread(target=self._flusher, name="traffic-flush", daemon=True).start()
+
+    def record(self, topic, payload, timestamp=None):
+        topic = topic.encode()
+        header = _RECORD.pack(timestamp or time.time(), len(topic), len(payload))
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(header + topic + payload)
+            self.count += 1
+            now = time.monotonic()
+            if now - self._flushed_at >= FLUSH_INTERVAL:
+                self._file.flush()
+                self._flushed_at = now
+
+    def _flusher(self):
+        # Quiet periods would otherwise leave the last records in the buffer
+        while not self._stop.wait(FLUSH_INTERVAL):
+            with self._lock:
+                if self._file.closed:
+                    return
+                self._file.flush()
+                self._flushed_at = time.monotonic()
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+        logger.info("traffic recording closed", extra={'fields': {'path': self.path, 'messages': self.count}})
+
+
+def read_recording(path):
+    """Yield (timestamp, topic, payload) for every complete record"""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a traffic recording")
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            timestamp, topic_length, payload_length = _RECORD.unpack(header)
+            body = f.read(topic_length + payload_length)
+            if len(body) < topic_length + payload_length:
+                return
+            yield timestamp, body[:topic_length].decode(), body[topic_length:]
+
+
+_recorder = None
+
+
+def start_recording(path):
+    global _recorder
+    if _recorder is None:
+        _recorder = TrafficRecorder(path)
+        atexit.register(stop_recording)
+        logger.info("recording MQTT traffic", extra={'fields': {'path': path}})
+    return _recorder
+
+
+def stop_recording():
+    global _recorder
+    if _recorder is not None:
+        _recorder.close()
+        _recorder = None
+
+
+def record(topic, payload):
+    recorder = _recorder
+    if recorder is not None:
+        recorder.record(topic, payload)
@@ -1,3 +1,8 @@
+from datetime import datetime, timedelta
+
+WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+DAY_NAMES = set(WEEKDAYS) | {'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday'}
+
 def transform_schedule_for_mqtt(schedules):
     """Transform database schedule format to MQTT format"""
     time_groups = {}
@@ -13,4 +18,65 @@ def transform_schedule_for_mqtt(schedules):
             }
         time_groups[time]['dispenser_modules'].append(schedule['module'])
     
-    return list(time_groups.values())
\ No newline at end of file
+    return list(time_groups.values())
+
+def normalize_timestamp(value):
+    """Device timestamp (epoch seconds or ISO string) -> ISO string, None if unusable"""
+    if value is None:
+        return None
+    try:
+        if isinstance(value, (int, float)):
+            return datetime.fromtimestamp(value).isoformat()
+        return datetime.fromisoformat(str(value)).isoformat()
+    except (ValueError, OverflowError, OSError):
+        return None
+
+
+def parse_time(value):
+    """"HH:MM" -> (hour, minute), None if it is not a valid time of day"""
+    try:
+        hour, minute = (int(part) for part in value.split(':'))
+    except (AttributeError, ValueError):
+        return None
+    if not (0 <= hour <= 23 and 0 <= minute <= 59):
+        return None
+    return hour, minute
+
+
+def valid_days(value):
+    """True for a list of weekday names ("mon", "Monday"); an empty list or None means daily"""
+    if value is None:
+        return True
+    return isinstance(value, list) and all(isinstance(day, str) and day.strip().lower() in DAY_NAMES
+                                           for day in value)
+
+
+def next_dose(schedules, now=None):
+    """Earliest upcoming dose within the next week.
+
+    `schedules` are dicts with time ("HH:MM"), repeat_type, days (list of
+    weekday names, empty for daily) and until_date ("YYYY-MM-DD" or None).
+    Returns (datetime, schedule) or (None, None).
+    """
+    now = now or datetime.now()
+    best, best_schedule = None, None
+    for schedule in schedules:
+        parsed = parse_time(schedule['time'])
+        if parsed is None:
+            continue  # stored before times were validated
+        hour, minute = parsed
+        days = {d.strip().lower()[:3] for d in schedule.get('days') or []} & set(WEEKDAYS)
+        daily = schedule.get('repeat_type') != 'custom' or not days
+        until = schedule.get('until_date')
+        for offset in range(8):
+            candidate = (now + timedelta(days=offset)).replace(hour=hour, minute=minute,
+                                                               second=0, microsecond=0)
+            if candidate < now:
+                continue
+            if until and candidate.date().isoformat() > until:
+                break
+            if daily or WEEKDAYS[candidate.weekday()] in days:
+                if best is None or candidate < best:
+                    best, best_schedule = candidate, schedule
+                break
+    return best, best_schedule